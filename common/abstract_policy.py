@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
-from typing import Tuple
+from contextlib import contextmanager
+from typing import Iterable, List, Tuple
+
+from common.evaluation_context import EvaluationContext
 
 
 class Policy(ABC):
@@ -11,6 +14,22 @@ class Policy(ABC):
     and cover the newly generated policy with meaningful unittests.
     """
 
+    # Row representation handed to `test_eligibility` by the default `test_eligibility_batch` adapter:
+    # "dict" for plain dictionaries (item access), "tuple" for named tuples (attribute access).
+    BATCH_ROW_FORMAT = "dict"
+
+    def __init__(self, context: EvaluationContext = None):
+        """
+        Args:
+            context (EvaluationContext): The fixed reference date (and date thresholds) of the evaluations.
+                If not given, every call to `test_eligibility` (or `test_eligibility_batch`) is evaluated at today.
+        """
+        self.context = context
+
+    def evaluation_context(self) -> EvaluationContext:
+        """The context of the current evaluation: the policy's fixed one, the one of the running batch, or today."""
+        return getattr(self, "context", None) or getattr(self, "_batch_context", None) or EvaluationContext()
+
     @abstractmethod
     def test_eligibility(self, case) -> Tuple:
         """
@@ -24,6 +43,38 @@ class Policy(ABC):
         """
         pass
 
+    def test_eligibility_batch(self, frame) -> List[Tuple]:
+        """
+        Tests the eligibility of every case of a DataFrame at once.
+
+        The default adapter feeds the rows to `test_eligibility` one by one, as plain dictionaries or named tuples
+        (see `BATCH_ROW_FORMAT`), which avoids building a pandas Series per row. Policies that can evaluate
+        whole columns at once should override it with a columnar implementation. Unless the policy has a fixed
+        context, the whole batch is evaluated with one context, at the day the batch started.
+
+        Args:
+            frame (pandas.DataFrame): The cases to be tested, one per row.
+
+        Returns: List[Tuple]: The results of `test_eligibility`, in the row order of the frame.
+        """
+        with self.batch_evaluation():
+            return [self.test_eligibility(row) for row in self.batch_rows(frame)]
+
+    def batch_rows(self, frame) -> Iterable:
+        """The rows of a DataFrame in the representation `test_eligibility` expects (see `BATCH_ROW_FORMAT`)."""
+        if self.BATCH_ROW_FORMAT == "tuple":
+            return frame.itertuples(index=False, name="Case")
+        return frame.to_dict(orient="records")
+
+    @contextmanager
+    def batch_evaluation(self):
+        """Evaluates the `test_eligibility` calls of the block with one context, unless the policy has a fixed one."""
+        self._batch_context = self.evaluation_context()
+        try:
+            yield
+        finally:
+            self._batch_context = None
+
 
 '''
     Testing class, which implements unittest.TestCase
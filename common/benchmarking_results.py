@@ -1,67 +1,113 @@
 import argparse
 import json
-from typing import Dict
+import os
+from collections import Counter
+from numbers import Number
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
 
-import pandas as pd
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
+from common.confusion_matrix import ConfusionMatrix
+from common.llm_telemetry import LLMTelemetry, telemetry_path
 
 
-def benchmark_results(resulting_file, column_mapping: Dict[str, str]) -> Dict[str, Dict[str, float | int]]:
-    print("Starting the benchmarking...")
+def comparable_value(value):
+    """
+    Maps a value to its class label: numbers and booleans are compared as floats (so 2 and 2.0 match, and so do
+    True and 1), any other value as its string representation.
+    """
+    if isinstance(value, Number):
+        return float(value)
+    return str(value)
+
 
-    # Load JSON file
+def iter_results(resulting_file) -> Iterator[Tuple[str | int, Dict]]:
+    """
+    Yields the (id, result) pairs of a results file: either a JSON object of results keyed by id,
+    or a JSONL file with one result per line (read line by line, without loading the whole file).
+    """
     with open(resulting_file, 'r', encoding='utf-8') as file:
-        data = json.load(file)
+        if not str(resulting_file).endswith(".jsonl"):
+            yield from json.load(file).items()
+            return
+
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line can be incomplete if the run was interrupted while writing it
+                print(f"Skipping an incomplete line of {resulting_file}")
+                continue
+            yield item.get("id"), item
 
-    # Extract test case and generated answer values
-    test_case_values = []
-    generated_values = []
 
-    for key, item in data.items():
-        test_case_entry = item["test_case"]
-        generated_entry = item["generated_answer"]
+def benchmark_results(resulting_file, column_mapping: Dict[str, str]) -> Dict[str, Dict[str, float | int]]:
+    print("Starting the benchmarking...")
 
-        row_test_case = []
-        row_generated = []
+    # Fold the test case and generated answer values into one confusion matrix per column
+    confusion_matrices = {col: ConfusionMatrix() for col in column_mapping.keys()}
+    batch_sizes = Counter()
 
-        for test_case_col, generated_col in column_mapping.items():
-            row_test_case.append(test_case_entry.get(test_case_col))
-            row_generated.append(generated_entry.get(generated_col))
+    for key, item in iter_results(resulting_file):
+        batch_sizes[item.get("batch_size", 1)] += 1
+        test_case_entry = item["test_case"]
+        generated_entry = item["generated_answer"] or {}
 
-        test_case_values.append(row_test_case)
-        generated_values.append(row_generated)
+        for test_case_col, generated_col in column_mapping.items():
+            confusion_matrices[test_case_col].add(comparable_value(test_case_entry.get(test_case_col)),
+                                                  comparable_value(generated_entry.get(generated_col)))
 
-    # Convert to DataFrame
-    df_test_case = pd.DataFrame(test_case_values, columns=column_mapping.keys())
-    df_generated = pd.DataFrame(generated_values, columns=column_mapping.keys())
+    if set(batch_sizes) != {1}:
+        print("Cases per batch size: " + ", ".join(f"{size}: {count}" for size, count in sorted(batch_sizes.items())))
 
     # Calculate metrics for each column
     metrics = {}
-    for col in column_mapping.keys():
-        y_true = df_test_case[col]
-        y_pred = df_generated[col]
-
-        # Convert categorical values to strings for comparison
-        if not pd.api.types.is_numeric_dtype(y_true) or not pd.api.types.is_numeric_dtype(y_pred):
-            y_true = y_true.astype(str)
-            y_pred = y_pred.astype(str)
-
-        # Compute metrics
-        accuracy = accuracy_score(y_true, y_pred)
-        precision = precision_score(y_true, y_pred, average='weighted', zero_division=0)
-        recall = recall_score(y_true, y_pred, average='weighted', zero_division=0)
-        f1 = f1_score(y_true, y_pred, average='weighted', zero_division=0)
+    for col, confusion_matrix in confusion_matrices.items():
+        col_metrics = confusion_matrix.metrics()
 
         metrics[col] = {
-            "accuracy": accuracy,
-            "precision": precision,
-            "recall": recall,
-            "f1_score": f1
+            "accuracy": col_metrics["accuracy"],
+            "precision": col_metrics["precision"],
+            "recall": col_metrics["recall"],
+            "f1_score": col_metrics["f1"]
         }
 
+    # Token and latency aggregates of the run, when its telemetry was saved next to the results
+    telemetry = LLMTelemetry.load(telemetry_path(resulting_file))
+    if len(telemetry):
+        metrics["telemetry"] = telemetry.summary()
+
     return metrics
 
 
+def compare_results(resulting_files: List[str], column_mapping: Dict[str, str]) -> Dict[str, Dict]:
+    """The benchmark_results of several results files (e.g. one per model of a fan-out run), keyed by file."""
+    return {resulting_file: benchmark_results(resulting_file, column_mapping) for resulting_file in resulting_files}
+
+
+def print_comparison_table(comparison: Dict[str, Dict]):
+    """Prints the metrics of every evaluated column of several results files side by side, as a markdown table."""
+    header = ["results", "column", "accuracy", "precision", "recall", "f1_score", "latency p50 (s)", "tokens/s"]
+    rows = []
+    for resulting_file, metrics in comparison.items():
+        # Telemetry of a single model run: its only model
+        telemetry = next(iter(metrics.get("telemetry", {}).values()), {})
+        latency = (telemetry.get("latency") or {}).get("p50")
+        tokens_per_second = telemetry.get("tokens_per_second")
+        for column, column_metrics in metrics.items():
+            if column == "telemetry":
+                continue
+            rows.append([Path(resulting_file).stem, column] +
+                        [f"{column_metrics[name]:.4f}" for name in ["accuracy", "precision", "recall", "f1_score"]] +
+                        [f"{latency:.2f}" if latency is not None else "-",
+                         f"{tokens_per_second:.1f}" if tokens_per_second is not None else "-"])
+
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    for row in [header, ["-" * width for width in widths]] + rows:
+        print("| " + " | ".join(str(cell).ljust(width) for cell, width in zip(row, widths)) + " |")
+
+
 def parse_column_mapping(value):
     """
     Parses the column_mapping argument, which should be a JSON string.
@@ -76,18 +122,99 @@ def parse_column_mapping(value):
         raise ValueError("Invalid format for column_mapping. Must be a valid JSON string.")
 
 
+import contextlib
+import io
+import tempfile
+import unittest
+
+
+class ResultsFilesTestCase(unittest.TestCase):
+    RESULTS = {"a": {"test_case": {"eligibility": True}, "generated_answer": {"eligible": True}},
+               "b": {"test_case": {"eligibility": False}, "generated_answer": {"eligible": True}}}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, filename, text) -> str:
+        path = os.path.join(self.directory.name, filename)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(text)
+        return path
+
+
+class TestIterResults(ResultsFilesTestCase):
+    def test_json_and_jsonl(self):
+        json_path = self.write("results.json", json.dumps(self.RESULTS))
+        jsonl_path = self.write("results.jsonl", "".join(json.dumps({"id": key, **result}) + "\n"
+                                                         for key, result in self.RESULTS.items()))
+        self.assertEqual(dict(iter_results(json_path)), self.RESULTS)
+        self.assertEqual({key: result["test_case"] for key, result in iter_results(jsonl_path)},
+                         {key: result["test_case"] for key, result in self.RESULTS.items()})
+
+    def test_incomplete_last_line(self):
+        lines = [json.dumps({"id": key, **result}) for key, result in self.RESULTS.items()]
+        path = self.write("results.jsonl", lines[0] + "\n\n" + lines[1][:20])
+        self.assertEqual([key for key, _ in iter_results(path)], ["a"])
+
+
+
+class TestComparableValue(unittest.TestCase):
+    def test_numbers_and_booleans(self):
+        self.assertEqual(comparable_value(2), comparable_value(2.0))
+        self.assertEqual(comparable_value(True), comparable_value(1.0))
+        self.assertEqual(comparable_value(False), comparable_value(0))
+        self.assertNotEqual(comparable_value(True), comparable_value(2))
+
+    def test_other_values(self):
+        self.assertEqual(comparable_value("approved"), "approved")
+        self.assertEqual(comparable_value(None), "None")
+        self.assertNotEqual(comparable_value("1"), comparable_value(1))
+
+
+class TestCompareResults(ResultsFilesTestCase):
+    def test_compare_results(self):
+        perfect = self.write("results_a.json", json.dumps({key: {**result, "generated_answer": {
+            "eligible": result["test_case"]["eligibility"]}} for key, result in self.RESULTS.items()}))
+        half = self.write("results_b.json", json.dumps(self.RESULTS))
+        telemetry = LLMTelemetry()
+        telemetry.records = [{"model": "b", "batch_size": 1, "prompt_tokens": 10, "completion_tokens": 4,
+                              "time_to_first_token": None, "queue_time": 0.0, "retry_time": 0.0, "latency": 2.0,
+                              "failed": False}]
+        telemetry.save(telemetry_path(half))
+
+        comparison = compare_results([perfect, half], {"eligibility": "eligible"})
+        self.assertEqual(list(comparison), [perfect, half])
+        self.assertEqual(comparison[perfect]["eligibility"]["accuracy"], 1.0)
+        self.assertEqual(comparison[half]["eligibility"]["accuracy"], 0.5)
+        self.assertNotIn("telemetry", comparison[perfect])
+        self.assertEqual(comparison[half]["telemetry"]["b"]["tokens_per_second"], 2.0)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            print_comparison_table(comparison)
+        rows = output.getvalue().splitlines()
+        self.assertIn("| results_a ", rows[2])
+        self.assertTrue(rows[3].rstrip(" |").endswith("2.0"))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate the benchmarking metrics from the resulting json")
-    parser.add_argument("--output_file", type=str, required=True, help="The path for the benchmarking results output")
+    parser.add_argument("--output_file", type=str, required=True, nargs="+",
+                        help="The path for the benchmarking results output. With several files, their metrics are compared in a table.")
     parser.add_argument("--column_mapping", type=str, required=True,
                         help="JSON string for column name mapping for benchmark metrics calculation (e.g., '{\"eligibility\": \"elig\"}').")
 
     args = parser.parse_args()
 
     column_mapping = parse_column_mapping(args.column_mapping)
-    if column_mapping:
-        res = benchmark_results(args.output_file, column_mapping)
+    if column_mapping and len(args.output_file) == 1:
+        res = benchmark_results(args.output_file[0], column_mapping)
         print(res)
+    elif column_mapping:
+        print_comparison_table(compare_results(args.output_file, column_mapping))
     else:
         print("Something went wrong during column mapping")
 
@@ -0,0 +1,116 @@
+from collections import Counter
+from typing import Dict, Iterable
+
+import numpy as np
+
+
+class ConfusionMatrix:
+    """
+    Online confusion matrix of a single evaluated column.
+
+    The matrix is stored sparsely as counts of (true value, predicted value) pairs, so it can be updated
+    chunk by chunk, and partial matrices (from chunks, workers or LLM calls) can be merged together.
+    The weighted metrics it produces are the same as sklearn's with ``average="weighted", zero_division=0``.
+    """
+
+    def __init__(self, counts: Dict = None):
+        self.counts = Counter(counts or {})
+
+    def add(self, y_true, y_pred, count: int = 1) -> "ConfusionMatrix":
+        """Counts one (true value, predicted value) pair."""
+        self.counts[(y_true, y_pred)] += count
+        return self
+
+    def update(self, y_true: Iterable, y_pred: Iterable) -> "ConfusionMatrix":
+        """Counts the pairs of two aligned sequences of true and predicted values."""
+        self.counts.update(zip(y_true, y_pred))
+        return self
+
+    def merge(self, other: "ConfusionMatrix") -> "ConfusionMatrix":
+        """Adds the counts of another partial matrix to this one."""
+        self.counts.update(other.counts)
+        return self
+
+    def __add__(self, other: "ConfusionMatrix") -> "ConfusionMatrix":
+        return ConfusionMatrix(self.counts).merge(other)
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def labels(self) -> list:
+        labels = {label for pair in self.counts for label in pair}
+        try:
+            return sorted(labels)
+        except TypeError:
+            # Mixed label types cannot be ordered, the order does not change the metrics
+            return sorted(labels, key=str)
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        Computes the accuracy and the support-weighted precision, recall and F1 score in one pass over the counts.
+        """
+        labels = self.labels()
+        index = {label: i for i, label in enumerate(labels)}
+        true_positives = np.zeros(len(labels))
+        support = np.zeros(len(labels))
+        predicted = np.zeros(len(labels))
+
+        for (y_true, y_pred), count in self.counts.items():
+            support[index[y_true]] += count
+            predicted[index[y_pred]] += count
+            if y_true == y_pred:
+                true_positives[index[y_true]] += count
+
+        total = support.sum()
+        if not total:
+            return {"accuracy": 0.0, "precision": 0.0, "recall": 0.0, "f1": 0.0}
+
+        precision = np.divide(true_positives, predicted, out=np.zeros(len(labels)), where=predicted > 0)
+        recall = np.divide(true_positives, support, out=np.zeros(len(labels)), where=support > 0)
+        f1_denominator = predicted + support
+        f1 = np.divide(2 * true_positives, f1_denominator, out=np.zeros(len(labels)), where=f1_denominator > 0)
+
+        return {
+            "accuracy": float(true_positives.sum() / total),
+            "precision": float(np.average(precision, weights=support)),
+            "recall": float(np.average(recall, weights=support)),
+            "f1": float(np.average(f1, weights=support)),
+        }
+
+    def __repr__(self):
+        return f"ConfusionMatrix({dict(self.counts)})"
+
+
+import unittest
+
+
+class TestConfusionMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.y_true = ["a", "b", "a", "c", "a", "b", "c", "c"]
+        self.y_pred = ["a", "a", "a", "c", "b", "b", "a", "c"]
+
+    def test_metrics_match_sklearn(self):
+        from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+
+        metrics = ConfusionMatrix().update(self.y_true, self.y_pred).metrics()
+        self.assertAlmostEqual(metrics["accuracy"], accuracy_score(self.y_true, self.y_pred))
+        self.assertAlmostEqual(metrics["precision"],
+                               precision_score(self.y_true, self.y_pred, average="weighted", zero_division=0))
+        self.assertAlmostEqual(metrics["recall"],
+                               recall_score(self.y_true, self.y_pred, average="weighted", zero_division=0))
+        self.assertAlmostEqual(metrics["f1"], f1_score(self.y_true, self.y_pred, average="weighted", zero_division=0))
+
+    def test_merged_partial_matrices(self):
+        first = ConfusionMatrix().update(self.y_true[:3], self.y_pred[:3])
+        second = ConfusionMatrix().update(self.y_true[3:], self.y_pred[3:])
+        full = ConfusionMatrix().update(self.y_true, self.y_pred)
+        self.assertEqual((first + second).metrics(), full.metrics())
+        self.assertEqual(len(first.merge(second)), len(self.y_true))
+
+    def test_empty_matrix(self):
+        self.assertEqual(ConfusionMatrix().metrics()["accuracy"], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
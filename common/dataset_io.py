@@ -0,0 +1,489 @@
+import json
+import os
+from typing import Dict, Iterator, List
+
+import numpy as np
+import pandas as pd
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+ARROW_EXTENSIONS = (".arrow", ".feather")
+
+
+def is_parquet(path) -> bool:
+    return os.path.splitext(str(path))[1].lower() in PARQUET_EXTENSIONS
+
+
+def is_arrow(path) -> bool:
+    return os.path.splitext(str(path))[1].lower() in ARROW_EXTENSIONS
+
+
+def _decode_nested(value):
+    """The JSON value of a nested cell: JSON text is decoded, empty and missing cells are null."""
+    if isinstance(value, str):
+        return json.loads(value) if value else None
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    return value
+
+
+def _without_null_types(data_type):
+    """
+    The type inferred from a chunk, with the types left unknown (e.g. the elements of lists that were always empty,
+    or fields that were always null) replaced by strings, so that the next chunks can fill them.
+    """
+    import pyarrow as pa
+
+    if pa.types.is_null(data_type):
+        return pa.string()
+    if pa.types.is_struct(data_type):
+        return pa.struct([field.with_type(_without_null_types(field.type)) for field in data_type])
+    if pa.types.is_list(data_type) or pa.types.is_large_list(data_type):
+        return pa.list_(_without_null_types(data_type.value_type))
+    return data_type
+
+
+def _has_null_types(data_type) -> bool:
+    """Whether some part of the type is still unknown (null), e.g. the elements of lists that were always empty."""
+    import pyarrow as pa
+
+    if pa.types.is_null(data_type):
+        return True
+    if pa.types.is_struct(data_type):
+        return any(_has_null_types(field.type) for field in data_type)
+    if pa.types.is_list(data_type) or pa.types.is_large_list(data_type):
+        return _has_null_types(data_type.value_type)
+    return False
+
+
+def _merge_types(data_type, other):
+    """
+    The type fitting the values of both types, inferred from two chunks: the unknown (null) parts of one are taken
+    from the other, the struct fields are united and integers are widened to floats.
+    Raises a ValueError if the types conflict.
+    """
+    import pyarrow as pa
+
+    if pa.types.is_null(data_type) or data_type == other:
+        return other
+    if pa.types.is_null(other):
+        return data_type
+    if pa.types.is_struct(data_type) and pa.types.is_struct(other):
+        others = {field.name: field.type for field in other}
+        names = {field.name for field in data_type}
+        fields = [field.with_type(_merge_types(field.type, others[field.name])) if field.name in others else field
+                  for field in data_type]
+        return pa.struct(fields + [field for field in other if field.name not in names])
+    if (pa.types.is_list(data_type) or pa.types.is_large_list(data_type)) and \
+            (pa.types.is_list(other) or pa.types.is_large_list(other)):
+        return pa.list_(_merge_types(data_type.value_type, other.value_type))
+    numbers = (pa.types.is_integer, pa.types.is_floating)
+    if any(is_type(data_type) for is_type in numbers) and any(is_type(other) for is_type in numbers):
+        return pa.float64()
+    raise ValueError(f"The types {data_type} and {other} conflict.")
+
+
+def _unknown_keys(value, data_type, path: str = "") -> Iterator[str]:
+    """The paths of the dictionary keys of a nested value that are not fields of the struct type at their place."""
+    import pyarrow as pa
+
+    if isinstance(value, dict) and pa.types.is_struct(data_type):
+        fields = {field.name: field.type for field in data_type}
+        for key, item in value.items():
+            if key not in fields:
+                yield f"{path}.{key}" if path else key
+            else:
+                yield from _unknown_keys(item, fields[key], f"{path}.{key}" if path else key)
+    elif isinstance(value, list) and (pa.types.is_list(data_type) or pa.types.is_large_list(data_type)):
+        for item in value:
+            yield from _unknown_keys(item, data_type.value_type, f"{path}[]")
+
+
+def frame_to_arrow(frame: pd.DataFrame, nested_columns: List[str] = None, schema=None, widen_null_types: bool = True):
+    """
+    Converts a DataFrame to an Arrow table, decoding the JSON text of the nested columns into struct/list columns.
+    Without a schema, it is inferred from the frame, its unknown types widened to strings if `widen_null_types`
+    (see _without_null_types).
+    Raises a ValueError if a column does not fit the given schema, including nested keys that are not fields of
+    their struct (Arrow would silently drop them). Struct fields missing from a value are stored as null.
+    """
+    import pyarrow as pa
+
+    nested_columns = set(nested_columns or [])
+    arrays = []
+    for column in frame.columns:
+        values = [_decode_nested(value) for value in frame[column]] if column in nested_columns else frame[column]
+        data_type = schema.field(column).type if schema is not None and column in schema.names else None
+        if schema is not None and column in nested_columns and data_type is not None:
+            for value in values:
+                unknown = next(_unknown_keys(value, data_type), None)
+                if unknown is not None:
+                    raise ValueError(f"The column '{column}' has the key '{unknown}', not a field of {data_type}.")
+        if schema is not None and data_type is None:
+            raise ValueError(f"The column '{column}' is not in the schema {schema}.")
+        try:
+            arrays.append(pa.array(values, type=data_type, from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, KeyError) as e:
+            raise ValueError(f"The column '{column}' does not fit the schema {schema}. ({e})") from e
+    table = pa.Table.from_arrays(arrays, names=list(frame.columns))
+
+    if schema is None and widen_null_types:
+        table = table.cast(pa.schema([field.with_type(_without_null_types(field.type)) for field in table.schema]))
+    return table
+
+
+class ParquetDatasetWriter:
+    """
+    Incremental writer of a generated dataset into a Parquet file, one row group per written chunk.
+
+    The nested columns (JSON text in the csv datasets, e.g. the applicants or the luggages) are stored as
+    struct/list columns. The schema is inferred from the first chunks: while some of its types are still unknown
+    (columns always null, lists always empty so far), the chunks are held back and their types merged, up to
+    `max_pending_rows` rows; the types still unknown then are stored as strings. The next chunks must fit the
+    schema: a ValueError is raised for a nested key absent from the first chunks, instead of dropping it.
+    """
+
+    def __init__(self, path, nested_columns: List[str] = None, compression: str = "snappy",
+                 max_pending_rows: int = 10000):
+        """
+        :param path: The Parquet file to write.
+        :param nested_columns: The columns holding JSON text (or already decoded dictionaries and lists).
+        :param compression: The Parquet compression codec.
+        :param max_pending_rows: The number of rows held back at most to infer the unknown types of the schema.
+        """
+        self.path = path
+        self.nested_columns = set(nested_columns or [])
+        self.compression = compression
+        self.max_pending_rows = max_pending_rows
+        self.schema = None
+        self.rows = 0
+        self._writer = None
+        self._pending = []
+        self._pending_schema = None
+
+    def write(self, chunk: pd.DataFrame):
+        """Appends the chunk to the file as one row group."""
+        if self._writer is not None:
+            self._write_table(chunk)
+        else:
+            self._hold_back(chunk)
+        self.rows += len(chunk)
+
+    def _hold_back(self, chunk: pd.DataFrame):
+        """Merges the types of the chunk into the pending schema, and opens the file once they are all known."""
+        import pyarrow as pa
+
+        schema = frame_to_arrow(chunk, self.nested_columns, widen_null_types=False).schema
+        if self._pending_schema is not None:
+            if schema.names != self._pending_schema.names:
+                raise ValueError(f"A chunk of {self.path} has the columns {schema.names}, "
+                                 f"not {self._pending_schema.names}.")
+            schema = pa.schema([field.with_type(_merge_types(field.type, other.type))
+                                for field, other in zip(self._pending_schema, schema)])
+        self._pending.append(chunk)
+        self._pending_schema = schema
+        if not any(_has_null_types(field.type) for field in schema) or \
+                sum(len(pending) for pending in self._pending) >= self.max_pending_rows:
+            self._open()
+
+    def _open(self):
+        """Opens the file with the pending schema, its unknown types widened to strings, and writes the held chunks."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.schema = pa.schema([field.with_type(_without_null_types(field.type)) for field in self._pending_schema])
+        self._writer = pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+        pending, self._pending = self._pending, []
+        for chunk in pending:
+            self._write_table(chunk)
+
+    def _write_table(self, chunk: pd.DataFrame):
+        try:
+            table = frame_to_arrow(chunk, self.nested_columns, self.schema)
+        except ValueError as e:
+            raise ValueError(f"A chunk does not fit the schema of {self.path} inferred from the first chunks; "
+                             f"use larger chunks. ({e})") from e
+        self._writer.write_table(table, row_group_size=max(len(chunk), 1))
+
+    def close(self):
+        if self._writer is None and self._pending:
+            self._open()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def arrow_to_frame(table) -> pd.DataFrame:
+    """
+    Converts an Arrow table or record batch to a DataFrame; the nested columns hold Python dictionaries and lists,
+    like the decoded JSON text of the csv datasets.
+    """
+    import pyarrow as pa
+
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_nested(column.type):
+            columns[name] = pd.Series(column.to_pylist(), dtype=object)
+        else:
+            columns[name] = column.to_pandas()
+    return pd.DataFrame(columns)
+
+
+def read_dataset(path, columns: List[str] = None) -> pd.DataFrame:
+    """Reads a Parquet dataset, only the given columns if any."""
+    import pyarrow.parquet as pq
+
+    return arrow_to_frame(pq.read_table(path, columns=columns))
+
+
+def iter_dataset(path, columns: List[str] = None, batch_size: int = None) -> Iterator[pd.DataFrame]:
+    """
+    Reads a Parquet dataset in chunks of `batch_size` rows (the row groups of the file if not given),
+    only the given columns if any. The chunks keep their row numbers in the file as index.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    start = 0
+    if batch_size is None:
+        batches = (parquet_file.read_row_group(index, columns=columns) for index in range(parquet_file.num_row_groups))
+    else:
+        batches = parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+    for batch in batches:
+        frame = arrow_to_frame(batch)
+        frame.index = pd.RangeIndex(start, start + len(frame))
+        start += len(frame)
+        yield frame
+
+
+def detect_nested_columns(frame: pd.DataFrame) -> List[str]:
+    """The text columns whose first non-empty value is a JSON object or array."""
+    nested_columns = []
+    for column in frame.columns:
+        values = frame[column].dropna()
+        values = values[values.astype(str).str.len() > 0]
+        if values.empty or not isinstance(values.iloc[0], str) or values.iloc[0].lstrip()[:1] not in ("{", "["):
+            continue
+        try:
+            json.loads(values.iloc[0])
+        except json.JSONDecodeError:
+            continue
+        nested_columns.append(column)
+    return nested_columns
+
+
+def arrow_path(source) -> str:
+    """The memory-mappable Arrow file converted from a dataset: data/dataset.csv -> data/dataset.arrow"""
+    return os.path.splitext(str(source))[0] + ".arrow"
+
+
+def convert_to_arrow(source, target=None, nested_columns: List[str] = None) -> str:
+    """
+    One-time conversion of a csv or Parquet dataset into an uncompressed Arrow IPC file, which later runs open
+    memory-mapped (see open_arrow_dataset). The JSON text columns of a csv dataset (detected if not given) are
+    decoded once into struct/list columns, whose numeric fields are stored as contiguous arrays.
+
+    :return: The path of the Arrow file, arrow_path(source) if not given.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    target = target or arrow_path(source)
+    if is_parquet(source):
+        table = pq.read_table(source)
+    else:
+        frame = pd.read_csv(source, na_filter=True)
+        table = frame_to_arrow(frame, detect_nested_columns(frame) if nested_columns is None else nested_columns)
+
+    # A single record batch keeps every column contiguous, so that it can be read without copy
+    table = table.combine_chunks()
+    temporary_path = f"{target}.{os.getpid()}.tmp"
+    with pa.OSFile(temporary_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temporary_path, target)
+    return target
+
+
+def ensure_arrow_dataset(source) -> str:
+    """The Arrow file of a dataset, converted first if it is missing or older than the dataset."""
+    if is_arrow(source):
+        return source
+    target = arrow_path(source)
+    if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(source):
+        convert_to_arrow(source, target)
+    return target
+
+
+def open_arrow_dataset(path, columns: List[str] = None):
+    """
+    Opens an Arrow IPC dataset memory-mapped: the returned table reads its buffers from the mapped file
+    without copying them, the pages are loaded on first access.
+    """
+    import pyarrow as pa
+
+    table = pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    return table.select(columns) if columns is not None else table
+
+
+def iter_arrow_dataset(path, columns: List[str] = None, batch_size: int = None) -> Iterator[pd.DataFrame]:
+    """
+    Reads a memory-mapped Arrow dataset in chunks of `batch_size` rows (at once if not given), only the given
+    columns if any. The chunks keep their row numbers in the file as index.
+    """
+    table = open_arrow_dataset(path, columns)
+    batch_size = batch_size or max(len(table), 1)
+    for start in range(0, len(table), batch_size):
+        frame = arrow_to_frame(table.slice(start, batch_size))
+        frame.index = pd.RangeIndex(start, start + len(frame))
+        yield frame
+
+
+def numeric_arrays(table) -> Dict[str, np.ndarray]:
+    """
+    The numeric fields of a table as NumPy arrays, without copy when they have no null values, named after their
+    path: "loan_amount", "applicant.credit_score" (null applicants are NaN), "luggages.weight" (the weights of all
+    the luggages, row after row, with their boundaries in "luggages.offsets").
+    """
+    import pyarrow as pa
+
+    arrays = {}
+
+    def collect(name, array):
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        if pa.types.is_struct(array.type):
+            # flatten() applies the nulls of the parent to the fields
+            for field, child in zip(array.type, array.flatten()):
+                collect(f"{name}.{field.name}", child)
+        elif pa.types.is_list(array.type) or pa.types.is_large_list(array.type):
+            offsets = array.offsets.to_numpy()
+            arrays[f"{name}.offsets"] = offsets - offsets[0]
+            collect(name, array.flatten())
+        elif pa.types.is_integer(array.type) or pa.types.is_floating(array.type):
+            arrays[name] = array.to_numpy(zero_copy_only=False)
+
+    for name, column in zip(table.column_names, table.columns):
+        collect(name, column)
+    return arrays
+
+
+import unittest
+
+
+class TestDatasetIO(unittest.TestCase):
+
+    def test_nested_round_trip(self):
+        import tempfile
+
+        chunks = [
+            pd.DataFrame({"applicant": [json.dumps({"credit_score": 700, "history": []}), ""],
+                          "loan_amount": [5000, 7000], "reason": ["", "Low income"]}),
+            pd.DataFrame({"applicant": [json.dumps({"credit_score": 650, "history": ["late"]})],
+                          "loan_amount": [9000], "reason": [""]}),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dataset.parquet")
+            with ParquetDatasetWriter(path, ["applicant"]) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+            self.assertEqual(writer.rows, 3)
+
+            data = read_dataset(path)
+            self.assertEqual(data["applicant"].tolist(), [{"credit_score": 700, "history": []}, None,
+                                                          {"credit_score": 650, "history": ["late"]}])
+            self.assertEqual(data["loan_amount"].tolist(), [5000, 7000, 9000])
+            self.assertEqual(list(read_dataset(path, ["reason"]).columns), ["reason"])
+
+            streamed = list(iter_dataset(path, ["loan_amount"]))
+            self.assertEqual([len(chunk) for chunk in streamed], [2, 1])
+            self.assertEqual(streamed[1].index.tolist(), [2])
+            self.assertEqual(sum(len(chunk) for chunk in iter_dataset(path, batch_size=1)), 3)
+
+    def test_memory_mapped_arrow_dataset(self):
+        import tempfile
+
+        frame = pd.DataFrame({
+            "luggages": [json.dumps([{"weight": 7.5, "dimensions": {"height": 40.0}}]), json.dumps([]),
+                         json.dumps([{"weight": 20.0, "dimensions": {"height": 70.0}}, {"weight": 3.0, "dimensions": {"height": 20.0}}])],
+            "applicant": [json.dumps({"credit_score": 700}), "", json.dumps({"credit_score": 650})],
+            "fees": [0, 50, 100],
+            "message": ["ok", "", "too heavy"],
+        })
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "dataset.csv")
+            frame.to_csv(source, index=False)
+            path = ensure_arrow_dataset(source)
+            self.assertEqual(path, os.path.join(directory, "dataset.arrow"))
+            modified = os.path.getmtime(path)
+            self.assertEqual(ensure_arrow_dataset(source), path)
+            self.assertEqual(os.path.getmtime(path), modified)
+
+            table = open_arrow_dataset(path)
+            arrays = numeric_arrays(table)
+            self.assertEqual(arrays["luggages.weight"].tolist(), [7.5, 20.0, 3.0])
+            self.assertEqual(arrays["luggages.dimensions.height"].tolist(), [40.0, 70.0, 20.0])
+            self.assertEqual(arrays["luggages.offsets"].tolist(), [0, 1, 1, 3])
+            self.assertTrue(np.isnan(arrays["applicant.credit_score"][1]))
+            self.assertEqual(arrays["fees"].tolist(), [0, 50, 100])
+
+            data = arrow_to_frame(open_arrow_dataset(path, ["luggages", "message"])).fillna("")
+            self.assertEqual(data["luggages"].tolist()[1], [])
+            self.assertEqual(data["message"].tolist(), ["ok", "", "too heavy"])
+            self.assertEqual([chunk.index.tolist() for chunk in iter_arrow_dataset(path, ["fees"], 2)], [[0, 1], [2]])
+
+    def test_chunk_not_fitting_the_schema(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            with ParquetDatasetWriter(os.path.join(directory, "dataset.parquet"), ["vehicle"]) as writer:
+                writer.write(pd.DataFrame({"vehicle": [json.dumps({"age": 3})]}))
+                with self.assertRaises(ValueError):
+                    writer.write(pd.DataFrame({"vehicle": [json.dumps({"age": "old"})]}))
+
+    def test_unknown_types_of_the_first_chunks(self):
+        import tempfile
+
+        chunks = [
+            pd.DataFrame({"vehicle": [json.dumps({"owners": [], "color": None})], "fee": [None]}),
+            pd.DataFrame({"vehicle": [json.dumps({"owners": [{"name": "A"}], "color": None})], "fee": [None]}),
+            pd.DataFrame({"vehicle": [json.dumps({"owners": [], "color": None})], "fee": [12.5]}),
+            pd.DataFrame({"vehicle": [json.dumps({"owners": [], "color": None})], "fee": [30]}),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dataset.parquet")
+            with ParquetDatasetWriter(path, ["vehicle"]) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+            data = read_dataset(path)
+            self.assertEqual(data["vehicle"].tolist()[1], {"owners": [{"name": "A"}], "color": None})
+            self.assertEqual(data["fee"].fillna(0).tolist(), [0, 0, 12.5, 30])
+            self.assertEqual(writer.schema.field("vehicle").type.field("color").type, "string")
+
+            with ParquetDatasetWriter(path, ["vehicle"], max_pending_rows=1) as writer:
+                writer.write(chunks[0])
+                with self.assertRaises(ValueError):
+                    writer.write(chunks[1])
+
+    def test_chunk_with_new_nested_key(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dataset.parquet")
+            with ParquetDatasetWriter(path, ["vehicle"]) as writer:
+                writer.write(pd.DataFrame({"vehicle": [json.dumps({"age": 3, "owners": [{"name": "A"}]})]}))
+                writer.write(pd.DataFrame({"vehicle": [json.dumps({"age": 4})]}))
+                with self.assertRaisesRegex(ValueError, "'color'"):
+                    writer.write(pd.DataFrame({"vehicle": [json.dumps({"age": 5, "color": "red"})]}))
+                with self.assertRaisesRegex(ValueError, r"'owners\[\]\.email'"):
+                    writer.write(pd.DataFrame({"vehicle": [json.dumps({"age": 5, "owners": [{"email": "b@c"}]})]}))
+            self.assertEqual(read_dataset(path)["vehicle"].tolist(), [{"age": 3, "owners": [{"name": "A"}]},
+                                                                      {"age": 4, "owners": None}])
+
+
+if __name__ == "__main__":
+    unittest.main()
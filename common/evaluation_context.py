@@ -0,0 +1,93 @@
+from datetime import date, timedelta
+from typing import Dict, Union
+
+DAYS_PER_YEAR = 365
+
+
+class EvaluationContext:
+    """
+    Fixed reference date of a policy evaluation, with the date thresholds derived from it.
+
+    Policies compute ages and time windows in whole 365-day years ((reference - date).days // 365). A context
+    computes every such cutoff once, as a date ordinal, and parses each distinct date string only once, so that a
+    batch of requests is evaluated against the same day without calling date.today() or date.fromisoformat per
+    record. The comparisons against the cutoffs are exactly equivalent to the year arithmetic:
+
+        age_in_years(d) <  n  <=>  ordinal(d) >  years_ago(n)
+        age_in_years(d) >= n  <=>  ordinal(d) <= years_ago(n)
+    """
+
+    def __init__(self, reference_date: date = None):
+        """
+        :param reference_date: The day the requests are evaluated at, date.today() if not given.
+        """
+        self.reference_date = reference_date or date.today()
+        self.reference_ordinal = self.reference_date.toordinal()
+        self._cutoffs: Dict[int, int] = {}
+        self._ordinals: Dict[str, int] = {}
+
+    def years_ago(self, years: int) -> int:
+        """The ordinal of the date `years` 365-day years before the reference date."""
+        cutoff = self._cutoffs.get(years)
+        if cutoff is None:
+            cutoff = self._cutoffs[years] = self.reference_ordinal - years * DAYS_PER_YEAR
+        return cutoff
+
+    def ordinal(self, value: Union[date, str, int]) -> int:
+        """The ordinal of a date given as a date, an ISO string (parsed once per distinct string) or an ordinal."""
+        if isinstance(value, int):
+            return value
+        if isinstance(value, date):
+            return value.toordinal()
+        ordinal = self._ordinals.get(value)
+        if ordinal is None:
+            ordinal = self._ordinals[value] = date.fromisoformat(value).toordinal()
+        return ordinal
+
+    def age_in_years(self, value: Union[date, str, int]) -> int:
+        """The number of whole 365-day years between a date and the reference date."""
+        return (self.reference_ordinal - self.ordinal(value)) // DAYS_PER_YEAR
+
+    def date_years_ago(self, years: int, days: int = 0) -> date:
+        """The date `years` 365-day years (and `days` days) before the reference date."""
+        return self.reference_date - timedelta(days=years * DAYS_PER_YEAR + days)
+
+
+def as_date(value: Union[date, str, int]) -> date:
+    """A date given as a date, an ISO string or a date ordinal (as datasets store pre-parsed dates)."""
+    if isinstance(value, date):
+        return value
+    if isinstance(value, int):
+        return date.fromordinal(value)
+    return date.fromisoformat(value)
+
+
+import unittest
+
+
+class TestEvaluationContext(unittest.TestCase):
+    def setUp(self):
+        self.context = EvaluationContext(date(2024, 3, 1))
+
+    def test_cutoffs_match_year_arithmetic(self):
+        for days in range(18 * 365 - 3, 18 * 365 + 3):
+            birth_date = self.context.reference_date - timedelta(days=days)
+            self.assertEqual(self.context.age_in_years(birth_date) < 18,
+                             birth_date.toordinal() > self.context.years_ago(18))
+
+    def test_ordinal_formats(self):
+        ordinal = date(2020, 2, 29).toordinal()
+        self.assertEqual(self.context.ordinal("2020-02-29"), ordinal)
+        self.assertEqual(self.context.ordinal(date(2020, 2, 29)), ordinal)
+        self.assertEqual(self.context.ordinal(ordinal), ordinal)
+        self.assertEqual(as_date(ordinal), as_date("2020-02-29"))
+
+    def test_default_reference_date(self):
+        self.assertEqual(EvaluationContext().reference_date, date.today())
+
+    def test_date_years_ago(self):
+        self.assertEqual(self.context.date_years_ago(5).toordinal(), self.context.years_ago(5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,42 @@
+import argparse
 from abc import ABC, abstractmethod
-from typing import List, Dict, Tuple
+from collections import deque
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Tuple, Iterator
+import numpy as np
 import pandas as pd
+import random
 import sys
 import os
+import time
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
 from common.abstract_policy import Policy
+from common.dataset_io import ParquetDatasetWriter, is_parquet
+
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Generator instance of a worker process, set once by the pool initializer
+_worker_generator = None
+
+
+def _init_generator_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _generate_worker_chunk(chunk):
+    return _worker_generator.generate_chunk(*chunk)
+
+
+def derive_seed(seed, chunk_index: int) -> int | None:
+    """The seed of one chunk, derived from the seed of the dataset (None stays unseeded)."""
+    if seed is None:
+        return None
+    return int(np.random.SeedSequence([seed, chunk_index]).generate_state(1)[0])
 
 
 class DataGenerator(ABC):
@@ -28,6 +58,9 @@ class DataGenerator(ABC):
         """
         pass
 
+    # Columns holding JSON text, stored as nested struct/list columns in Parquet datasets
+    NESTED_COLUMNS: List[str] = []
+
     ## PUT ALL OTHER CONSTANTS/ENUMS USED IN THE CODE HERE
 
     def __init__(self, policy_checker: Policy):
@@ -38,15 +71,94 @@ class DataGenerator(ABC):
         """
         self.policy_checker = policy_checker  # Policy instance
 
-    def generate_test_dataset(self, num_samples=100) -> pd.DataFrame:
+    def generate_test_dataset(self, num_samples=100, seed=None, workers=1, chunk_size=None) -> pd.DataFrame:
         """
         Generate a test dataset with an approximately equal number of positive and negative cases.
 
+        Every chunk holds its positive cases then its negative ones. A dataset of at most `chunk_size` samples is
+        therefore laid out as before chunking (all the positive cases, then all the negative ones), but a larger
+        dataset alternates blocks of positive and negative cases, chunk after chunk.
+
         :param num_samples: Total number of samples to generate.
+        :param seed: Optional seed; the same seed and chunk size always generate the same dataset, whatever the
+                     number of workers.
+        :param workers: Number of worker processes generating the chunks of the dataset.
+        :param chunk_size: Number of samples per chunk, each one half positive and half negative (default: 10000).
         :return: DataFrame containing the generated dataset.
         """
-        num_positive = num_samples // 2
-        num_negative = num_samples - num_positive  # To handle odd numbers properly
+        chunks = list(self.iter_test_dataset(num_samples, seed, workers, chunk_size))
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+    def iter_test_dataset(self, num_samples=100, seed=None, workers=1, chunk_size=None) -> Iterator[pd.DataFrame]:
+        """
+        Generate a test dataset chunk by chunk, in order, so that it never needs to be held in memory at once.
+        Every chunk is generated with its own seed derived from `seed` and its index, half positive and half negative.
+        With several workers, the chunks are generated by a process pool, a few chunks ahead of the consumer.
+
+        See generate_test_dataset for the parameters.
+        """
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        chunks = []
+        for chunk_index, start in enumerate(range(0, num_samples, chunk_size)):
+            size = min(chunk_size, num_samples - start)
+            chunks.append((size // 2, size - size // 2, derive_seed(seed, chunk_index)))
+
+        if workers == 1:
+            for chunk in chunks:
+                yield self.generate_chunk(*chunk)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_generator_worker, initargs=(self,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_generate_worker_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def write_test_dataset(self, path, num_samples=100, seed=None, workers=1, chunk_size=None, **to_csv_kwargs) -> int:
+        """
+        Generate a test dataset straight to a csv or Parquet file, one chunk at a time, printing the throughput
+        in rows/sec. In a Parquet file (.parquet extension), every chunk is a row group and the NESTED_COLUMNS
+        are stored as struct/list columns instead of JSON text.
+
+        The rows are in the order of generate_test_dataset: with more than `chunk_size` samples (10000 by default),
+        the file alternates blocks of positive and negative cases instead of holding all the positive cases first.
+        Consumers should not rely on the row order, e.g. to split positive and negative cases by position.
+
+        :param path: The csv or Parquet file to write.
+        :param to_csv_kwargs: Additional arguments of DataFrame.to_csv (e.g. quoting), ignored for Parquet files.
+        :return: The number of written rows.
+
+        See generate_test_dataset for the other parameters.
+        """
+        parquet_writer = ParquetDatasetWriter(path, self.NESTED_COLUMNS) if is_parquet(path) else None
+        start_time = time.time()
+        rows = 0
+        try:
+            for chunk_index, chunk in enumerate(self.iter_test_dataset(num_samples, seed, workers, chunk_size)):
+                if parquet_writer:
+                    parquet_writer.write(chunk)
+                else:
+                    chunk.to_csv(path, index=False, mode="w" if chunk_index == 0 else "a", header=chunk_index == 0,
+                                 **to_csv_kwargs)
+                rows += len(chunk)
+                elapsed = time.time() - start_time
+                print(f"{path}: {rows}/{num_samples} rows, {rows / elapsed if elapsed else 0:.0f} rows/sec")
+        finally:
+            if parquet_writer:
+                parquet_writer.close()
+        return rows
+
+    def generate_chunk(self, num_positive, num_negative, seed=None) -> pd.DataFrame:
+        """
+        Generate the given numbers of positive then negative cases.
+
+        :param seed: Optional seed of the random generator, set before generating the cases.
+        """
+        if seed is not None:
+            random.seed(seed)
 
         data = []
 
@@ -115,3 +227,89 @@ def format_data_units(n):
 
     label = f'{nb_units}{unit}'
     return label
+
+
+def data_generator_parser(reference_date: bool = False) -> argparse.ArgumentParser:
+    """
+    The command line parser of a data generator script, with the options of write_test_datasets.
+
+    :param reference_date: Whether to add the --reference_date and --date_ordinals options, for the generators
+        taking a reference date and date_ordinals.
+    """
+    parser = argparse.ArgumentParser(description="Generate the reference testing datasets")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000], help="The number of test cases of every dataset.")
+    parser.add_argument("--seed", type=int, required=False, default=None, help="Optional seed, to generate the same datasets again.")
+    parser.add_argument("--workers", type=int, required=False, default=1, help="The number of worker processes (default: 1).")
+    parser.add_argument("--chunk_size", type=int, required=False, default=None,
+                        help="The number of test cases generated and written at once (default: 10000).")
+    parser.add_argument("--format", type=str, choices=["csv", "parquet"], default="csv",
+                        help="The format of the datasets; Parquet stores the nested objects as struct/list columns.")
+    if reference_date:
+        parser.add_argument("--reference_date", type=date.fromisoformat, required=False, default=None,
+                            help="The day (YYYY-MM-DD) the requests are generated for and labelled at (default: today).")
+        parser.add_argument("--date_ordinals", action="store_true",
+                            help="Store the dates as date ordinals instead of ISO strings, to skip parsing them.")
+    return parser
+
+
+def write_test_datasets(generator: DataGenerator, name_template: str, args: argparse.Namespace, **to_csv_kwargs):
+    """
+    Writes a dataset of every size of the parsed command line (see data_generator_parser).
+
+    :param name_template: The file name of the datasets, formatted with the size (see format_data_units) and the
+        format, e.g. 'loan_policy_test_dataset_{size}.{format}'.
+    :param to_csv_kwargs: Additional arguments of DataFrame.to_csv (see DataGenerator.write_test_dataset).
+    """
+    for size in args.sizes:
+        path = name_template.format(size=format_data_units(size), format=args.format)
+        generator.write_test_dataset(path, size, args.seed, args.workers, args.chunk_size, **to_csv_kwargs)
+
+
+import unittest
+
+
+class _RandomCaseGenerator(DataGenerator):
+    COLUMN_NAMES = ["value", "eligibility"]
+    EVAL_COLUMN_NAMES = ["eligibility"]
+
+    def __init__(self):
+        super().__init__(None)
+
+    def generate_eligible_case(self) -> Dict:
+        return {"value": random.randint(0, 10 ** 9), "eligibility": True}
+
+    def generate_non_eligible_case(self) -> Dict:
+        return {"value": random.randint(0, 10 ** 9), "eligibility": False}
+
+
+class TestDataGenerator(unittest.TestCase):
+
+    def test_seeded_chunks(self):
+        generator = _RandomCaseGenerator()
+        serial = generator.generate_test_dataset(25, seed=3, chunk_size=10)
+        parallel = generator.generate_test_dataset(25, seed=3, workers=2, chunk_size=10)
+        pd.testing.assert_frame_equal(serial, parallel)
+        self.assertEqual(serial["eligibility"].tolist(), [True] * 5 + [False] * 5 + [True] * 5 + [False] * 5
+                         + [True] * 2 + [False] * 3)
+        self.assertNotEqual(serial["value"].tolist(), generator.generate_test_dataset(25, seed=4, chunk_size=10)["value"].tolist())
+
+    def test_single_chunk_order(self):
+        dataset = _RandomCaseGenerator().generate_test_dataset(25, seed=3)
+        self.assertEqual(dataset["eligibility"].tolist(), [True] * 12 + [False] * 13)
+
+    def test_write_test_datasets(self):
+        import tempfile
+
+        args = data_generator_parser().parse_args(["--sizes", "5", "1000", "--seed", "3", "--chunk_size", "400"])
+        self.assertFalse(hasattr(args, "reference_date"))
+        with tempfile.TemporaryDirectory() as directory:
+            write_test_datasets(_RandomCaseGenerator(), os.path.join(directory, "dataset_{size}.{format}"), args)
+            self.assertEqual(sorted(os.listdir(directory)), ["dataset_1K.csv", "dataset_5.csv"])
+            self.assertEqual(len(pd.read_csv(os.path.join(directory, "dataset_1K.csv"))), 1000)
+
+        args = data_generator_parser(reference_date=True).parse_args(["--reference_date", "2024-03-01"])
+        self.assertEqual((args.reference_date, args.date_ordinals), (date(2024, 3, 1), False))
+
+
+if __name__ == "__main__":
+    unittest.main()
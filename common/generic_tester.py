@@ -1,71 +1,217 @@
+import contextlib
 import csv
 import datetime
+import math
 import os
 import pprint
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from sklearn.metrics import accuracy_score, f1_score, recall_score, precision_score
-from sklearn.preprocessing import LabelEncoder
+
+from common.abstract_policy import Policy
+from common.confusion_matrix import ConfusionMatrix
+from common.dataset_io import (arrow_to_frame, ensure_arrow_dataset, is_arrow, is_parquet, iter_arrow_dataset,
+                               iter_dataset, open_arrow_dataset, read_dataset)
+
+
+# Per-worker policy instance, built once by the pool initializer
+_worker_state = threading.local()
+
+
+def _init_worker(policy_factory):
+    _worker_state.policy = policy_factory()
+
+
+def _test_chunk(chunk):
+    return evaluate_policy(_worker_state.policy, chunk)
+
+
+def evaluate_policy(policy, data):
+    """
+    Evaluates every row of the data with the policy, with the execution time of every row.
+
+    Policies overriding `Policy.test_eligibility_batch` evaluate the whole frame at once: the time of the batch is
+    then spread evenly over its rows. The other policies are timed row by row, on the rows of their batch adapter.
+    """
+    if isinstance(policy, Policy) and type(policy).test_eligibility_batch is not Policy.test_eligibility_batch:
+        start_time = time.time()
+        results = list(policy.test_eligibility_batch(data))
+        execution_time = (time.time() - start_time) / max(len(results), 1)
+
+        return results, [execution_time] * len(results)
+
+    if isinstance(policy, Policy):
+        rows = policy.batch_rows(data)
+        evaluation = policy.batch_evaluation()
+    else:
+        rows = (row for _, row in data.iterrows())
+        evaluation = contextlib.nullcontext()
+
+    results = []
+    execution_times = []
+
+    with evaluation:
+        for row in rows:
+            start_time = time.time()
+            result = policy.test_eligibility(row)
+            execution_time = time.time() - start_time
+
+            results.append(result)
+            execution_times.append(execution_time)
+
+    return results, execution_times
 
 
 class PolicyTester:
 
     RESULTS_SAVING_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output")
+    EXECUTORS = ["serial", "threads", "processes"]
 
-    def __init__(self, policy_class, csv_file, parse_functions=None, eval_columns=None, evaluators=None, save_in_csv=False):
+    def __init__(self, policy_class, csv_file, parse_functions=None, eval_columns=None, evaluators=None, save_in_csv=False,
+                 executor="serial", max_workers=None, chunk_size=None, stream_chunk_size=None, columns=None,
+                 memory_map=False):
         """
         :param policy_class: The policy class to be tested.
-        :param csv_file: Path to the CSV file.
+        :param csv_file: Path to the CSV file, or to a Parquet (.parquet) or Arrow (.arrow) file whose nested columns
+                         are read as dictionaries and lists instead of JSON text.
         :param parse_functions: Dictionary of column-specific parsing functions.
         :param eval_columns: Ordered list of column names expected from test_policy results.
         :param evaluators: List of evaluator functions.
         :param save_in_csv: A boolean to save the results in CSV file.
+        :param executor: How the cases are evaluated: "serial", "threads" or "processes".
+        :param max_workers: Number of parallel workers (defaults to the number of CPUs).
+        :param chunk_size: Number of rows sent to a worker at once (defaults to an even split between the workers).
+        :param stream_chunk_size: If set, the CSV file is streamed in chunks of this many rows instead of being loaded at once.
+        :param columns: Optional list of the columns to read, the other columns of a Parquet file are not read at all.
+        :param memory_map: If True, the dataset is converted once into an Arrow file next to it, which this run and
+                           the next ones open memory-mapped instead of parsing the dataset again.
         """
+        if executor not in self.EXECUTORS:
+            raise ValueError(f"Unknown executor '{executor}'. Must be one of {self.EXECUTORS}.")
+
         self.policy_class = policy_class
         self.csv_file = csv_file
         self.parse_functions = parse_functions
         self.evaluators = evaluators
         self.eval_columns = eval_columns
         self.save_in_csv = save_in_csv
+        self.executor = executor
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.stream_chunk_size = stream_chunk_size
+        self.columns = columns
+        self.memory_map = memory_map
         self.data = None
         self.policy = None
+        self.pool = None
+
+    def dataset_path(self):
+        """The file the data is read from: the Arrow conversion of the dataset with memory_map."""
+        return ensure_arrow_dataset(self.csv_file) if self.memory_map else self.csv_file
 
     def load_data(self):
-        self.data = pd.read_csv(self.csv_file, na_filter=True).fillna("")
+        path = self.dataset_path()
+        if is_arrow(path):
+            data = arrow_to_frame(open_arrow_dataset(path, self.columns))
+        elif is_parquet(self.csv_file):
+            data = read_dataset(self.csv_file, self.columns)
+        else:
+            data = pd.read_csv(self.csv_file, na_filter=True, usecols=self.columns)
+        self.data = self.parse_data(data.fillna(""))
+
+    def iter_data(self):
+        path = self.dataset_path()
+        if is_arrow(path):
+            chunks = iter_arrow_dataset(path, self.columns, self.stream_chunk_size)
+        elif is_parquet(self.csv_file):
+            chunks = iter_dataset(self.csv_file, self.columns, self.stream_chunk_size)
+        else:
+            chunks = pd.read_csv(self.csv_file, na_filter=True, usecols=self.columns, chunksize=self.stream_chunk_size)
+        for chunk in chunks:
+            yield self.parse_data(chunk.fillna(""))
+
+    def parse_data(self, data):
         if not self.parse_functions:
-            return
+            return data
         for column, parse_function in self.parse_functions.items():
             if column == '*c':
-                for df_column in self.data.columns:
-                    self.data.rename(columns={f'{df_column}': parse_function(df_column)}, inplace=True)
+                for df_column in data.columns:
+                    data.rename(columns={f'{df_column}': parse_function(df_column)}, inplace=True)
+            elif getattr(parse_function, "columnar", False):
+                # Columnar parse functions get the whole column, and may return several columns to add
+                parsed = parse_function(data[column])
+                if isinstance(parsed, pd.DataFrame):
+                    for parsed_column in parsed.columns:
+                        data[parsed_column] = parsed[parsed_column].to_numpy()
+                else:
+                    data[column] = list(parsed)
             else:
-                self.data[column] = self.data[column].apply(parse_function)
+                data[column] = data[column].apply(parse_function)
+        return data
 
     def initialize_policy(self):
         self.policy = self.policy_class()
 
     def test_policy(self):
-        results = []
-        execution_times = []
+        """Evaluates every row of the data with the policy of the tester (see evaluate_policy)."""
+        return evaluate_policy(self.policy, self.data)
 
-        for _, row in self.data.iterrows():
-            start_time = time.time()
-            result = self.policy.test_eligibility(row)
-            execution_time = time.time() - start_time
+    @contextlib.contextmanager
+    def worker_pool(self):
+        """
+        The worker pool of the parallel executors, shared by all the execute_policy calls of the block (e.g. by all
+        the chunks of a streamed run). Every worker builds its policy once, by calling the policy class.
+        """
+        if self.executor == "serial" or self.pool is not None:
+            yield self.pool
+            return
 
-            results.append(result)
-            execution_times.append(execution_time)
+        pool_class = ProcessPoolExecutor if self.executor == "processes" else ThreadPoolExecutor
+        with pool_class(max_workers=self.max_workers, initializer=_init_worker, initargs=(self.policy_class,)) as pool:
+            self.pool = pool
+            try:
+                yield pool
+            finally:
+                self.pool = None
+
+    def execute_policy(self):
+        """
+        Runs test_policy with the configured executor. In parallel mode the data is split into chunks of rows,
+        evaluated by the workers of the pool (see worker_pool), and the results are merged back in the original
+        row order. The serial executor builds its policy once, on its first call.
+        """
+        if self.executor == "serial" or len(self.data) == 0:
+            if self.policy is None:
+                self.initialize_policy()
+            return self.test_policy()
+
+        if self.pool is None:
+            with self.worker_pool():
+                return self.execute_policy()
+
+        chunk_size = self.chunk_size or math.ceil(len(self.data) / self.max_workers)
+        chunks = [self.data.iloc[start:start + chunk_size] for start in range(0, len(self.data), chunk_size)]
+        chunk_outputs = list(self.pool.map(_test_chunk, chunks))
+
+        results = [result for chunk_results, _ in chunk_outputs for result in chunk_results]
+        execution_times = [execution_time for _, chunk_times in chunk_outputs for execution_time in chunk_times]
 
         return results, execution_times
 
     @staticmethod
     def calculate_metrics(y_true_encoded, y_pred_encoded):
+        return PolicyTester.report_metrics(ConfusionMatrix().update(y_true_encoded, y_pred_encoded))
+
+    @staticmethod
+    def report_metrics(confusion_matrix: ConfusionMatrix):
         # Compute metrics
-        accuracy = accuracy_score(y_true_encoded, y_pred_encoded)
-        f1 = f1_score(y_true_encoded, y_pred_encoded, average="weighted", zero_division=0.0)
-        recall = recall_score(y_true_encoded, y_pred_encoded, average="weighted", zero_division=0.0)
-        precision = precision_score(y_true_encoded, y_pred_encoded, average="weighted", zero_division=0.0)
+        column_metrics = confusion_matrix.metrics()
+        accuracy = column_metrics["accuracy"]
+        f1 = column_metrics["f1"]
+        recall = column_metrics["recall"]
+        precision = column_metrics["precision"]
 
         print(f"  Accuracy: {accuracy}")
         print(f"  F1 Score: {f1}")
@@ -76,43 +222,77 @@ class PolicyTester:
 
     def statistics_tester(self, results_transposed):
         diff_indices = {}
-        label_encoder = LabelEncoder()
-
         metrics = {}
 
         for idx, column in enumerate(self.eval_columns):
             y_true = self.data[column]
             y_pred = results_transposed[idx] if idx < len(results_transposed) else []
-            y_pred = ['' if i is None else i for i in y_pred]
 
             if len(y_pred) != len(y_true):
                 print(f"Skipping evaluation for {column} due to size mismatch.")
                 continue
 
-            # Boolean and numerical columns can be directly compared
-            if y_true.dtype == bool or np.issubdtype(y_true.dtype, np.number):
-                y_true_encoded = y_true.astype(int)  # Convert bool to int if needed
-                y_pred_encoded = np.array(y_pred, dtype=int)
-            else:
-                # Assume string values, arrays, dictionaries, apply LabelEncoder
-                y_true = y_true.astype(str)
-                y_pred = [str(pred) for pred in y_pred]
-
-                label_encoder.fit(list(y_true) + y_pred)
-                y_true_encoded = label_encoder.transform(y_true)
-                y_pred_encoded = label_encoder.transform(y_pred)
+            y_true_encoded, y_pred_encoded = self.normalize_column(y_true, y_pred)
 
             print(f"\nMetrics for {column}:")
             metrics[column] = self.calculate_metrics(y_true_encoded, y_pred_encoded)
 
-            diff_indices[column] = np.where(y_true_encoded != y_pred_encoded)[0]
+            diff_indices[column] = np.where(np.asarray(y_true_encoded) != np.asarray(y_pred_encoded))[0]
 
         return metrics, diff_indices
 
+    @staticmethod
+    def normalize_column(y_true, y_pred, numeric=None):
+        """
+        Brings the true and predicted values of a column to comparable types:
+        integer arrays for boolean and numerical columns, lists of strings otherwise.
+        `numeric` forces the kind of the column instead of inferring it from the dtype of `y_true`, e.g. the kind
+        of the first chunk of a streamed dataset: the values of a numeric column that are not numbers (such as the
+        "" of missing values in a later chunk) are then kept as strings.
+        """
+        y_pred = ['' if i is None else i for i in y_pred]
+        if numeric is None:
+            numeric = y_true.dtype == bool or np.issubdtype(y_true.dtype, np.number)
+
+        # Boolean and numerical columns can be directly compared
+        if numeric:
+            return PolicyTester.integer_labels(y_true.to_numpy()), PolicyTester.integer_labels(y_pred)
+
+        return list(y_true.astype(str)), [str(pred) for pred in y_pred]
+
+    @staticmethod
+    def integer_labels(values) -> np.ndarray:
+        """The values as integers, or as an object array keeping the values that are not numbers as strings."""
+        try:
+            return np.asarray(values).astype(int)
+        except (TypeError, ValueError):
+            return np.array([PolicyTester.integer_label(value) for value in values], dtype=object)
+
+    @staticmethod
+    def integer_label(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError, OverflowError):
+            return str(value)
+
+    def predictions_frame(self, results_transposed):
+        dd = self.data.copy(deep=True)
+
+        if self.eval_columns:
+            for i in range(len(self.eval_columns)):
+                dd[self.eval_columns[i]] = results_transposed[i]
+        else:
+            for i in range(len(results_transposed)):
+                dd[f"output_{i}"] = results_transposed[i]
+
+        return dd
+
     def run(self):
+        if self.stream_chunk_size:
+            return self.run_streaming()
+
         self.load_data()
-        self.initialize_policy()
-        test_results, execution_times = self.test_policy()
+        test_results, execution_times = self.execute_policy()
 
         # Transpose results to match columns
         results_transposed = list(zip(*test_results))
@@ -130,16 +310,7 @@ class PolicyTester:
             results_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
             path = os.path.join(self.RESULTS_SAVING_DIRECTORY, f"{results_id}_predicted_testresults.csv")
-            dd = self.data.copy(deep=True)
-
-            if self.eval_columns:
-                for i in range(len(self.eval_columns)):
-                    dd[self.eval_columns[i]] = results_transposed[i]
-            else:
-                for i in range(len(results_transposed)):
-                    dd[f"output_{i}"] = results_transposed[i]
-
-            dd.to_csv(path, index=False)
+            self.predictions_frame(results_transposed).to_csv(path, index=False)
 
             print(f"Results are saved with this id {results_id}")
 
@@ -159,26 +330,204 @@ class PolicyTester:
             with open(path, 'w') as csvfile:
                 writer = csv.DictWriter(csvfile, fieldnames=["data_sample", "true_value", "predicted_value"])
                 writer.writeheader()
-                for column, indices in diff_indices.items():
-                    for el in indices:
-                        print(f"\nDiscrepancy in {column}:")
-                        print("Case:")
-                        pprint.pprint(self.data.loc[el])
-                        print(
-                            f"True value: {self.data[column][el]},\nPredicted: {results_transposed[self.eval_columns.index(column)][el]}")
-                        print("=========")
-
-                        writer.writerow({
-                            "data_sample": self.data.loc[el].to_dict(),
-                            "true_value": self.data[column][el],
-                            "predicted_value": results_transposed[self.eval_columns.index(column)][el]
-                        })
+                self.report_discrepancies(diff_indices, results_transposed, writer)
+        else:
+            self.report_discrepancies(diff_indices, results_transposed)
+
+    def report_discrepancies(self, diff_indices, results_transposed, writer=None):
+        for column, indices in diff_indices.items():
+            for el in indices:
+                predicted_value = results_transposed[self.eval_columns.index(column)][el]
+                print(f"\nDiscrepancy in {column}:")
+                print("Case:")
+                pprint.pprint(self.data.iloc[el])
+                print(
+                    f"True value: {self.data[column].iloc[el]},\nPredicted: {predicted_value}")
+                print("=========")
+
+                if writer:
+                    writer.writerow({
+                        "data_sample": self.data.iloc[el].to_dict(),
+                        "true_value": self.data[column].iloc[el],
+                        "predicted_value": predicted_value
+                    })
+
+    def run_streaming(self):
+        """
+        Streaming version of `run`: the CSV file is read in chunks of `stream_chunk_size` rows, each chunk is parsed,
+        evaluated and folded into running confusion matrices, so only one chunk is held in memory at a time.
+        """
+        results_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        if self.save_in_csv:
+            os.makedirs(self.RESULTS_SAVING_DIRECTORY, exist_ok=True)
+            predicted_path = os.path.join(self.RESULTS_SAVING_DIRECTORY, f"{results_id}_predicted_testresults.csv")
+            difference_path = os.path.join(self.RESULTS_SAVING_DIRECTORY, f"{results_id}_difference_testresults.csv")
+            difference_file = open(difference_path, 'w')
+            writer = csv.DictWriter(difference_file, fieldnames=["data_sample", "true_value", "predicted_value"])
+            writer.writeheader()
         else:
-            for column, indices in diff_indices.items():
-                for el in indices:
-                    print(f"\nDiscrepancy in {column}:")
-                    print("Case:")
-                    pprint.pprint(self.data.loc[el])
-                    print(
-                        f"True value: {self.data[column][el]},\nPredicted: {results_transposed[self.eval_columns.index(column)][el]}")
-                    print("=========")
+            writer = None
+
+        confusion_matrices = {column: ConfusionMatrix() for column in self.eval_columns or []}
+        # Column kinds are inferred from the first chunk, so that all the chunks are compared the same way
+        numeric_columns = {}
+        total_execution_time = 0.0
+        total_cases = 0
+
+        try:
+            with self.worker_pool():
+                for chunk_number, chunk in enumerate(self.iter_data()):
+                    self.data = chunk
+                    test_results, execution_times = self.execute_policy()
+                    results_transposed = list(zip(*test_results))
+                    total_execution_time += sum(execution_times)
+                    total_cases += len(execution_times)
+
+                    if self.evaluators:
+                        print(f"Evaluation Results (rows {chunk.index[0]}-{chunk.index[-1]}):")
+                        for evaluator in self.evaluators:
+                            evaluator(self.data, results_transposed)
+
+                    if self.save_in_csv:
+                        self.predictions_frame(results_transposed).to_csv(
+                            predicted_path, index=False, mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0)
+
+                    diff_indices = {}
+                    for idx, column in enumerate(self.eval_columns or []):
+                        y_pred = results_transposed[idx] if idx < len(results_transposed) else []
+                        if len(y_pred) != len(chunk):
+                            print(f"Skipping evaluation for {column} due to size mismatch.")
+                            continue
+                        y_true, y_pred = self.normalize_column(chunk[column], y_pred, numeric_columns.get(column))
+                        numeric_columns.setdefault(column, isinstance(y_true, np.ndarray))
+                        confusion_matrices[column].update(y_true, y_pred)
+                        diff_indices[column] = np.where(np.asarray(y_true) != np.asarray(y_pred))[0]
+
+                    self.report_discrepancies(diff_indices, results_transposed, writer)
+        finally:
+            if writer:
+                difference_file.close()
+
+        if self.evaluators:
+            print(f"\nAverage Execution Time: {total_execution_time / max(total_cases, 1)} seconds")
+        if self.save_in_csv:
+            print(f"Results are saved with this id {results_id}")
+
+        if not self.eval_columns:
+            print("The eval_columns are not specified! Skipping...")
+            return
+
+        metrics = {}
+        for column, confusion_matrix in confusion_matrices.items():
+            if not len(confusion_matrix):
+                continue
+            print(f"\nMetrics for {column}:")
+            metrics[column] = self.report_metrics(confusion_matrix)
+
+        if self.save_in_csv:
+            path = os.path.join(self.RESULTS_SAVING_DIRECTORY, f"{results_id}_metrics_testresults.csv")
+            with open(path, 'w') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=metrics.keys())
+                writer.writeheader()
+                writer.writerow(metrics)
+
+        return metrics
+
+
+import io
+import tempfile
+import unittest
+
+
+class RowTimedPolicy(Policy):
+    """Test policy without a batch implementation, slower on the odd cases."""
+
+    def test_eligibility(self, case):
+        if case["value"] % 2:
+            time.sleep(0.005)
+        return case["value"] > 2, case["value"] * 2
+
+
+class ColumnarPolicy(RowTimedPolicy):
+    """Test policy evaluating the whole frame at once."""
+
+    def test_eligibility_batch(self, frame):
+        return list(zip((frame["value"] > 2).tolist(), (frame["value"] * 2).tolist()))
+
+
+class CountedPolicy(ColumnarPolicy):
+    """Test policy counting its instances."""
+    instances = 0
+    instances_lock = threading.Lock()
+
+    def __init__(self):
+        super().__init__()
+        with CountedPolicy.instances_lock:
+            CountedPolicy.instances += 1
+
+
+class TestPolicyTester(unittest.TestCase):
+    def policy_tester(self, policy_class, **kwargs) -> PolicyTester:
+        tester = PolicyTester(policy_class, None, **kwargs)
+        tester.data = pd.DataFrame({"value": [1, 2, 3, 4]})
+        tester.initialize_policy()
+        return tester
+
+    def test_rows_timed_one_by_one(self):
+        results, execution_times = self.policy_tester(RowTimedPolicy).test_policy()
+        self.assertEqual(results, [(False, 2), (False, 4), (True, 6), (True, 8)])
+        self.assertGreater(min(execution_times[0], execution_times[2]), max(execution_times[1], execution_times[3]))
+
+    def test_batch_time_spread(self):
+        results, execution_times = self.policy_tester(ColumnarPolicy).test_policy()
+        self.assertEqual(results, [(False, 2), (False, 4), (True, 6), (True, 8)])
+        self.assertEqual(len(set(execution_times)), 1)
+
+
+class TestExecutors(unittest.TestCase):
+    VALUES = [1, 2, 3, 4, 5, 6, 7]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.csv_file = os.path.join(self.directory.name, "dataset.csv")
+        # The expected doubles of the last chunk are missing, the first chunks make the column numeric
+        pd.DataFrame({"value": self.VALUES, "eligible": [value > 2 for value in self.VALUES],
+                      "doubled": [value * 2 for value in self.VALUES[:-1]] + [""]}).to_csv(self.csv_file, index=False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_tester(self, policy_class, **kwargs):
+        tester = PolicyTester(policy_class, self.csv_file, eval_columns=["eligible", "doubled"], max_workers=2, **kwargs)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return tester.run()
+
+    def test_executors_match_serial(self):
+        outputs = {}
+        for executor in PolicyTester.EXECUTORS:
+            tester = PolicyTester(RowTimedPolicy, self.csv_file, executor=executor, max_workers=2, chunk_size=3)
+            tester.load_data()
+            results, execution_times = tester.execute_policy()
+            outputs[executor] = results
+            self.assertEqual(len(execution_times), len(self.VALUES))
+        self.assertEqual(outputs["threads"], outputs["serial"])
+        self.assertEqual(outputs["processes"], outputs["serial"])
+
+    def test_streaming_metrics(self):
+        for executor in PolicyTester.EXECUTORS:
+            metrics = self.run_tester(ColumnarPolicy, executor=executor, stream_chunk_size=3)
+            self.assertEqual(metrics["eligible"]["accuracy"], 1.0)
+            self.assertAlmostEqual(metrics["doubled"]["accuracy"], 6 / 7)
+
+    def test_pool_shared_by_chunks(self):
+        CountedPolicy.instances = 0
+        self.run_tester(CountedPolicy, executor="threads", stream_chunk_size=2, chunk_size=1)
+        self.assertLessEqual(CountedPolicy.instances, 2)
+
+    def test_integer_labels(self):
+        self.assertEqual(PolicyTester.integer_labels([True, 2.0, 3]).tolist(), [1, 2, 3])
+        self.assertEqual(PolicyTester.integer_labels([True, "", None]).tolist(), [1, "", "None"])
+
+
+if __name__ == "__main__":
+    unittest.main()
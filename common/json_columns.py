@@ -0,0 +1,186 @@
+import json
+from datetime import date
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Ordinal of 1970-01-01, the epoch of numpy datetime64 days
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+PRESENT_FIELD = "__present__"
+FIELD_TYPES = {
+    "float": (float, np.nan),
+    "bool": (bool, False),
+    "str": (object, ""),
+    "date": (np.int64, 0),
+}
+# Booleans written as text, e.g. by datasets that went through a csv file
+BOOL_STRINGS = {"true": True, "false": False}
+
+
+@lru_cache(maxsize=None)
+def json_backend() -> str:
+    """The fastest installed JSON decoder: "msgspec", "orjson" or the standard "json"."""
+    for backend in ("msgspec", "orjson"):
+        try:
+            __import__(backend)
+            return backend
+        except ImportError:
+            continue
+    return "json"
+
+
+def _decode_array(text: str, backend: str):
+    if backend == "msgspec":
+        import msgspec
+        return msgspec.json.decode(text)
+    if backend == "orjson":
+        import orjson
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _bool_values(path: str, column: List) -> List[bool]:
+    """The values of a "bool" field: booleans, or their "true"/"false" text (any case); anything else is rejected."""
+    values = []
+    for value in column:
+        if type(value) is not bool:
+            value = BOOL_STRINGS.get(value.lower()) if isinstance(value, str) else None
+            if value is None:
+                raise ValueError(f"Expected a boolean for the field '{path}', got {column[len(values)]!r}")
+        values.append(value)
+    return values
+
+
+def _field_spec(spec) -> Tuple[str, object]:
+    """The (type, default) of a schema field, given as "type" or ("type", default)."""
+    field_type, default = (spec, None) if isinstance(spec, str) else spec
+    if field_type not in FIELD_TYPES:
+        raise ValueError(f"Unknown field type '{field_type}', expected one of: {', '.join(FIELD_TYPES)}")
+    return field_type, FIELD_TYPES[field_type][1] if default is None else default
+
+
+def decode_json_cells(values: Iterable, backend: str = None) -> List:
+    """
+    Decodes the JSON text cells of a column at once, joined into a single JSON array parsed in one call.
+
+    :param values: The cells of the column (JSON text, already decoded dictionaries or lists, empty or missing).
+    :param backend: The JSON decoder, json_backend() if not given.
+    :return: The decoded cells, already decoded ones as they are, None for the empty and missing ones.
+    """
+    cells = [cell if isinstance(cell, (str, dict, list)) else None for cell in values]
+    texts = [index for index, cell in enumerate(cells) if isinstance(cell, str)]
+    if texts:
+        objects = _decode_array(f"[{','.join(cells[index] or 'null' for index in texts)}]", backend or json_backend())
+        for index, item in zip(texts, objects):
+            cells[index] = item
+    return cells
+
+
+def decode_json_column(values: Iterable, schema: Dict, backend: str = None) -> Dict[str, np.ndarray]:
+    """
+    Decodes a column of JSON objects at once into one typed array per field of the schema.
+
+    The JSON text cells are parsed at once by decode_json_cells, with msgspec or orjson when installed and the standard
+    json module otherwise; already decoded dictionaries are kept. Empty cells are null objects.
+
+    :param values: The cells of the column (JSON text, dictionaries, empty or missing).
+    :param schema: The field types by path ("credit_score", "address.country"): "float" (NaN if missing), "bool"
+                   (booleans or "true"/"false", any other value raises a ValueError), "str", or "date" (ISO dates or pre-parsed date ordinals, as date ordinals, 0 if missing); or
+                   ("type", default) to set the value of missing and null fields.
+    :param backend: The JSON decoder, json_backend() if not given.
+    :return: The arrays by field path, and under PRESENT_FIELD whether each object is present (not null).
+    """
+    objects = decode_json_cells(values, backend)
+
+    arrays = {PRESENT_FIELD: np.array([isinstance(item, dict) for item in objects], dtype=bool)}
+    for path, spec in schema.items():
+        field_type, default = _field_spec(spec)
+        items = objects
+        for key in path.split("."):
+            items = [item.get(key) if type(item) is dict else None for item in items]
+        column = [default if item is None else item for item in items]
+
+        if field_type == "date":
+            # Dates are ISO strings, or date ordinals when the dataset stores them pre-parsed
+            is_ordinal = np.array([type(value) is int for value in column], dtype=bool)
+            days = np.array([None if not value or type(value) is int else value for value in column],
+                            dtype="datetime64[D]")
+            arrays[path] = np.where(np.isnat(days), default, days.astype(np.int64) + EPOCH_ORDINAL)
+            if is_ordinal.any():
+                arrays[path][is_ordinal] = [value for value in column if type(value) is int]
+        elif field_type == "bool":
+            arrays[path] = np.array(_bool_values(path, column), dtype=bool)
+        else:
+            arrays[path] = np.array(column, dtype=FIELD_TYPES[field_type][0])
+    return arrays
+
+
+class JsonColumnParser:
+    """
+    Columnar PolicyTester parse function: decodes a whole column of JSON objects with decode_json_column and adds
+    one typed column per field of the schema, named "<column>.<field path>" (and "<column>.__present__"),
+    which vectorized policies can read instead of decoding every cell. The original column is kept.
+    """
+    columnar = True
+
+    def __init__(self, schema: Dict, backend: str = None):
+        self.schema = schema
+        self.backend = backend
+
+    def __call__(self, column: pd.Series) -> pd.DataFrame:
+        arrays = decode_json_column(column, self.schema, self.backend)
+        return pd.DataFrame({f"{column.name}.{path}": array for path, array in arrays.items()}, index=column.index)
+
+
+import unittest
+
+
+class TestJsonColumns(unittest.TestCase):
+    SCHEMA = {"birth_date": "date", "address.country": "str", "credit_score": "float",
+              "employment_status": ("str", "unemployed"), "is_financial_record_present": "bool"}
+    COLUMN = [
+        json.dumps({"birth_date": "1990-05-17", "address": {"country": "US"}, "credit_score": 700,
+                    "employment_status": "full-time", "is_financial_record_present": True}),
+        "",
+        {"birth_date": date(2008, 1, 2).toordinal(), "address": {}, "credit_score": None},
+    ]
+
+    def test_decode_all_backends(self):
+        backends = ["json", json_backend()]
+        for backend in backends:
+            arrays = decode_json_column(self.COLUMN, self.SCHEMA, backend)
+            self.assertEqual(arrays[PRESENT_FIELD].tolist(), [True, False, True])
+            self.assertEqual(arrays["birth_date"].tolist(), [date(1990, 5, 17).toordinal(), 0, date(2008, 1, 2).toordinal()])
+            self.assertEqual(arrays["address.country"].tolist(), ["US", "", ""])
+            self.assertEqual(arrays["credit_score"][0], 700)
+            self.assertTrue(np.isnan(arrays["credit_score"][1:]).all())
+            self.assertEqual(arrays["employment_status"].tolist(), ["full-time", "unemployed", "unemployed"])
+            self.assertEqual(arrays["is_financial_record_present"].tolist(), [True, False, False])
+
+    def test_parser_columns(self):
+        frame = pd.DataFrame({"applicant": self.COLUMN}, index=[5, 6, 7])
+        decoded = JsonColumnParser({"credit_score": "float"})(frame["applicant"])
+        self.assertEqual(list(decoded.columns), ["applicant.__present__", "applicant.credit_score"])
+        self.assertEqual(decoded.index.tolist(), [5, 6, 7])
+
+    def test_decode_cells(self):
+        cells = decode_json_cells(['[{"a": 1}]', "", None, [{"a": 2}], float("nan")], "json")
+        self.assertEqual(cells, [[{"a": 1}], None, None, [{"a": 2}], None])
+
+    def test_bool_values(self):
+        arrays = decode_json_column(['{"flag": "false"}', '{"flag": "TRUE"}', '{"flag": true}', '{}'], {"flag": "bool"})
+        self.assertEqual(arrays["flag"].tolist(), [False, True, True, False])
+        with self.assertRaises(ValueError):
+            decode_json_column(['{"flag": "no"}'], {"flag": "bool"})
+        with self.assertRaises(ValueError):
+            decode_json_column(['{"flag": 1}'], {"flag": "bool"})
+
+    def test_unknown_type(self):
+        with self.assertRaises(ValueError):
+            decode_json_column([], {"credit_score": "decimal"})
+
+
+if __name__ == "__main__":
+    unittest.main()
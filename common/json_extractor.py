@@ -0,0 +1,221 @@
+import json
+import re
+from typing import List
+
+# Every fence marker, with the language tag that may follow it
+FENCE_PATTERN = re.compile(r"```([A-Za-z]*)")
+# Characters that matter for the balanced-brace scan, the text between them is skipped by the regex engine
+STRUCTURE_PATTERN = re.compile(r'[{}\[\]"\\]')
+JSON_LANGUAGES = {"json"}
+
+
+class JsonCandidate:
+    def __init__(self, text: str, start: int, end: int, fenced: bool = True, language: str = ""):
+        """
+        A piece of a response that may hold a JSON value.
+
+        :param text: The stripped content of the fenced block, or the balanced JSON text.
+        :param start: The offset in the response of the start of the block (of its opening fence if fenced).
+        :param end: The offset in the response just after the block (after its closing fence if fenced).
+        :param fenced: Whether the candidate is a fenced block, or was found by balanced-brace detection.
+        :param language: The language tag of the fenced block ("json", "" if none).
+        """
+        self.text = text
+        self.start = start
+        self.end = end
+        self.fenced = fenced
+        self.language = language
+
+    @property
+    def is_json(self) -> bool:
+        return self.language.lower() in JSON_LANGUAGES
+
+    def parses(self) -> bool:
+        try:
+            json.loads(self.text)
+            return True
+        except json.JSONDecodeError:
+            return False
+
+    def __eq__(self, other):
+        if not isinstance(other, JsonCandidate):
+            return False
+        return (self.text, self.start, self.end, self.fenced, self.language) == \
+            (other.text, other.start, other.end, other.fenced, other.language)
+
+    def __repr__(self):
+        return (f"JsonCandidate(start={self.start}, end={self.end}, fenced={self.fenced}, "
+                f"language={self.language!r}, text={self.text[:40]!r})")
+
+
+def _is_fence_opener(response: str, marker: re.Match) -> bool:
+    """
+    Whether a fence marker can open a block: it carries a language tag, starts a line, or ends its line.
+    A ``` quoted inside prose ("use ``` to fence") is none of them, and is skipped instead of shifting the pairing
+    of every later fence.
+    """
+    if marker.group(1):
+        return True
+    line_start = response.rfind("\n", 0, marker.start()) + 1
+    return not response[line_start:marker.start()].strip() or response[marker.end():marker.end() + 1] in ("\n", "\r")
+
+
+def find_fenced_blocks(response: str) -> List[JsonCandidate]:
+    """Every fenced block of the response, in order: each opening fence is paired with the next fence."""
+    blocks = []
+    markers = list(FENCE_PATTERN.finditer(response))
+    index = 0
+    while index < len(markers) - 1:
+        opener = markers[index]
+        if not _is_fence_opener(response, opener):
+            index += 1
+            continue
+        closer = markers[index + 1]
+        blocks.append(JsonCandidate(response[opener.end():closer.start()].strip(), opener.start(),
+                                    closer.start() + 3, True, opener.group(1)))
+        index += 2
+    return blocks
+
+
+def find_balanced_json(response: str) -> List[JsonCandidate]:
+    """
+    Every top-level balanced {...} or [...] span of the response, in order, with their offsets.
+    Only the brackets, quotes and backslashes are visited, once, and brackets inside JSON strings are ignored;
+    the spans are not validated as JSON. A bracket that is never closed (e.g. a stray bracket in the prose)
+    does not hide the balanced spans after it, and a mismatched closing bracket discards the open ones.
+    """
+    candidates = []
+    next_opening = {"{": -1, "[": -1}
+    # The expected closing bracket and the offset of every open bracket
+    stack = []
+    in_string = False
+    escaped_position = -1
+    position = 0
+
+    while True:
+        if not stack:
+            # Jump to the next opening bracket (str.find is much faster than the regex scan on plain prose)
+            for bracket in next_opening:
+                if next_opening[bracket] != -2 and next_opening[bracket] < position:
+                    found = response.find(bracket, position)
+                    next_opening[bracket] = found if found != -1 else -2
+            openings = [found for found in next_opening.values() if found != -2]
+            if not openings:
+                return candidates
+            position = min(openings)
+            in_string = False
+
+        match = STRUCTURE_PATTERN.search(response, position)
+        if match is None:
+            # Only unclosed brackets left, the spans balanced inside them are already candidates
+            return candidates
+        char, position = match.group(), match.end()
+        if in_string:
+            if char == "\\" and match.start() != escaped_position:
+                escaped_position = match.start() + 1
+            elif char == '"' and match.start() != escaped_position:
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append(("}" if char == "{" else "]", match.start()))
+        elif stack[-1][0] != char:
+            stack.clear()
+        else:
+            start = stack.pop()[1]
+            # The spans balanced inside this one are not top-level
+            while candidates and candidates[-1].start > start:
+                candidates.pop()
+            candidates.append(JsonCandidate(response[start:position], start, position, False))
+
+
+def find_json_candidates(response: str) -> List[JsonCandidate]:
+    """
+    Every candidate JSON text of the response with its offsets: the fenced blocks if there are any,
+    otherwise the balanced-brace spans of the unfenced response.
+    """
+    if not response:
+        return []
+    return find_fenced_blocks(response) or find_balanced_json(response)
+
+
+def extract_json(response: str) -> str | None:
+    """
+    The text of the JSON answer of a response: the first ```json fenced block that parses, otherwise the first
+    fenced block that parses, otherwise the first balanced-brace span that parses. If no candidate parses, the
+    first ```json block, fenced block or balanced span, for the caller to report. None if there is none, or if it
+    is empty.
+    """
+    if not response:
+        return None
+    fenced = find_fenced_blocks(response)
+    preferred = [block for block in fenced if block.is_json] + [block for block in fenced if not block.is_json]
+    candidate = next((block for block in preferred if block.parses()), None)
+    if candidate is None:
+        balanced = find_balanced_json(response)
+        candidate = next((span for span in balanced if span.parses()), None) or next(iter(preferred + balanced), None)
+    return candidate.text or None if candidate else None
+
+
+import unittest
+
+
+class TestJsonExtractor(unittest.TestCase):
+
+    def test_prefers_json_block(self):
+        response = "Reasoning:\n```\nnot json\n```\nAnswer:\n```json\n{\"eligible\": true}\n```"
+        self.assertEqual(extract_json(response), '{"eligible": true}')
+
+    def test_any_case_language_tag(self):
+        self.assertEqual(extract_json("```JSON\n[1, 2]\n```"), "[1, 2]")
+
+    def test_plain_fenced_block(self):
+        self.assertEqual(extract_json("```\n{\"a\": 1}\n```"), '{"a": 1}')
+
+    def test_candidates_offsets(self):
+        response = "a ```json\n{}\n``` b ```\n[]\n```"
+        candidates = find_json_candidates(response)
+        self.assertEqual([candidate.text for candidate in candidates], ["{}", "[]"])
+        self.assertEqual(response[candidates[0].start:candidates[0].end], "```json\n{}\n```")
+        self.assertEqual(response[candidates[1].start:candidates[1].end], "```\n[]\n```")
+
+    def test_unfenced_balanced_json(self):
+        response = 'The answer is {"eligible": false, "reason": "score {too} low \\" [x"} and [1, {"b": 2}].'
+        candidates = find_json_candidates(response)
+        self.assertEqual([candidate.text for candidate in candidates],
+                         ['{"eligible": false, "reason": "score {too} low \\" [x"}', '[1, {"b": 2}]'])
+        self.assertFalse(candidates[0].fenced)
+        self.assertEqual(response[candidates[1].start:candidates[1].end], '[1, {"b": 2}]')
+
+    def test_no_json(self):
+        self.assertIsNone(extract_json("I think it's eligible"))
+        self.assertIsNone(extract_json("```json\n```"))
+        self.assertIsNone(extract_json(""))
+        self.assertEqual(find_json_candidates("unbalanced { [ }"), [])
+
+    def test_stray_bracket_before_json(self):
+        self.assertEqual(extract_json('Check the {income and then answer {"eligible": true}'), '{"eligible": true}')
+
+    def test_stray_fence_in_prose(self):
+        self.assertEqual(extract_json("Use ``` to fence. ```json\n{}\n```"), "{}")
+        self.assertEqual(extract_json("Wrap it in ``` like ```this```.\n```\n[1]\n```"), "[1]")
+
+    def test_falls_back_to_a_parsing_candidate(self):
+        self.assertEqual(extract_json('```json\n{"eligible": tru\n```\n```\n{"eligible": true}\n```'),
+                         '{"eligible": true}')
+        self.assertEqual(extract_json('```\nnot json\n``` then {"eligible": false}'), '{"eligible": false}')
+        self.assertEqual(extract_json("```json\n{bad\n```"), "{bad")
+
+    def test_balanced_scan_is_linear(self):
+        import time
+
+        response = "{" * 200000 + ' and [ "x" ] {"eligible": true}'
+        start = time.perf_counter()
+        self.assertEqual([candidate.text for candidate in find_balanced_json(response)],
+                         ['[ "x" ]', '{"eligible": true}'])
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertEqual([candidate.text for candidate in find_balanced_json('{ ] {"a": [1]} [')], ['{"a": [1]}'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from common.json_extractor import extract_json, find_json_candidates
+
+
+def cascading_extract_json(response):
+    """The previous extractor: one DOTALL search per pattern, each rescanning the whole response."""
+    code_string = None
+    for pattern in [r'```json(.*?)```', r'```Json(.*?)```', r'```JSON(.*?)```', r'```(.*?)```']:
+        code_string = re.search(pattern, response, re.DOTALL)
+        if code_string is not None:
+            code_string = code_string.group(1).strip()
+            break
+    return None if not code_string else code_string
+
+
+def sample_responses(reasoning_size: int):
+    reasoning = "Let me check the policy rules one by one. The applicant is older than 18. " * (reasoning_size // 74)
+    answer = json.dumps({"eligible": True, "reason": "The applicant meets all the requirements."})
+    batch = json.dumps([{"case_id": case_id, "eligible": case_id % 2 == 0} for case_id in range(100)], indent=3)
+    return {
+        "short answer": f"```json\n{answer}\n```",
+        "long reasoning, JSON answer": f"<think>\n{reasoning}\n</think>\n```json\n{answer}\n```",
+        "long reasoning, uppercase tag": f"<think>\n{reasoning}\n</think>\n```JSON\n{answer}\n```",
+        "long reasoning, no answer": f"<think>\n{reasoning}\n</think>\nThe applicant is eligible.",
+        "batch of 100 answers": f"```json\n{batch}\n```",
+    }
+
+
+def run_benchmark(reasoning_size: int, number: int):
+    print(f"{'response':<32}{'size':>10}{'cascading (us)':>16}{'single-pass (us)':>18}")
+    for name, response in sample_responses(reasoning_size).items():
+        assert name == "long reasoning, no answer" or extract_json(response) == cascading_extract_json(response)
+        cascading = timeit.timeit(lambda: cascading_extract_json(response), number=number) / number
+        single_pass = timeit.timeit(lambda: extract_json(response), number=number) / number
+        print(f"{name:<32}{len(response):>10}{cascading * 1e6:>16.1f}{single_pass * 1e6:>18.1f}")
+
+    # The unfenced fallback scans only the structural characters of the response
+    response = sample_responses(reasoning_size)["long reasoning, no answer"] + ' {"eligible": true}'
+    fallback = timeit.timeit(lambda: find_json_candidates(response), number=number) / number
+    print(f"{'unfenced fallback':<32}{len(response):>10}{'-':>16}{fallback * 1e6:>18.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the JSON extraction of the LLM responses")
+    parser.add_argument("--reasoning_size", type=int, required=False, default=2 ** 20,
+                        help="The size in characters of the reasoning trace of the long responses (default: 1 MB).")
+    parser.add_argument("--number", type=int, required=False, default=20,
+                        help="The number of extractions timed per response.")
+    args = parser.parse_args()
+
+    run_benchmark(args.reasoning_size, args.number)
@@ -0,0 +1,626 @@
+import asyncio
+import json
+import os
+import time
+import urllib.request
+from abc import ABC, abstractmethod
+from functools import partial
+from typing import Dict, List, Tuple
+
+from common.json_extractor import extract_json, find_fenced_blocks
+from common.response_cache import ResponseCache
+from common.retry_policy import RetryPolicy
+from common.watson_utils import DEFAULT_PARAMETERS, DEFAULT_URL
+
+# Ollama keeps the model (and its cached prompt prefix) loaded that long after the last request
+DEFAULT_KEEP_ALIVE = "30m"
+NUM_CTX_STEP = 1024
+DEFAULT_OPENAI_BASE_URL = "http://localhost:8000/v1"
+# Socket timeout in seconds of the blocking HTTP requests of runs without a request timeout
+DEFAULT_HTTP_TIMEOUT = 600
+
+BACKENDS = {}
+
+
+def complete_json_answer(response, validate_answer=None):
+    """
+    The answer of the first complete ```json fenced block of a (partial) response that parses and is accepted by
+    `validate_answer` (e.g. an answer of the expected shape); None while there is no such block yet.
+    """
+    for candidate in find_fenced_blocks(response):
+        if candidate.is_json and candidate.parses():
+            answer = json.loads(candidate.text)
+            if not validate_answer or validate_answer(answer):
+                return answer
+    return None
+
+
+class LLMAnswer:
+    def __init__(self,
+                 generated_response: str = None,
+                 generated_answer=None,
+                 number_tokens: int = 0,
+                 execution_time: float = 0,
+                 retry_time: float = 0.0,
+                 transport_failures: int = 0,
+                 parse_failures: int = 0,
+                 failure: Dict = None,
+                 cached: bool = False,
+                 prompt_tokens: int = 0,
+                 time_to_first_token: float = None,
+                 latency: float = 0.0,
+                 queue_time: float = 0.0):
+        """
+        The outcome of the LLM call of one test case.
+
+        :param generated_response: The full text of the last LLM response.
+        :param generated_answer: The JSON answer parsed from the response, None if the case failed.
+        :param number_tokens: The number of completion tokens of the accepted response.
+        :param execution_time: The time in seconds spent on the case, retries included.
+        :param retry_time: The part of the execution time spent on failed attempts and backoff delays.
+        :param transport_failures: The number of failed requests.
+        :param parse_failures: The number of responses without a parsable JSON answer.
+        :param failure: The failure record of the case ("reason", "error", attempts), None if it succeeded.
+        :param cached: Whether the response was read from the response cache instead of calling the LLM.
+        :param prompt_tokens: The number of prompt tokens of the accepted request.
+        :param time_to_first_token: The time in seconds until the first token of the accepted response, if known.
+        :param latency: The time in seconds of the accepted request.
+        :param queue_time: The time in seconds the request waited for a free request slot.
+        """
+        self.generated_response = generated_response
+        self.generated_answer = generated_answer
+        self.number_tokens = number_tokens
+        self.execution_time = execution_time
+        self.retry_time = retry_time
+        self.transport_failures = transport_failures
+        self.parse_failures = parse_failures
+        self.failure = failure
+        self.cached = cached
+        self.prompt_tokens = prompt_tokens
+        self.time_to_first_token = time_to_first_token
+        self.latency = latency
+        self.queue_time = queue_time
+
+
+async def dispatch_requests(user_prompts, ask, concurrency=1, on_result=None) -> List:
+    """
+    Calls the coroutine function `ask` for every user prompt, with at most `concurrency` requests in flight.
+    The results are collected in the order of the user prompts. If given, `on_result(index, result)` is called
+    as soon as the result of the user prompt at `index` is available.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def ask_when_allowed(index, user_prompt):
+        queued_time = time.time()
+        async with semaphore:
+            queue_time = time.time() - queued_time
+            result = await ask(user_prompt)
+        result.queue_time = queue_time
+        if on_result:
+            on_result(index, result)
+        return result
+
+    return await asyncio.gather(*(ask_when_allowed(index, user_prompt) for index, user_prompt in enumerate(user_prompts)))
+
+
+async def ask_with_retries(send, retry_policy: RetryPolicy, timeout=None,
+                           cache: ResponseCache = None, cache_key: str = None, validate_answer=None) -> LLMAnswer:
+    """
+    Calls the coroutine function `send` (returning the response text, its number of completion tokens and a usage
+    dictionary with the "prompt_tokens" and the "time_to_first_token" when known) until the response contains a parsable JSON answer or one of the retry budgets is exhausted.
+    If given, `validate_answer(generated_answer)` must also accept the parsed answer (e.g. a JSON array for batches).
+    Accepted responses are stored in the `cache` (if any) under `cache_key`, and later read from it instead of calling the LLM.
+    """
+    if cache is not None:
+        cached = cache.get(cache_key)
+        # Answers cached by runs expecting another answer shape are asked again
+        if cached and (not validate_answer or validate_answer(cached["generated_answer"])):
+            return LLMAnswer(cached["generated_response"], cached["generated_answer"], cached["number_tokens"], cached=True)
+
+    start_time_round = time.time()
+    retry_time = 0.0
+    transport_failures = 0
+    parse_failures = 0
+    generated_response = None
+
+    while True:
+        attempt_start_time = time.time()
+        try:
+            generated_response, number_tokens, usage = await asyncio.wait_for(send(), timeout)
+        except Exception as e:
+            transport_failures += 1
+            error = f"timed out after {timeout} seconds" if isinstance(e, asyncio.TimeoutError) else str(e)
+            print(f"Attempt {transport_failures + parse_failures} failed with error: {error}")
+            if transport_failures >= retry_policy.max_transport_attempts:
+                failure = {"reason": "transport", "error": error}
+                break
+            await asyncio.sleep(retry_policy.backoff(transport_failures))
+            retry_time += time.time() - attempt_start_time
+            continue
+
+        # The first accepted ```json block, otherwise the JSON that extract_json finds, if accepted
+        generated_answer = complete_json_answer(generated_response, validate_answer)
+        if generated_answer is None:
+            generated_code = extract_json(generated_response)
+            try:
+                generated_answer = json.loads(generated_code) if generated_code else None
+            except json.JSONDecodeError:
+                generated_answer = None
+            if generated_answer is not None and validate_answer and not validate_answer(generated_answer):
+                generated_answer = None
+
+        if generated_answer is not None:
+            end_time = time.time()
+            if cache is not None:
+                cache.put(cache_key, {"generated_response": generated_response, "generated_answer": generated_answer,
+                                      "number_tokens": number_tokens})
+            return LLMAnswer(generated_response, generated_answer, number_tokens, round(end_time - start_time_round),
+                             retry_time, transport_failures, parse_failures,
+                             prompt_tokens=usage.get("prompt_tokens", 0),
+                             time_to_first_token=usage.get("time_to_first_token"),
+                             latency=end_time - attempt_start_time)
+
+        parse_failures += 1
+        print(f"Attempt {transport_failures + parse_failures} returned no parsable JSON answer")
+        if parse_failures >= retry_policy.max_parse_attempts:
+            failure = {"reason": "parse", "error": "No parsable JSON answer in the response"}
+            break
+        await asyncio.sleep(retry_policy.backoff(parse_failures))
+        retry_time += time.time() - attempt_start_time
+
+    end_time = time.time()
+    retry_time += end_time - attempt_start_time
+    failure.update({"transport_failures": transport_failures, "parse_failures": parse_failures})
+    return LLMAnswer(generated_response, None, 0, round(end_time - start_time_round),
+                     retry_time, transport_failures, parse_failures, failure)
+
+
+def context_size(model_config: Dict, system_prompt, user_prompts) -> int:
+    """
+    Context window large enough for the system prompt, the longest user prompt and `additional_num_ctx` more,
+    rounded up to a multiple of NUM_CTX_STEP: the same context size is kept for all the requests of a run (and of
+    similar runs), so that Ollama does not reload the model and can reuse the cached system prompt prefix.
+    """
+    num_ctx = model_config["options"].get("additional_num_ctx", 0) + len(system_prompt) + len(max(user_prompts, key=len))
+    return -(-num_ctx // NUM_CTX_STEP) * NUM_CTX_STEP
+
+
+
+
+def register_backend(name: str):
+    """Class decorator registering an LLMBackend subclass under the given API name."""
+
+    def register(backend_class):
+        backend_class.name = name
+        BACKENDS[name] = backend_class
+        return backend_class
+
+    return register
+
+
+def create_backend(name: str, model_config: Dict, stream: bool = False) -> "LLMBackend":
+    if name not in BACKENDS:
+        raise ValueError(f"Unsupported LLM API '{name}', available APIs: {', '.join(BACKENDS)}")
+    return BACKENDS[name](model_config, stream)
+
+
+class LLMBackend(ABC):
+    """
+    Abstract base class of the LLM APIs.
+
+    A backend only implements `agenerate`, the request of one (system prompt, user prompt) pair, and optionally
+    `open`/`aclose` to manage the clients of a run. The retries, the response cache and the concurrent dispatch
+    of `batch_generate` are shared by all the backends, and every request is counted in the token usage.
+    New backends are made available to `call_llm` and to the `--api` option with the `register_backend` decorator.
+    """
+
+    name = None
+
+    def __init__(self, model_config: Dict, stream: bool = False):
+        """
+        :param model_config: The model & API configuration (see the config folder).
+        :param stream: Whether to stream the responses and stop them once their JSON answer is complete,
+                       for the backends supporting it.
+        """
+        self.model_config = model_config
+        self.stream = stream
+        self.retry_policy = RetryPolicy.from_config(model_config.get("retry"))
+        # The timeout in seconds of a single request of the current run, if any
+        self.timeout = None
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def model_name(self) -> str:
+        return self.model_config.get("model_name") or self.model_config.get("model_id")
+
+    def cache_key(self, system_prompt, user_prompt) -> str:
+        return ResponseCache.key(self.name, self.model_name, self.model_config.get("options"), system_prompt, user_prompt)
+
+    def size_context(self, system_prompt, user_prompts):
+        """
+        Sizes the requests of a run once for all the user prompts it will send (e.g. its batched and its individual
+        prompts), so that all its passes are sent with the same settings. Without it, every `open` sizes them for
+        its own user prompts.
+        """
+        pass
+
+    async def open(self, system_prompt, user_prompts):
+        """Prepares the clients of a run, inside its event loop."""
+        pass
+
+    async def aclose(self):
+        pass
+
+    @abstractmethod
+    async def agenerate(self, system_prompt, user_prompt, is_complete=None) -> Tuple[str, int, Dict]:
+        """
+        Sends one request.
+
+        Args:
+            system_prompt (str): The system prompt.
+            user_prompt (str): The user prompt.
+            is_complete (callable): Optional predicate on the partial response text, with which streaming backends
+                can stop the generation early.
+
+        Returns: Tuple: The response text, its number of completion tokens, and a usage dictionary holding the
+        "prompt_tokens" and the "time_to_first_token" when known.
+        """
+        pass
+
+    def generate(self, system_prompt, user_prompt) -> Tuple[str, int, Dict]:
+        """Synchronous `agenerate`, without retries nor cache."""
+
+        async def generate_once():
+            await self.open(system_prompt, [user_prompt])
+            try:
+                response = await self.agenerate(system_prompt, user_prompt)
+                self.count_tokens(response[1], response[2])
+                return response
+            finally:
+                await self.aclose()
+
+        return asyncio.run(generate_once())
+
+    def count_tokens(self, number_tokens: int, usage: Dict):
+        self.requests += 1
+        self.completion_tokens += number_tokens
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+
+    def token_usage(self) -> Dict[str, int]:
+        """The requests and tokens spent by this backend so far, failed attempts included."""
+        return {"requests": self.requests, "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens}
+
+    async def abatch_generate(self, system_prompt, user_prompts, concurrency=1, timeout=None,
+                              cache: ResponseCache = None, on_answer=None, validate_answer=None) -> List[LLMAnswer]:
+        """
+        Asks every user prompt with at most `concurrency` requests in flight, with retries, until a parsable JSON
+        answer (accepted by `validate_answer(user_prompt, generated_answer)` if given) is returned.
+        The answers are in the order of the user prompts; `on_answer(index, answer)` is called as soon as each one is available.
+        """
+        self.timeout = timeout
+        await self.open(system_prompt, user_prompts)
+        try:
+            async def ask(user_prompt):
+                case_validate_answer = partial(validate_answer, user_prompt) if validate_answer else None
+
+                async def send():
+                    response = await self.agenerate(
+                        system_prompt, user_prompt,
+                        lambda partial_response: complete_json_answer(partial_response, case_validate_answer) is not None)
+                    self.count_tokens(response[1], response[2])
+                    return response
+
+                return await ask_with_retries(send, self.retry_policy, timeout, cache,
+                                              self.cache_key(system_prompt, user_prompt), case_validate_answer)
+
+            return await dispatch_requests(user_prompts, ask, concurrency, on_answer)
+        finally:
+            await self.aclose()
+
+    def batch_generate(self, system_prompt, user_prompts, concurrency=1, timeout=None,
+                       cache: ResponseCache = None, on_answer=None, validate_answer=None) -> List[LLMAnswer]:
+        return asyncio.run(self.abatch_generate(system_prompt, user_prompts, concurrency, timeout, cache,
+                                                on_answer, validate_answer))
+
+    def __repr__(self):
+        return f"{type(self).__name__}(model={self.model_name}, stream={self.stream})"
+
+
+@register_backend("ollama")
+class OllamaBackend(LLMBackend):
+    """
+    Local Ollama server. With `stream`, the response is read token by token and the generation is stopped as soon
+    as a complete ```json fenced answer has been emitted.
+    """
+
+    num_ctx = None
+
+    def size_context(self, system_prompt, user_prompts):
+        self.num_ctx = context_size(self.model_config, system_prompt, user_prompts)
+
+    async def open(self, system_prompt, user_prompts):
+        try:
+            import ollama
+        except ImportError as e:
+            raise e
+
+        self.client = ollama.AsyncClient()
+        self.options = {key: value for key, value in self.model_config["options"].items() if key != "additional_num_ctx"}
+        self.options["num_ctx"] = self.num_ctx or context_size(self.model_config, system_prompt, user_prompts)
+        self.keep_alive = self.model_config.get("keep_alive", DEFAULT_KEEP_ALIVE)
+
+    async def agenerate(self, system_prompt, user_prompt, is_complete=None) -> Tuple[str, int, Dict]:
+        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+        if self.stream:
+            return await self._generate_streaming(messages, is_complete)
+
+        response_cur = await self.client.chat(
+            model=self.model_name, messages=messages, stream=False,
+            options=self.options, keep_alive=self.keep_alive
+        )
+        if not response_cur["done"]:
+            raise Exception("Non-200 response: " + str(response_cur))
+        # Durations are reported in nanoseconds; the prompt_eval_* fields are missing when the prompt was cached
+        usage = {
+            "prompt_tokens": response_cur.get("prompt_eval_count", 0),
+            "time_to_first_token": (response_cur.get("load_duration", 0)
+                                    + response_cur.get("prompt_eval_duration", 0)) / 1e9 or None
+        }
+        return response_cur["message"]["content"], response_cur["eval_count"], usage
+
+    async def _generate_streaming(self, messages, is_complete=None) -> Tuple[str, int, Dict]:
+        start_time = time.time()
+        time_to_first_token = None
+        chunks = []
+        number_tokens = 0
+        prompt_tokens = 0
+        response_stream = await self.client.chat(
+            model=self.model_name, messages=messages, stream=True,
+            options=self.options, keep_alive=self.keep_alive
+        )
+        try:
+            async for part in response_stream:
+                content = part["message"]["content"]
+                if content and time_to_first_token is None:
+                    time_to_first_token = time.time() - start_time
+                chunks.append(content)
+                if part["done"]:
+                    number_tokens = part.get("eval_count", number_tokens + 1)
+                    prompt_tokens = part.get("prompt_eval_count", 0)
+                    break
+                number_tokens += 1
+                # A fenced block can only be completed by a chunk holding a backtick
+                if is_complete and "`" in content and is_complete("".join(chunks)):
+                    break
+        finally:
+            # Closing the stream early aborts the request, which stops the generation
+            await response_stream.aclose()
+        return "".join(chunks), number_tokens, {"prompt_tokens": prompt_tokens, "time_to_first_token": time_to_first_token}
+
+
+@register_backend("watsonx")
+class WatsonxBackend(LLMBackend):
+    """
+    IBM watsonx.ai, through langchain's ChatWatsonx. A single client is created per backend and reused by all its
+    requests, so that they share its keep-alive connections and IAM token.
+    """
+
+    def __init__(self, model_config: Dict, stream: bool = False):
+        super().__init__(model_config, stream)
+        self.chat = None
+
+    @property
+    def params(self) -> Dict:
+        return self.model_config["options"] if self.model_config["options"] else DEFAULT_PARAMETERS
+
+    def cache_key(self, system_prompt, user_prompt) -> str:
+        return ResponseCache.key(self.name, self.model_name, self.params, system_prompt, user_prompt)
+
+    async def open(self, system_prompt, user_prompts):
+        if self.chat is not None:
+            return
+
+        try:
+            from langchain_ibm import ChatWatsonx
+        except ImportError as e:
+            raise e
+
+        if not os.getenv("WATSONX_APIKEY"):
+            os.environ["WATSONX_APIKEY"] = os.getenv("IBM_API_KEY")
+
+        self.chat = ChatWatsonx(
+            model_id=self.model_config["model_id"],
+            url=self.model_config["url"] if self.model_config["url"] else DEFAULT_URL,
+            project_id=self.model_config["project_id"],
+            params=self.params,
+        )
+
+    async def agenerate(self, system_prompt, user_prompt, is_complete=None) -> Tuple[str, int, Dict]:
+        from langchain_core.messages import SystemMessage, HumanMessage
+
+        response_cur = await self.chat.ainvoke([SystemMessage(content=system_prompt), HumanMessage(content=user_prompt)])
+        token_usage = response_cur.response_metadata['token_usage']
+        return response_cur.content, token_usage['completion_tokens'], {"prompt_tokens": token_usage.get('prompt_tokens', 0)}
+
+
+@register_backend("openai")
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Any server implementing the OpenAI chat completions API (vLLM, llama.cpp, LM Studio, the local stub server...).
+    The configuration holds the `base_url` of the API, and the optional name of the environment variable holding
+    the API key in `api_key_env`. The "options" are sent as request parameters (e.g. "temperature", "max_tokens").
+    """
+
+    async def open(self, system_prompt, user_prompts):
+        self.url = self.model_config.get("base_url", DEFAULT_OPENAI_BASE_URL).rstrip("/") + "/chat/completions"
+        self.headers = {"Content-Type": "application/json"}
+        api_key = os.getenv(self.model_config.get("api_key_env", "OPENAI_API_KEY"))
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.options = {key: value for key, value in (self.model_config.get("options") or {}).items()
+                        if key != "additional_num_ctx"}
+
+    def _post(self, payload: Dict) -> Dict:
+        request = urllib.request.Request(self.url, json.dumps(payload).encode("utf-8"), self.headers, method="POST")
+        # The request thread cannot be cancelled by the timeout of its coroutine: the socket times out instead
+        with urllib.request.urlopen(request, timeout=self.timeout or DEFAULT_HTTP_TIMEOUT) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    async def agenerate(self, system_prompt, user_prompt, is_complete=None) -> Tuple[str, int, Dict]:
+        payload = {
+            "model": self.model_name,
+            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
+            **self.options
+        }
+        # urllib is blocking, the request is sent from a worker thread to keep the other requests in flight
+        response = await asyncio.to_thread(self._post, payload)
+        usage = response.get("usage") or {}
+        return (response["choices"][0]["message"]["content"], usage.get("completion_tokens", 0),
+                {"prompt_tokens": usage.get("prompt_tokens", 0)})
+
+
+@register_backend("stub")
+class StubBackend(LLMBackend):
+    """
+    In-process, deterministic stand-in for an LLM, replaying the answers of a reference csv dataset with simulated
+    latencies and errors (see llm_stub_server.py), to load-test the benchmark without any model or network.
+    """
+
+    def __init__(self, model_config: Dict, stream: bool = False):
+        super().__init__(model_config, stream)
+        self.replayer = None
+
+    def cache_key(self, system_prompt, user_prompt) -> str:
+        return ResponseCache.key(self.name, self.model_name, self.model_config.get("csv_file"),
+                                 self.model_config.get("column_mapping"), system_prompt, user_prompt)
+
+    async def open(self, system_prompt, user_prompts):
+        from common.llm_stub_server import ReferenceAnswerReplayer
+
+        if self.replayer is None:
+            self.replayer = ReferenceAnswerReplayer.from_config(self.model_config)
+
+    async def agenerate(self, system_prompt, user_prompt, is_complete=None) -> Tuple[str, int, Dict]:
+        response, delay = self.replayer.replay(user_prompt)
+        await asyncio.sleep(delay)
+        if response is None:
+            raise ConnectionError("Simulated stub server error")
+        return response, self.replayer.count_tokens(response), {"prompt_tokens": self.replayer.count_tokens(user_prompt)}
+
+
+import tempfile
+import unittest
+
+
+class TestDispatchRequests(unittest.TestCase):
+    def test_order_and_concurrency(self):
+        in_flight = []
+        peak = []
+        completed = []
+
+        async def ask(user_prompt):
+            in_flight.append(user_prompt)
+            peak.append(len(in_flight))
+            # The first prompts take the longest, so that the results complete out of order
+            await asyncio.sleep(0.01 * (5 - user_prompt))
+            in_flight.remove(user_prompt)
+            return LLMAnswer(str(user_prompt))
+
+        answers = asyncio.run(dispatch_requests(range(5), ask, concurrency=2,
+                                                on_result=lambda index, answer: completed.append(index)))
+        self.assertEqual([answer.generated_response for answer in answers], ["0", "1", "2", "3", "4"])
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(sorted(completed), [0, 1, 2, 3, 4])
+        self.assertNotEqual(completed, [0, 1, 2, 3, 4])
+
+
+
+class TestCompleteJsonAnswer(unittest.TestCase):
+    def test_first_accepted_block(self):
+        response = "```json\n{\"reason\": \"draft\"}\n```\n```json\n{\"eligible\": true}\n```"
+        self.assertEqual(complete_json_answer(response), {"reason": "draft"})
+        self.assertEqual(complete_json_answer(response, lambda answer: "eligible" in answer), {"eligible": True})
+        self.assertIsNone(complete_json_answer(response[:40], lambda answer: "eligible" in answer))
+
+
+class TestAskWithRetries(unittest.TestCase):
+    POLICY = RetryPolicy(max_transport_attempts=3, max_parse_attempts=2, base_delay=0, jitter=0)
+
+    @staticmethod
+    def sender(responses):
+        """A `send` coroutine function returning (or raising) the given responses in turn."""
+        responses = iter(responses)
+
+        async def send():
+            response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return response, 3, {"prompt_tokens": 10}
+
+        return send
+
+    def test_transport_then_success(self):
+        send = self.sender([ConnectionError("reset"), "```json\n{\"eligible\": true}\n```"])
+        answer = asyncio.run(ask_with_retries(send, self.POLICY))
+        self.assertEqual(answer.generated_answer, {"eligible": True})
+        self.assertEqual((answer.transport_failures, answer.parse_failures, answer.prompt_tokens), (1, 0, 10))
+        self.assertIsNone(answer.failure)
+
+    def test_transport_budget(self):
+        answer = asyncio.run(ask_with_retries(self.sender([ConnectionError("reset")] * 3), self.POLICY))
+        self.assertEqual(answer.failure["reason"], "transport")
+        self.assertEqual(answer.failure["transport_failures"], 3)
+
+    def test_parse_budget_and_validation(self):
+        send = self.sender(["no answer", "```json\n{\"eligible\": true}\n```"])
+        answer = asyncio.run(ask_with_retries(send, self.POLICY, validate_answer=lambda answer: isinstance(answer, list)))
+        self.assertEqual(answer.failure["reason"], "parse")
+        self.assertEqual(answer.parse_failures, 2)
+
+    def test_parse_failure_backoff(self):
+        send = self.sender(["no answer", "```json\n{\"eligible\": true}\n```"])
+        policy = RetryPolicy(base_delay=0.05, jitter=0)
+        answer = asyncio.run(ask_with_retries(send, policy))
+        self.assertEqual(answer.parse_failures, 1)
+        self.assertGreaterEqual(answer.retry_time, 0.05)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResponseCache(directory)
+            send = self.sender(["```json\n{\"eligible\": false}\n```"])
+            answer = asyncio.run(ask_with_retries(send, self.POLICY, cache=cache, cache_key="key"))
+            cached = asyncio.run(ask_with_retries(self.sender([]), self.POLICY, cache=cache, cache_key="key"))
+        self.assertFalse(answer.cached)
+        self.assertTrue(cached.cached)
+        self.assertEqual(cached.generated_answer, {"eligible": False})
+
+
+class TestOpenAICompatibleBackend(unittest.TestCase):
+    CSV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "../loan/loan_compliance/loan_policy_test_dataset_100.csv")
+
+    def serve(self, latency):
+        import threading
+        from common.llm_stub_server import ReferenceAnswerReplayer, create_server
+
+        server = create_server(ReferenceAnswerReplayer(self.CSV_FILE, {"eligibility": "eligible"}, latency), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return create_backend("openai", {"model_name": "stub", "base_url": f"http://127.0.0.1:{server.server_port}/v1",
+                                         "retry": {"max_transport_attempts": 1, "base_delay": 0}})
+
+    def test_batch_through_stub_server(self):
+        backend = self.serve("constant:0")
+        answers = backend.batch_generate("system prompt", ["```json\n{\"unknown\": 1}\n```"] * 2, concurrency=2)
+        self.assertEqual([answer.failure["reason"] for answer in answers], ["parse", "parse"])
+        self.assertEqual(backend.token_usage()["requests"], 2 * backend.retry_policy.max_parse_attempts)
+
+    def test_request_timeout(self):
+        backend = self.serve("constant:1")
+        asyncio.run(backend.open("system prompt", []))
+        backend.timeout = 0.1
+        with self.assertRaises(TimeoutError):
+            backend._post({"messages": [{"role": "user", "content": "prompt"}]})
@@ -1,30 +1,40 @@
 import argparse
+import asyncio
+import hashlib
 import importlib
 import inspect
 import os
 import re
 import sys
-import time
 from enum import Enum
 from pathlib import Path
-from typing import Tuple, Dict, List
+from typing import Dict, List
 import json
 import pandas as pd
 
-from common.benchmarking_results import benchmark_results, parse_column_mapping
+from common.benchmarking_results import benchmark_results, compare_results, iter_results, parse_column_mapping, \
+    print_comparison_table
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
 
 from common.generic_data_generator import DataGenerator
-from common.watson_utils import DEFAULT_PARAMETERS, DEFAULT_URL
+from common.json_extractor import extract_json
+from common.llm_backends import BACKENDS, LLMAnswer, LLMBackend, create_backend
+from common.llm_telemetry import LLMTelemetry, telemetry_path
+from common.response_cache import ResponseCache
 
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 LLM_PROMPTS_PATH = os.path.join(ROOT_DIR, "../benchmark_your_policy_automation_docs")
 SYSTEM_PROMPT_FILE = os.path.join(LLM_PROMPTS_PATH, "system_prompt_template.md")
 USER_PROMPT = os.path.join(LLM_PROMPTS_PATH, "user_prompt_template.md")
+BATCH_USER_PROMPT = os.path.join(LLM_PROMPTS_PATH, "batch_user_prompt_template.md")
+BATCH_TEST_CASE = "Test case {case_id}:\n```json\n{test_case}\n```"
+BATCH_CASE_ID_FIELD = "case_id"
+CASE_ID_LENGTH = 16
 
 CONFIG_DIR = os.path.join(ROOT_DIR, "config")
+CACHE_DIR = os.path.join(ROOT_DIR, ".llm_cache")
 
 
 class LLM_API(Enum):
@@ -32,6 +42,9 @@ class LLM_API(Enum):
     WATSONXAI = 2
 
 
+LLM_API_BACKENDS = {LLM_API.OLLAMA: "ollama", LLM_API.WATSONXAI: "watsonx"}
+
+
 def load_config(filename):
     with open(filename, "r") as file:
         return json.load(file)
@@ -43,133 +56,308 @@ def file_to_string(filename):
 
 
 def extract_json_from_response(response):
-    patterns = [r'```json(.*?)```', r'```Json(.*?)```', r'```JSON(.*?)```', r'```(.*?)```'] # r'"""(.*?)"""', r'""(.*?)""', r'"(.*?)"'
-    for pattern in patterns:
-        code_string = re.search(pattern, response, re.DOTALL)
-        if code_string is not None:
-            code_string = code_string.group(1).strip()
-            break
-    return None if not code_string else code_string
+    return extract_json(response)
 
 
-def call_ollama(model_config: Dict, system_prompt, user_prompts) -> Tuple[List[str | None], List[str | None], List[int], List[float]]:
-    try:
-        import ollama
-    except ImportError as e:
-        raise e
-
-    messages = [{"role": "system", "content": system_prompt}]
-    generated_codes = []
-    generated_responses = []
-    completion_tokens = []
-    exec_times = []
-
-    options = model_config["options"]
-    options["additional_num_ctx"] += len(system_prompt) + len(max(user_prompts, key=len))
-    for user_prompt in user_prompts:
-        if len(messages) == 1:
-            messages.append({"role": "user", "content": user_prompt})
-        else:
-            messages[1] = {"role": "user", "content": user_prompt}
-        start_time_round = time.time()
-        for attempt in range(1000):
-            try:
-                response_cur = ollama.chat(
-                    model=model_config["model_name"], messages=messages, stream=False,
-                    options=options
-                )
-                end_time = time.time()
-                if not response_cur["done"]:
-                    raise Exception("Non-200 response: " + str(response_cur))
-                generated_response = response_cur["message"]["content"]
-                generated_code = extract_json_from_response(generated_response)
-
-                if generated_code:
-                    exec_times.append(round(end_time - start_time_round))
-                    completion_tokens.append(response_cur["eval_count"])
-                    generated_codes.append(generated_code)
-                    generated_responses.append(generated_response)
-                    break
-            except Exception as e:
-                print(f"Attempt {attempt + 1} failed with error: {e}")
-                time.sleep(1)
-
-    return generated_responses, generated_codes, completion_tokens, exec_times
-
-
-def call_watsonxai(model_config: Dict, system_prompt, user_prompts: []) -> Tuple[List[str | None], List[str | None], List[int], List[float]]:
-    try:
-        from langchain_core.messages import SystemMessage, HumanMessage
-        from langchain_ibm import ChatWatsonx
-    except ImportError as e:
-        raise e
-
-    if not os.getenv("WATSONX_APIKEY"):
-        os.environ["WATSONX_APIKEY"] = os.getenv("IBM_API_KEY")
-
-    messages = [SystemMessage(content=system_prompt)]
-
-    chat = ChatWatsonx(
-        model_id=model_config["model_id"],
-        url=model_config["url"] if model_config["url"] else DEFAULT_URL,
-        project_id=model_config["project_id"],
-        params=model_config["options"] if model_config["options"] else DEFAULT_PARAMETERS,
-    )
-
-    generated_codes = []
-    generated_responses = []
-    number_tokens = []
-    exec_times = []
-
-    for user_prompt in user_prompts:
-        if len(messages) == 1:
-            messages.append(user_prompt)
-        else:
-            messages[1] = user_prompt
+def call_ollama(model_config: Dict, system_prompt, user_prompts, concurrency=1, timeout=None,
+                cache: ResponseCache = None, on_answer=None, validate_answer=None, stream=False) -> List[LLMAnswer]:
+    return create_backend("ollama", model_config, stream).batch_generate(
+        system_prompt, user_prompts, concurrency, timeout, cache, on_answer, validate_answer)
+
+
+def call_watsonxai(model_config: Dict, system_prompt, user_prompts: [], concurrency=1, timeout=None,
+                   cache: ResponseCache = None, on_answer=None, validate_answer=None) -> List[LLMAnswer]:
+    return create_backend("watsonx", model_config).batch_generate(
+        system_prompt, user_prompts, concurrency, timeout, cache, on_answer, validate_answer)
+
+
+def backend_name(llm_api: LLM_API | str) -> str:
+    """The name of the registered backend of an API, given as an LLM_API member or by name."""
+    return LLM_API_BACKENDS.get(llm_api, llm_api)
+
 
-        start_time_round = time.time()
+def call_api(llm_api, model_config, system_prompt, user_prompts, concurrency=1, timeout=None,
+             cache: ResponseCache = None, on_answer=None, validate_answer=None, stream=False) -> List[LLMAnswer]:
+    if backend_name(llm_api) in BACKENDS:
+        return create_backend(backend_name(llm_api), model_config, stream).batch_generate(
+            system_prompt, user_prompts, concurrency, timeout, cache, on_answer, validate_answer)
 
-        for attempt in range(1000):
-            try:
-                response_cur = chat.invoke(messages)
-                end_time = time.time()
-                generated_response = response_cur.content
-                generated_code = extract_json_from_response(generated_response)
+    return [LLMAnswer("No supported LLM API type provided", failure={"reason": "api", "error": f"Unsupported API: {llm_api}"})]
 
-                if generated_code:
-                    exec_times.append(round(end_time - start_time_round))
-                    number_tokens.append(response_cur.response_metadata['token_usage']['completion_tokens'])
-                    generated_codes.append(generated_code)
-                    generated_responses.append(generated_response)
-                    break
-            except Exception as e:
-                print(f"Attempt {attempt + 1} failed with error: {e}")
-                time.sleep(1)
 
-    return generated_responses, generated_codes, number_tokens, exec_times
+def print_retry_summary(answers: List[LLMAnswer], model_name: str = None):
+    retried = sum(1 for answer in answers if answer.transport_failures or answer.parse_failures)
+    failed = sum(1 for answer in answers if answer.failure)
+    retry_time = sum(answer.retry_time for answer in answers)
 
+    print(f"Retry summary{f' of {model_name}' if model_name else ''}: {retried}/{len(answers)} requests retried, {failed} failed, "
+          f"{sum(answer.transport_failures for answer in answers)} transport errors, "
+          f"{sum(answer.parse_failures for answer in answers)} unparsable answers, "
+          f"{retry_time:.1f} seconds spent on retries")
 
-def call_api(llm_api, model_config, system_prompt, user_prompts) -> Tuple[List[str], List[str], List[int], List[float]]:
-    if llm_api == LLM_API.OLLAMA:
-        return call_ollama(model_config, system_prompt, user_prompts)
-    elif llm_api == LLM_API.WATSONXAI:
-        return call_watsonxai(model_config, system_prompt, user_prompts)
 
-    return ["No supported LLM API type provided"], [""], [0], [0]
+def print_telemetry_summary(telemetry: LLMTelemetry):
+    for model, summary in telemetry.summary().items():
+        latency = summary["latency"]
+        tokens_per_second = summary["tokens_per_second"]
+        print(f"Telemetry of {model}: {summary['requests']} requests, {summary['cache_hits']} cache hits, "
+              f"{summary['prompt_tokens']} prompt tokens, "
+              f"{summary['completion_tokens']} completion tokens, "
+              f"latency p50/p95/p99 {latency['p50'] or 0:.2f}/{latency['p95'] or 0:.2f}/{latency['p99'] or 0:.2f} s, "
+              f"{tokens_per_second or 0:.1f} tokens/s")
 
 
-def call_llm(policy_description_file_path, csv_file, data_generator_or_columns: DataGenerator | List[str], llm_api: LLM_API, config_file_path, result_output_path):
+def case_key(test_case: Dict) -> str:
+    """Identifies a test case by its content, so that it can be found again in the results of a previous run."""
+    return json.dumps(test_case, sort_keys=True, ensure_ascii=False)
+
+
+def case_ids(test_cases: List[Dict]) -> List[str]:
+    """
+    Stable ids of the test cases, derived from their content: the same test case gets the same id whatever the
+    order of the dataset, the run or the model. Repeated test cases are numbered ("<id>-2", "<id>-3"...).
+    """
+    ids = []
+    occurrences = {}
+    for test_case in test_cases:
+        digest = hashlib.sha256(case_key(test_case).encode("utf-8")).hexdigest()[:CASE_ID_LENGTH]
+        occurrences[digest] = occurrences.get(digest, 0) + 1
+        ids.append(digest if occurrences[digest] == 1 else f"{digest}-{occurrences[digest]}")
+    return ids
+
+
+def batch_user_prompt(batch_prompt_template, test_cases: Dict[str, str]) -> str:
+    """Packs the JSON test cases into one user prompt, each introduced by its case id."""
+    packed_cases = "\n".join(BATCH_TEST_CASE.format(case_id=case_id, test_case=test_case)
+                             for case_id, test_case in test_cases.items())
+    return batch_prompt_template.format(number_cases=len(test_cases), test_cases=packed_cases)
+
+
+def split_batch_answer(answer: LLMAnswer, case_ids: List[str]) -> Dict[str, LLMAnswer]:
+    """
+    Splits the JSON array answered to a batched request into one answer per case id.
+    Only the case ids of the batch answered with a JSON object are returned (the first answer wins for repeated ids),
+    the missing ones have to be asked again. The tokens are shared evenly between the cases of the batch,
+    the execution time is the one of the whole request.
+    """
+    if answer.failure:
+        return {}
+
+    ids = {str(case_id): case_id for case_id in case_ids}
+    case_answers = {}
+    for item in answer.generated_answer:
+        if not isinstance(item, dict):
+            continue
+        case_id = ids.get(str(item.get(BATCH_CASE_ID_FIELD)))
+        if case_id is None or case_id in case_answers:
+            continue
+        case_answer = {key: value for key, value in item.items() if key != BATCH_CASE_ID_FIELD}
+        case_answers[case_id] = LLMAnswer(answer.generated_response, case_answer, answer.number_tokens / len(case_ids),
+                                          answer.execution_time, answer.retry_time, answer.transport_failures,
+                                          answer.parse_failures, cached=answer.cached,
+                                          prompt_tokens=answer.prompt_tokens / len(case_ids),
+                                          time_to_first_token=answer.time_to_first_token, latency=answer.latency,
+                                          queue_time=answer.queue_time)
+    return case_answers
+
+
+def build_result(test_case: Dict, answer: LLMAnswer, batch_size: int = 1) -> Dict:
+    result = {
+        "test_case": test_case,
+        "generated_response": answer.generated_response,
+        "generated_answer": answer.generated_answer,
+        "number_tokens": answer.number_tokens,
+        "execution_time": answer.execution_time,
+        "batch_size": batch_size
+    }
+    if answer.failure:
+        result["failure"] = answer.failure
+    return result
+
+
+def model_output_path(result_output_path, model_name, taken_paths=()) -> str:
+    """The results file of one of several models: results.json -> results_<model name>.json"""
+    path = Path(result_output_path)
+    slug = re.sub(r"[^A-Za-z0-9._-]+", "-", model_name).strip("-")
+    output_path = str(path.with_name(f"{path.stem}_{slug}{path.suffix}"))
+    number = 2
+    while output_path in taken_paths:
+        output_path = str(path.with_name(f"{path.stem}_{slug}_{number}{path.suffix}"))
+        number += 1
+    return output_path
+
+
+class ModelRun:
+    def __init__(self, backend: LLMBackend, result_output_path, resume=False, batch_size=1, answer_fields=()):
+        """
+        The benchmark of one model: its backend, its results and their output files.
+
+        :param backend: The backend of the model.
+        :param result_output_path: The results file, ".jsonl" to append every result as soon as it is answered.
+        :param resume: Whether to keep the results already present in the results file, and only ask the other cases.
+        :param batch_size: The number of test cases packed into one request.
+        :param answer_fields: The fields every answer must hold. Answers of another shape are rejected, both to stop
+                              streamed responses early and to retry them.
+        """
+        self.backend = backend
+        self.answer_fields = list(answer_fields)
+        self.result_output_path = result_output_path
+        self.resume = resume
+        self.batch_size = max(1, batch_size)
+        self.stream_results = Path(result_output_path).suffix == ".jsonl"
+        self.telemetry_output_path = telemetry_path(result_output_path)
+        self.telemetry = LLMTelemetry.load(self.telemetry_output_path) if resume else LLMTelemetry()
+        self.answers = []
+        self.jsonl_file = None
+
+        self.results = {}
+        if resume and os.path.exists(result_output_path):
+            # The ids are derived again from the test cases, which also aligns the results of older (positional) ids
+            resumed = [result for _, result in iter_results(result_output_path)]
+            self.results = dict(zip(case_ids([result["test_case"] for result in resumed]), resumed))
+            print(f"Resuming: {len(self.results)} cases already answered in {result_output_path}")
+
+    @property
+    def model_name(self) -> str:
+        return self.backend.model_name
+
+    def plan(self, test_cases: List[Dict], test_case_ids: List[str]):
+        """Selects the test cases (given with their case ids) not answered yet."""
+        self.test_cases = test_cases
+        self.case_ids = test_case_ids
+        self.pending = [idx for idx, case_id in enumerate(test_case_ids) if case_id not in self.results]
+        self.batches = [range(start, min(start + self.batch_size, len(self.pending)))
+                        for start in range(0, len(self.pending), self.batch_size)]
+
+    def open(self):
+        Path(self.result_output_path).parent.mkdir(exist_ok=True, parents=True)
+        if self.stream_results:
+            self.jsonl_file = open(self.result_output_path, "a" if self.resume else "w", encoding="utf-8")
+            # The incomplete last line of an interrupted run is left on its own line, and skipped when read
+            if self.jsonl_file.tell() and not self.ends_with_newline():
+                self.jsonl_file.write("\n")
+
+    def ends_with_newline(self) -> bool:
+        with open(self.result_output_path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b"\n"
+
+    def close(self):
+        if self.jsonl_file:
+            self.jsonl_file.close()
+            self.jsonl_file = None
+
+    def save_answer(self, index, answer, answer_batch_size=1):
+        result_id = self.case_ids[self.pending[index]]
+        self.results[result_id] = build_result(self.test_cases[self.pending[index]], answer, answer_batch_size)
+        if self.jsonl_file:
+            self.jsonl_file.write(json.dumps({"id": result_id, **self.results[result_id]}, ensure_ascii=False) + "\n")
+            self.jsonl_file.flush()
+
+    def save_batch_answer(self, batch_index, answer):
+        batch = self.batches[batch_index]
+        batch_case_ids = [self.case_ids[self.pending[index]] for index in batch]
+        case_answers = split_batch_answer(answer, batch_case_ids)
+        for index, case_id in zip(batch, batch_case_ids):
+            if case_id in case_answers:
+                self.save_answer(index, case_answers[case_id], len(batch))
+
+    def validate_answer(self, user_prompt, generated_answer) -> bool:
+        """Whether the answer to a single case is a JSON object holding the answer fields."""
+        return isinstance(generated_answer, dict) and all(field in generated_answer for field in self.answer_fields)
+
+    def validate_batch_answer(self, user_prompt, generated_answer) -> bool:
+        """Whether the answer to a batch is a JSON array of single answers, each with the case id it answers."""
+        return isinstance(generated_answer, list) and all(
+            self.validate_answer(user_prompt, item) and BATCH_CASE_ID_FIELD in item for item in generated_answer)
+
+    async def run(self, system_prompt, user_prompts: List[str], batch_user_prompts, concurrency=1, timeout=None,
+                  cache: ResponseCache = None) -> List[LLMAnswer]:
+        """
+        Asks the pending test cases, in batches first if `batch_size` is above 1, then one by one.
+
+        :param user_prompts: The user prompt of every test case, shared by all the models.
+        :param batch_user_prompts: Builds the user prompt of a batch from the {case id: test case index} of its cases.
+        """
+        batch_prompts = []
+        if self.batch_size > 1 and self.pending:
+            batch_prompts = [batch_user_prompts({self.case_ids[self.pending[index]]: self.pending[index] for index in batch})
+                             for batch in self.batches]
+        # Any pending case may be asked individually after the batches: the context is sized for all the prompts at once
+        if self.pending:
+            self.backend.size_context(system_prompt, batch_prompts + [user_prompts[index] for index in self.pending])
+
+        if batch_prompts:
+            print(f"Calling {self.model_name} with the created batched user prompts...")
+            batch_answers = await self.backend.abatch_generate(system_prompt, batch_prompts, concurrency, timeout, cache,
+                                                               self.save_batch_answer, self.validate_batch_answer)
+            for batch, answer in zip(self.batches, batch_answers):
+                self.telemetry.record(self.model_name, answer, len(batch))
+            self.answers += batch_answers
+
+        # Without batches all the cases, otherwise the cases missing from the batched answers, are asked one by one
+        single_cases = [index for index in range(len(self.pending)) if self.case_ids[self.pending[index]] not in self.results]
+        if single_cases:
+            if self.batch_size > 1:
+                print(f"Asking {len(single_cases)} cases missing from the batched answers of {self.model_name} individually...")
+            print(f"Calling {self.model_name} with the created user prompts...")
+            single_answers = await self.backend.abatch_generate(
+                system_prompt, [user_prompts[self.pending[index]] for index in single_cases], concurrency, timeout, cache,
+                lambda position, answer: self.save_answer(single_cases[position], answer), self.validate_answer)
+            for answer in single_answers:
+                self.telemetry.record(self.model_name, answer)
+            self.answers += single_answers
+        return self.answers
+
+    def report(self):
+        if self.answers:
+            print_retry_summary(self.answers, self.model_name)
+            print(f"Token usage of {self.model_name} (failed attempts included): {self.backend.token_usage()}")
+            self.telemetry.save(self.telemetry_output_path)
+            print_telemetry_summary(self.telemetry)
+
+    def save(self):
+        if not self.stream_results:
+            print(f"Saving the generation results of {self.model_name}...")
+            with open(self.result_output_path, "w", encoding="utf-8") as f:
+                # In the order of the dataset, followed by the resumed results of cases no longer in the dataset
+                ordered = {case_id: self.results[case_id] for case_id in self.case_ids if case_id in self.results}
+                ordered.update(self.results)
+                json.dump(ordered, f, indent=4, ensure_ascii=False)
+
+
+def call_llm_models(policy_description_file_path, csv_file, data_generator_or_columns: DataGenerator | List[str],
+                    llm_apis: List[LLM_API | str], config_file_paths: List[str], result_output_path,
+                    concurrency=1, timeout=None, cache: ResponseCache = None, resume=False, batch_size=1,
+                    stream=False, seed=None, column_mapping: Dict[str, str] = None) -> Dict[str, Dict]:
+    """
+    Benchmarks several models in one pass over the dataset: the csv file is read and shuffled once, the prompts are
+    built once, and all the models are asked concurrently (each one with up to `concurrency` requests in flight).
+    A single API applies to all the configurations, otherwise there is one API per configuration file.
+
+    With a single model, the results are saved in `result_output_path`, otherwise every model gets its own results
+    file named after it (see model_output_path), with the same case ids for the same test cases.
+    With a `column_mapping` (from the evaluated columns to the answered fields), every answer must hold the fields
+    of the evaluated columns, otherwise the answers are only required to be JSON objects.
+    Returns the results of every results file, keyed by case id. See call_llm for the other parameters.
+    """
+    if len(llm_apis) == 1:
+        llm_apis = llm_apis * len(config_file_paths)
+    if len(llm_apis) != len(config_file_paths):
+        raise ValueError("Expected either one API for all the configuration files or one API per configuration file.")
+
     policy_document = file_to_string(policy_description_file_path)
 
     system_prompt = file_to_string(SYSTEM_PROMPT_FILE)
     system_prompt = system_prompt.format(policy_document=policy_document)
 
-    model_config = load_config(config_file_path)
+    backends = [create_backend(backend_name(llm_api), load_config(config_file_path), stream)
+                for llm_api, config_file_path in zip(llm_apis, config_file_paths)]
 
     user_prompt_default = file_to_string(USER_PROMPT)
 
     dataFull = pd.read_csv(csv_file, na_filter=True).fillna("")
-    dataFull = dataFull.sample(frac=1).reset_index(drop=True)
+    dataFull = dataFull.sample(frac=1, random_state=seed).reset_index(drop=True)
 
     # Handle both DataGenerator and direct list input
     if isinstance(data_generator_or_columns, list):
@@ -180,33 +368,96 @@ def call_llm(policy_description_file_path, csv_file, data_generator_or_columns:
         raise TypeError("data_generator_or_columns must be either a list of strings or a DataGenerator instance.")
 
     data = dataFull.drop(columns=eval_column_names)
+    # The LLM answers the evaluated columns under their mapped names (e.g. "eligibility" -> "eligible")
+    answer_fields = [column_mapping[column] for column in eval_column_names if column in (column_mapping or {})]
     # data = data.head(5)
 
-    results = {}
-    user_prompts = []
+    runs = []
+    for backend in backends:
+        output_path = result_output_path if len(backends) == 1 else \
+            model_output_path(result_output_path, backend.model_name, [run.result_output_path for run in runs])
+        runs.append(ModelRun(backend, output_path, resume, batch_size, answer_fields))
+
+    test_cases = dataFull.to_dict(orient="records")
+    test_case_ids = case_ids(test_cases)
+    for run in runs:
+        run.plan(test_cases, test_case_ids)
+
+    # The prompts of the cases pending for any of the models are built once, and shared by all of them
     print("Formulating user prompts...")
-    for idx, case in data.iterrows():
-        user_prompts.append(user_prompt_default.format(test_case=case.to_json()))
+    pending = sorted({idx for run in runs for idx in run.pending})
+    case_prompts = dict(zip(pending, (case.to_json() for _, case in data.iloc[pending].iterrows())))
+    user_prompts = {idx: user_prompt_default.format(test_case=case_prompt) for idx, case_prompt in case_prompts.items()}
+    batch_prompt_template = file_to_string(BATCH_USER_PROMPT) if batch_size > 1 else None
+    batch_prompts = {}
+
+    def batch_user_prompts(batch_cases: Dict[str, int]) -> str:
+        key = tuple(batch_cases.items())
+        if key not in batch_prompts:
+            batch_prompts[key] = batch_user_prompt(batch_prompt_template,
+                                                   {case_id: case_prompts[idx] for case_id, idx in batch_cases.items()})
+        return batch_prompts[key]
+
+    async def ask_models():
+        # All the passes of all the models run in the same event loop, so that the backend clients are reused
+        return await asyncio.gather(*(run.run(system_prompt, user_prompts, batch_user_prompts, concurrency, timeout, cache)
+                                      for run in runs))
+
+    for run in runs:
+        run.open()
+    try:
+        asyncio.run(ask_models())
+        for run in runs:
+            run.report()
+        if cache is not None:
+            print(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+    finally:
+        for run in runs:
+            run.close()
+
+    for run in runs:
+        run.save()
+
+    return {run.result_output_path: run.results for run in runs}
+
+
+def call_llm(policy_description_file_path, csv_file, data_generator_or_columns: DataGenerator | List[str], llm_api: LLM_API | str, config_file_path, result_output_path,
+             concurrency=1, timeout=None, cache: ResponseCache = None, resume=False, batch_size=1, stream=False,
+             seed=None, column_mapping: Dict[str, str] = None):
+    """
+    Asks the LLM to decide every test case of the csv file and saves the results in `result_output_path`.
+
+    If the output path ends with ".jsonl", every result is appended to it as one JSON line as soon as the case is
+    finished, otherwise all the results are written at the end as one JSON object. With `resume`, the cases already
+    present in the output file are skipped and their results kept.
 
-    print("Calling LLM with the created user prompts...")
-    generated_responses, generated_answers, numbers_tokens, exec_times = call_api(llm_api, model_config, system_prompt, user_prompts)
-    for idx in range(len(generated_answers)):
-        results[idx] = {
-            "test_case": dataFull.iloc[idx].to_dict(),
-            "generated_response": generated_responses[idx],
-            "generated_answer": json.loads(generated_answers[idx]) if generated_answers[idx] else None,
-            "number_tokens": numbers_tokens[idx],
-            "execution_time": exec_times[idx]
-        }
+    With a `batch_size` above 1, the test cases are packed by `batch_size` into one user prompt (see
+    batch_user_prompt_template.md), introduced by their case id, and the JSON array answered by the LLM is
+    split back by case id. The cases missing from the answer, or of failed batches, are then asked individually.
+    Every result records the size of the batch in which it was answered.
 
-    print("Saving the generation results...")
+    The token and latency records of every request, and their aggregates, are saved next to the results file
+    (see llm_telemetry.py).
 
-    results_output_path = Path(result_output_path)
-    results_output_path.parent.mkdir(exist_ok=True, parents=True)
-    with open(result_output_path, "w", encoding="utf-8") as f:
-        json.dump(results, f, indent=4, ensure_ascii=False)
+    With `stream` (Ollama only), the responses are streamed and stopped as soon as their JSON answer is complete.
 
-    return results
+    With a `column_mapping` (from the evaluated columns to the answered fields), only the answers holding the fields
+    of the evaluated columns are accepted: a JSON object per case, or a JSON array of them with their case ids for
+    batches. Answers of another shape neither stop a streamed response nor end the retries.
+
+    The results are keyed by case id, derived from the content of the test case (see case_ids), so that the results
+    of different runs, models or orders can be matched. The cases are asked in a random order, reproducible with `seed`.
+
+    `llm_api` is an LLM_API member or the name of a registered backend (see llm_backends.py).
+    """
+    return call_llm_models(policy_description_file_path, csv_file, data_generator_or_columns, [llm_api],
+                           [config_file_path], result_output_path, concurrency, timeout, cache, resume, batch_size,
+                           stream, seed, column_mapping)[result_output_path]
+
+
+def configured_apis(config_file_paths: List[str]) -> List[str | None]:
+    """The API named by the "api" field of every configuration file, None for the files without one."""
+    return [load_config(config_file_path).get("api") for config_file_path in config_file_paths]
 
 
 def load_data_generator_or_columns(value):
@@ -232,6 +483,166 @@ def load_data_generator_or_columns(value):
         raise ImportError(f"Could not load data generator class '{value}': {e}")
 
 
+import tempfile
+import unittest
+
+
+class TestModelRun(unittest.TestCase):
+    CSV_FILE = os.path.join(ROOT_DIR, "../loan/loan_compliance/loan_policy_test_dataset_100.csv")
+    EVAL_COLUMNS = ["eligibility", "interest_rate", "reason"]
+
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        data = pd.read_csv(self.CSV_FILE, na_filter=True).fillna("").head(5)
+        self.test_cases = data.to_dict(orient="records")
+        self.case_prompts = [case.to_json() for _, case in data.drop(columns=self.EVAL_COLUMNS).iterrows()]
+        self.user_prompts = {idx: file_to_string(USER_PROMPT).format(test_case=case_prompt)
+                             for idx, case_prompt in enumerate(self.case_prompts)}
+
+    def tearDown(self):
+        self.output_dir.cleanup()
+
+    def backend(self):
+        return create_backend("stub", {"model_name": "stub", "csv_file": self.CSV_FILE,
+                                       "column_mapping": {"eligibility": "eligible"},
+                                       "retry": {"max_parse_attempts": 1}})
+
+    def model_run(self, backend, output_file="results.jsonl", resume=False, batch_size=1,
+                  answer_fields=("eligible",)) -> ModelRun:
+        run = ModelRun(backend, os.path.join(self.output_dir.name, output_file), resume, batch_size, answer_fields)
+        run.plan(self.test_cases, case_ids(self.test_cases))
+        return run
+
+    def ask(self, run: ModelRun):
+        batch_template = file_to_string(BATCH_USER_PROMPT)
+
+        def batch_user_prompts(batch_cases):
+            return batch_user_prompt(batch_template, {case_id: self.case_prompts[idx] for case_id, idx in batch_cases.items()})
+
+        run.open()
+        try:
+            return asyncio.run(run.run("system prompt", self.user_prompts, batch_user_prompts))
+        finally:
+            run.close()
+
+    def test_context_sized_once_for_both_passes(self):
+        backend = self.backend()
+        sized = []
+        backend.size_context = lambda system_prompt, user_prompts: sized.append(user_prompts)
+        run = self.model_run(backend, batch_size=2)
+        self.ask(run)
+
+        self.assertEqual(len(sized), 1)
+        self.assertEqual(len(sized[0]), len(run.batches) + len(self.test_cases))
+        self.assertTrue(set(self.user_prompts.values()) <= set(sized[0]))
+
+
+    def test_jsonl_resume(self):
+        self.ask(self.model_run(self.backend()))
+        path = os.path.join(self.output_dir.name, "results.jsonl")
+        with open(path, "r", encoding="utf-8") as file:
+            lines = file.readlines()
+        self.assertEqual(len(lines), len(self.test_cases))
+        # An interrupted run: two results written, the third one incomplete
+        with open(path, "w", encoding="utf-8") as file:
+            file.writelines(lines[:2] + [lines[2][:30]])
+
+        backend = self.backend()
+        run = self.model_run(backend, resume=True)
+        self.assertEqual(len(run.pending), len(self.test_cases) - 2)
+        self.ask(run)
+        self.assertEqual(backend.token_usage()["requests"], len(self.test_cases) - 2)
+        self.assertEqual(sorted(key for key, _ in iter_results(path)), sorted(case_ids(self.test_cases)))
+
+
+    def test_answer_shapes(self):
+        run = self.model_run(self.backend())
+        self.assertTrue(run.validate_answer("prompt", {"eligible": False, "reason": "age"}))
+        self.assertFalse(run.validate_answer("prompt", {"approved": False}))
+        self.assertFalse(run.validate_answer("prompt", [{"eligible": False}]))
+        self.assertTrue(run.validate_batch_answer("prompt", [{"case_id": "a1", "eligible": True}]))
+        self.assertFalse(run.validate_batch_answer("prompt", [{"case_id": "a1", "eligible": True}, {"eligible": True}]))
+        self.assertFalse(run.validate_batch_answer("prompt", {"case_id": "a1", "eligible": True}))
+
+    def test_answers_of_another_shape_rejected(self):
+        backend = self.backend()
+        run = self.model_run(backend, "results.json", batch_size=2, answer_fields=["interest_rate"])
+        answers = self.ask(run)
+        self.assertTrue(all(answer.failure and answer.failure["reason"] == "parse" for answer in answers))
+        self.assertTrue(all(result["generated_answer"] is None for result in run.results.values()))
+        self.assertEqual(len(run.results), len(self.test_cases))
+
+    def test_batched_run(self):
+        backend = self.backend()
+        run = self.model_run(backend, "results.json", batch_size=2)
+        self.ask(run)
+        run.save()
+        self.assertEqual(backend.token_usage()["requests"], len(run.batches))
+        results = dict(iter_results(run.result_output_path))
+        self.assertEqual(list(results), case_ids(self.test_cases))
+        for test_case, result in zip(self.test_cases, results.values()):
+            self.assertEqual(result["generated_answer"], {"eligible": test_case["eligibility"]})
+            self.assertEqual(result["batch_size"], 1 if test_case is self.test_cases[-1] else 2)
+
+
+class TestBatchAnswers(unittest.TestCase):
+    def test_batch_user_prompt(self):
+        prompt = batch_user_prompt("{number_cases} cases:\n{test_cases}", {"a1": '{"x": 1}', "b2": '{"x": 2}'})
+        self.assertEqual(prompt, "2 cases:\n" + BATCH_TEST_CASE.format(case_id="a1", test_case='{"x": 1}') + "\n" +
+                         BATCH_TEST_CASE.format(case_id="b2", test_case='{"x": 2}'))
+
+    def test_split_batch_answer(self):
+        answer = LLMAnswer("response", [{"case_id": "a1", "eligible": True}, "not an object",
+                                        {"case_id": "zz", "eligible": False}, {"case_id": "a1", "eligible": False},
+                                        {"case_id": 7, "eligible": False}],
+                           number_tokens=30, prompt_tokens=90)
+        case_answers = split_batch_answer(answer, ["a1", "b2", 7])
+        self.assertEqual(set(case_answers), {"a1", 7})
+        self.assertEqual(case_answers["a1"].generated_answer, {"eligible": True})
+        self.assertEqual((case_answers[7].number_tokens, case_answers[7].prompt_tokens), (10, 30))
+
+    def test_split_failed_batch(self):
+        self.assertEqual(split_batch_answer(LLMAnswer(failure={"reason": "parse"}), ["a1"]), {})
+
+
+
+class TestModelOutputPath(unittest.TestCase):
+    def test_paths_per_model(self):
+        self.assertEqual(model_output_path("out/results.jsonl", "granite3.3:8b"), str(Path("out/results_granite3.3-8b.jsonl")))
+        taken = [str(Path("out/results_llama.json"))]
+        self.assertEqual(model_output_path("out/results.json", "llama", taken), str(Path("out/results_llama_2.json")))
+
+
+
+class TestCaseIds(unittest.TestCase):
+    def test_stable_ids(self):
+        cases = [{"age": 30, "income": 1000}, {"age": 40, "income": 2000}]
+        ids = case_ids(cases)
+        self.assertEqual(case_ids(cases[::-1]), ids[::-1])
+        self.assertEqual(case_ids([{"income": 1000, "age": 30}])[0], ids[0])
+        self.assertEqual(len(ids[0]), CASE_ID_LENGTH)
+
+    def test_duplicate_suffixes(self):
+        case = {"age": 30}
+        ids = case_ids([case, {"age": 31}, case, case])
+        self.assertEqual(ids[2:], [f"{ids[0]}-2", f"{ids[0]}-3"])
+        self.assertEqual(len(set(ids)), 4)
+
+
+
+class TestConfiguredApis(unittest.TestCase):
+    def test_example_configurations(self):
+        config_files = [os.path.join(CONFIG_DIR, f"{api}_config_example.json") for api in BACKENDS]
+        self.assertEqual(configured_apis(config_files), list(BACKENDS))
+
+    def test_missing_api(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config_file = os.path.join(directory, "config.json")
+            with open(config_file, "w") as file:
+                json.dump({"model_name": "model"}, file)
+            self.assertEqual(configured_apis([config_file]), [None])
+
+
 if __name__ == "__main__":
     # from luggage_data_generator import LuggageDataGenerator
     # call_llm(
@@ -259,11 +670,34 @@ if __name__ == "__main__":
     parser.add_argument("--data_generator", type=str, required=True,
                         help="Either the full module path of a DataGenerator subclass, with which the reference csv dataset is generated (e.g., 'my_module.MyGenerator') "
                              "or a comma-separated list of evaluation columns (e.g., 'col1,col2,col3').")
-    parser.add_argument("--api", type=str, required=False, choices=["ollama", "watsonx"],
-                        help="The API to be used for the LLM call (ollama/watsonx).")
-    parser.add_argument("--config_file", type=str, required=True, help="The model & api configuration file path.")
-    parser.add_argument("--output_file", type=str, required=True, help="The path for the benchmarking results output")
-    parser.add_argument("--output_file", type=str, required=True, help="The path for the benchmarking results output")
+    parser.add_argument("--api", type=str, required=False, choices=list(BACKENDS), nargs="+",
+                        help=f"The API to be used for the LLM call ({'/'.join(BACKENDS)}), "
+                             f"either one for all the configuration files or one per configuration file. "
+                             f"Defaults to the \"api\" field of every configuration file.")
+    parser.add_argument("--config_file", type=str, required=True, nargs="+",
+                        help="The model & api configuration file path. With several files, all the models are "
+                             "benchmarked concurrently, each one in its own output file.")
+    parser.add_argument("--output_file", type=str, required=True,
+                        help="The path for the benchmarking results output. With a .jsonl extension, "
+                             "every result is appended to the file as soon as its case is answered.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Keep the results already present in the output file and only ask the remaining cases.")
+    parser.add_argument("--batch_size", type=int, required=False, default=1,
+                        help="The number of test cases packed into one LLM request (default: 1).")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream the responses and stop the generation as soon as the JSON answer is complete (ollama only).")
+    parser.add_argument("--seed", type=int, required=False, default=None,
+                        help="Optional seed of the shuffling of the test cases, to ask them in the same order on every run.")
+    parser.add_argument("--concurrency", type=int, required=False, default=1,
+                        help="The maximum number of LLM requests sent at the same time (default: 1).")
+    parser.add_argument("--timeout", type=float, required=False, default=None,
+                        help="Optional timeout in seconds of a single LLM request, after which it is retried.")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Always call the LLM, without reading or writing the on-disk response cache.")
+    parser.add_argument("--cache_dir", type=str, required=False, default=CACHE_DIR,
+                        help="The directory of the on-disk response cache (default: common/.llm_cache).")
+    parser.add_argument("--cache_max_size", type=int, required=False, default=ResponseCache.DEFAULT_MAX_SIZE_BYTES // 2 ** 20,
+                        help="The maximum size of the response cache in MB, the least recently used responses are evicted.")
     parser.add_argument("--column_mapping", type=str, required=False,
                         help="Optional JSON string for column name mapping for benchmark metrics calculation. "
                              "The way they are saved in reference csv dataset vs the way they are saved in the resulting output_file (generated by LLM) "
@@ -271,14 +705,23 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    data_generator = load_data_generator_or_columns(args.data_generator)
+    llm_apis = args.api or configured_apis(args.config_file)
+    if None in llm_apis:
+        parser.error("--api is required when a configuration file has no \"api\" field")
 
-    call_llm(args.policy_desc, args.csv_file, data_generator,
-             LLM_API[args.api.upper()] if args.api else None, args.config_file, args.output_file)
+    data_generator = load_data_generator_or_columns(args.data_generator)
+    cache = None if args.no_cache else ResponseCache(args.cache_dir, args.cache_max_size * 2 ** 20)
 
     column_mapping = parse_column_mapping(args.column_mapping)
-    if column_mapping:
+    model_results = call_llm_models(args.policy_desc, args.csv_file, data_generator,
+                                    llm_apis, args.config_file, args.output_file,
+                                    args.concurrency, args.timeout, cache, args.resume, args.batch_size, args.stream,
+                                    args.seed, column_mapping)
+
+    if column_mapping and len(model_results) == 1:
         res = benchmark_results(args.output_file, column_mapping)
         print(res)
+    elif column_mapping:
+        print_comparison_table(compare_results(list(model_results), column_mapping))
 
 # python ./llm_calls.py --policy_desc "../luggage/luggage_policy.txt" --csv_file "../luggage/luggage_compliance/luggage_policy_test_dataset_100.csv" --data_generator "luggage_data_generator.LuggageDataGenerator" --api ollama --config_file "./config/ollama_config_example.json" --output_file "generation_result_test.json" --column_mapping '{"eligibility": "eligible"}'
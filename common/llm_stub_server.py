@@ -0,0 +1,252 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from common.benchmarking_results import parse_column_mapping
+from common.json_extractor import find_fenced_blocks
+
+BATCH_CASE_ID_PATTERN = re.compile(r"Test case (\S+):\s*$")
+BATCH_CASE_ID_FIELD = "case_id"
+UNKNOWN_CASE_RESPONSE = "I could not find this test case in the reference dataset."
+
+
+class LatencyDistribution:
+    """
+    Distribution of the simulated latencies in seconds, written "kind:parameters":
+    "constant:0.2", "uniform:0.1,0.5", "normal:0.3,0.05", "lognormal:-1.5,0.5" (of the log of the latency)
+    or "exponential:0.3" (mean). Negative samples are clipped to 0.
+    """
+
+    KINDS = {
+        "constant": lambda rng, value: value,
+        "uniform": lambda rng, low, high: rng.uniform(low, high),
+        "normal": lambda rng, mean, std: rng.gauss(mean, std),
+        "lognormal": lambda rng, mu, sigma: rng.lognormvariate(mu, sigma),
+        "exponential": lambda rng, mean: rng.expovariate(1 / mean),
+    }
+
+    def __init__(self, description: str = "constant:0"):
+        kind, _, parameters = description.partition(":")
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution '{kind}', expected one of: {', '.join(self.KINDS)}")
+        self.description = description
+        self.kind = kind
+        self.parameters = [float(parameter) for parameter in parameters.split(",") if parameter]
+
+    def sample(self, rng: random.Random) -> float:
+        return max(0.0, self.KINDS[self.kind](rng, *self.parameters))
+
+    def __repr__(self):
+        return f"LatencyDistribution({self.description})"
+
+
+class ReferenceAnswerReplayer:
+    """
+    Deterministic stand-in for an LLM: answers the test cases found in the user prompts (single or batched)
+    with the expected values of the reference csv dataset, in the JSON format of the prompt templates.
+
+    The latency and the simulated errors of a request only depend on the seed, the user prompt and the number of
+    previous attempts of the same prompt, so that a run can be replayed identically whatever the concurrency.
+    """
+
+    def __init__(self, csv_file: str, column_mapping: Dict[str, str] = None, latency: str = "constant:0",
+                 error_rate: float = 0.0, seed: int = 0):
+        """
+        :param csv_file: The reference csv dataset.
+        :param column_mapping: Maps the reference columns to the answered fields (e.g. {"eligibility": "eligible"}).
+                               The columns missing from the test case of the prompt are answered if not given.
+        :param latency: The description of the LatencyDistribution of the requests.
+        :param error_rate: The probability that a request fails.
+        :param seed: The seed of the latencies and errors.
+        """
+        self.data = pd.read_csv(csv_file, na_filter=True).fillna("")
+        self.column_mapping = column_mapping
+        self.latency = LatencyDistribution(latency)
+        self.error_rate = error_rate
+        self.seed = seed
+        # Index of the reference rows by the content of their prompted columns, built per set of columns
+        self._indexes = {}
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config: Dict) -> "ReferenceAnswerReplayer":
+        return ReferenceAnswerReplayer(config["csv_file"], config.get("column_mapping"),
+                                       config.get("latency", "constant:0"), config.get("error_rate", 0.0),
+                                       config.get("seed", 0))
+
+    @staticmethod
+    def _key(test_case: Dict) -> str:
+        return json.dumps(test_case, sort_keys=True, ensure_ascii=False)
+
+    def _index(self, columns: Tuple[str]) -> Dict[str, Dict]:
+        if columns not in self._indexes:
+            rows = json.loads(self.data.to_json(orient="records"))
+            self._indexes[columns] = {self._key({column: row[column] for column in columns}): row for row in rows}
+        return self._indexes[columns]
+
+    def expected_answer(self, test_case: Dict) -> Dict | None:
+        """The reference answer of a prompted test case, None if the test case is not in the dataset."""
+        columns = tuple(sorted(test_case))
+        if not set(columns) <= set(self.data.columns):
+            return None
+        with self._lock:
+            row = self._index(columns).get(self._key(test_case))
+        if row is None:
+            return None
+        column_mapping = self.column_mapping or {column: column for column in self.data.columns if column not in test_case}
+        return {answered: row[column] for column, answered in column_mapping.items()}
+
+    def respond(self, user_prompt: str) -> str:
+        """The response text to a single or batched user prompt."""
+        answers = []
+        case_ids = []
+        previous_end = 0
+        for block in find_fenced_blocks(user_prompt):
+            try:
+                test_case = json.loads(block.text)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(test_case, dict):
+                continue
+            case_id = BATCH_CASE_ID_PATTERN.search(user_prompt, previous_end, block.start)
+            previous_end = block.end
+            case_ids.append(case_id.group(1) if case_id else None)
+            answers.append(self.expected_answer(test_case))
+
+        if not answers or (len(answers) == 1 and case_ids[0] is None):
+            answer = answers[0] if answers else None
+            return UNKNOWN_CASE_RESPONSE if answer is None else f"```json\n{json.dumps(answer)}\n```"
+
+        batch_answers = [{BATCH_CASE_ID_FIELD: case_id, **answer}
+                         for case_id, answer in zip(case_ids, answers) if case_id is not None and answer is not None]
+        return f"```json\n{json.dumps(batch_answers)}\n```"
+
+    def replay(self, user_prompt: str) -> Tuple[str | None, float]:
+        """The response to a user prompt (None for a simulated error) and the latency to wait before returning it."""
+        with self._lock:
+            attempt = self._attempts.get(user_prompt, 0)
+            self._attempts[user_prompt] = attempt + 1
+        digest = hashlib.sha256(f"{self.seed}:{attempt}:{user_prompt}".encode("utf-8")).digest()
+        rng = random.Random(int.from_bytes(digest[:8], "big"))
+        delay = self.latency.sample(rng)
+        if rng.random() < self.error_rate:
+            return None, delay
+        return self.respond(user_prompt), delay
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        """Rough token count of a text, about 4 characters per token."""
+        return max(1, len(text) // 4)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """OpenAI compatible chat completions endpoint, answered by the ReferenceAnswerReplayer of the server."""
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+        user_prompt = next((message["content"] for message in reversed(request["messages"]) if message["role"] == "user"), "")
+
+        response, delay = self.server.replayer.replay(user_prompt)
+        time.sleep(delay)
+        if response is None:
+            self.send_error(503, "Simulated stub server error")
+            return
+
+        body = json.dumps({
+            "id": f"stub-{hashlib.sha256(user_prompt.encode('utf-8')).hexdigest()[:12]}",
+            "object": "chat.completion",
+            "model": request.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": response}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": ReferenceAnswerReplayer.count_tokens(user_prompt),
+                "completion_tokens": ReferenceAnswerReplayer.count_tokens(response),
+            }
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(replayer: ReferenceAnswerReplayer, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), StubRequestHandler)
+    server.daemon_threads = True
+    server.replayer = replayer
+    return server
+
+
+import unittest
+
+
+class TestReferenceAnswerReplayer(unittest.TestCase):
+    CSV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "../loan/loan_compliance/loan_policy_test_dataset_100.csv")
+
+    def setUp(self):
+        self.replayer = ReferenceAnswerReplayer(self.CSV_FILE, {"eligibility": "eligible"}, "uniform:0.1,0.5",
+                                                error_rate=0.3, seed=7)
+        self.data = self.replayer.data.drop(columns=["eligibility", "interest_rate", "reason"])
+
+    def test_single_and_batched_answers(self):
+        test_case = self.data.iloc[3].to_json()
+        expected = {"eligible": bool(self.replayer.data.iloc[3]["eligibility"])}
+        self.assertEqual(json.loads(find_fenced_blocks(self.replayer.respond(f"```json\n{test_case}\n```"))[0].text),
+                         expected)
+
+        batch = f"Test case 12:\n```json\n{test_case}\n```\nTest case 13:\n```json\n{{\"unknown\": 1}}\n```"
+        answers = json.loads(find_fenced_blocks(self.replayer.respond(batch))[0].text)
+        self.assertEqual(answers, [{"case_id": "12", **expected}])
+
+    def test_unknown_case(self):
+        self.assertEqual(self.replayer.respond("```json\n{\"unknown\": 1}\n```"), UNKNOWN_CASE_RESPONSE)
+
+    def test_deterministic_replay(self):
+        other = ReferenceAnswerReplayer(self.CSV_FILE, {"eligibility": "eligible"}, "uniform:0.1,0.5",
+                                        error_rate=0.3, seed=7)
+        prompts = [f"```json\n{self.data.iloc[index].to_json()}\n```" for index in range(20)] * 2
+        replays = [self.replayer.replay(prompt) for prompt in prompts]
+        self.assertEqual(replays, [other.replay(prompt) for prompt in prompts])
+        self.assertTrue(all(0.1 <= delay <= 0.5 for _, delay in replays))
+        self.assertTrue(any(response is None for response, _ in replays))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI compatible server replaying the answers of a reference dataset")
+    parser.add_argument("--csv_file", type=str, required=True, help="Path to the reference testing dataset csv file.")
+    parser.add_argument("--column_mapping", type=str, required=False,
+                        help="Optional JSON string mapping the reference columns to the answered fields "
+                             "(e.g., '{\"eligibility\": \"eligible\"}').")
+    parser.add_argument("--latency", type=str, required=False, default="constant:0",
+                        help="The latency distribution of the requests, e.g. 'lognormal:-1.5,0.5' (default: constant:0).")
+    parser.add_argument("--error_rate", type=float, required=False, default=0.0,
+                        help="The probability that a request fails with a 503 error (default: 0).")
+    parser.add_argument("--seed", type=int, required=False, default=0, help="The seed of the latencies and errors.")
+    parser.add_argument("--host", type=str, required=False, default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=False, default=8000)
+    args = parser.parse_args()
+
+    replayer = ReferenceAnswerReplayer(args.csv_file, parse_column_mapping(args.column_mapping), args.latency,
+                                       args.error_rate, args.seed)
+    server = create_server(replayer, args.host, args.port)
+    print(f"Serving {len(replayer.data)} reference answers on http://{args.host}:{args.port}/v1/chat/completions")
+    server.serve_forever()
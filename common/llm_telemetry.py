@@ -0,0 +1,155 @@
+import json
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+PERCENTILES = [50, 95, 99]
+
+
+def telemetry_path(result_output_path) -> Path:
+    """The telemetry file written next to a results file: results.json -> results_telemetry.json"""
+    path = Path(result_output_path)
+    return path.with_name(f"{path.stem}_telemetry.json")
+
+
+def percentiles(values: List[float]) -> Dict[str, float | None]:
+    if not values:
+        return {f"p{percentile}": None for percentile in PERCENTILES}
+    return {f"p{percentile}": float(value) for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+
+
+class LLMTelemetry:
+    """
+    Per-call token and latency records of the LLM requests of a benchmark run, aggregated per model.
+
+    Every record holds the prompt and completion tokens, the time to first token, the time spent waiting for a free
+    request slot (queue time), the time lost on failed attempts (retry time) and the latency of the accepted request.
+    Responses read from the response cache sent no request: they are only counted, per model, in `cache_hits`.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.cache_hits = Counter()
+
+    def record(self, model: str, answer, batch_size: int = 1) -> Dict | None:
+        """Adds the record of one request from its LLMAnswer, or counts the cache hit of a cached answer."""
+        if answer.cached:
+            self.cache_hits[model] += 1
+            return None
+
+        record = {
+            "model": model,
+            "batch_size": batch_size,
+            "prompt_tokens": answer.prompt_tokens,
+            "completion_tokens": answer.number_tokens,
+            "time_to_first_token": answer.time_to_first_token,
+            "queue_time": answer.queue_time,
+            "retry_time": answer.retry_time,
+            "latency": answer.latency,
+            "failed": answer.failure is not None
+        }
+        self.records.append(record)
+        return record
+
+    def summary(self) -> Dict[str, Dict]:
+        """Aggregates the records per model: totals, p50/p95/p99 of the timings and completion tokens per second."""
+        summary = {}
+        for model in dict.fromkeys([record["model"] for record in self.records] + list(self.cache_hits)):
+            records = [record for record in self.records if record["model"] == model]
+            called = [record for record in records if not record["failed"]]
+            latency = sum(record["latency"] for record in called)
+            completion_tokens = sum(record["completion_tokens"] for record in called)
+
+            summary[model] = {
+                "requests": len(records),
+                "cache_hits": self.cache_hits[model],
+                "failed": sum(record["failed"] for record in records),
+                "prompt_tokens": sum(record["prompt_tokens"] for record in records),
+                "completion_tokens": sum(record["completion_tokens"] for record in records),
+                "tokens_per_second": completion_tokens / latency if latency else None,
+                "latency": percentiles([record["latency"] for record in called]),
+                "time_to_first_token": percentiles([record["time_to_first_token"] for record in called
+                                                    if record["time_to_first_token"] is not None]),
+                "queue_time": percentiles([record["queue_time"] for record in records]),
+                "retry_time": percentiles([record["retry_time"] for record in records]),
+            }
+        return summary
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"summary": self.summary(), "calls": self.records, "cache_hits": self.cache_hits}, file, indent=4)
+
+    @staticmethod
+    def load(path) -> "LLMTelemetry":
+        """Reads the records of a saved telemetry file, none if the file does not exist or is unreadable."""
+        telemetry = LLMTelemetry()
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                saved = json.load(file)
+            telemetry.cache_hits.update(saved.get("cache_hits", {}))
+            # Older files recorded the cache hits among the calls
+            for record in saved["calls"]:
+                if record.pop("cached", False):
+                    telemetry.cache_hits[record["model"]] += 1
+                else:
+                    telemetry.records.append(record)
+        except (OSError, json.JSONDecodeError, KeyError):
+            pass
+        return telemetry
+
+    def __len__(self):
+        return len(self.records) + sum(self.cache_hits.values())
+
+
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+
+class TestLLMTelemetry(unittest.TestCase):
+    @staticmethod
+    def answer(latency, number_tokens=10, cached=False, failure=None):
+        return SimpleNamespace(prompt_tokens=100, number_tokens=number_tokens, time_to_first_token=latency / 2,
+                               queue_time=0.0, retry_time=0.0, latency=latency, cached=cached, failure=failure)
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles(list(range(1, 101))), {"p50": 50.5, "p95": 95.05, "p99": 99.01})
+        self.assertEqual(percentiles([]), {"p50": None, "p95": None, "p99": None})
+
+    def test_summary_counts_cache_hits_apart(self):
+        telemetry = LLMTelemetry()
+        for latency in (1.0, 2.0, 3.0):
+            telemetry.record("model", self.answer(latency))
+        telemetry.record("model", self.answer(0.0, cached=True))
+        telemetry.record("model", self.answer(9.0, number_tokens=0, failure={"reason": "parse"}))
+        telemetry.record("other", self.answer(4.0), batch_size=2)
+
+        telemetry.record("cached only", self.answer(0.0, cached=True))
+
+        summary = telemetry.summary()
+        self.assertEqual(list(summary), ["model", "other", "cached only"])
+        self.assertEqual((summary["model"]["requests"], summary["model"]["cache_hits"], summary["model"]["failed"]),
+                         (4, 1, 1))
+        self.assertEqual((summary["cached only"]["requests"], summary["cached only"]["cache_hits"]), (0, 1))
+        self.assertEqual(summary["model"]["latency"]["p50"], 2.0)
+        self.assertEqual(summary["model"]["time_to_first_token"]["p50"], 1.0)
+        self.assertEqual(summary["model"]["tokens_per_second"], 5.0)
+        self.assertEqual(summary["model"]["prompt_tokens"], 400)
+
+    def test_save_and_load(self):
+        telemetry = LLMTelemetry()
+        telemetry.record("model", self.answer(1.0))
+        telemetry.record("model", self.answer(0.0, cached=True))
+        with tempfile.TemporaryDirectory() as directory:
+            path = telemetry_path(f"{directory}/results.jsonl")
+            self.assertEqual(path.name, "results_telemetry.json")
+            telemetry.save(path)
+            loaded = LLMTelemetry.load(path)
+            self.assertEqual((loaded.records, loaded.cache_hits), (telemetry.records, telemetry.cache_hits))
+            self.assertEqual(len(LLMTelemetry.load(f"{directory}/missing.json")), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
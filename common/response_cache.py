@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Dict
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of LLM responses.
+
+    Every entry is a small JSON file named after the hash of everything that determines the response
+    (backend, model, options, system and user prompts). When the total size of the entries exceeds
+    `max_size_bytes`, the least recently used ones are deleted.
+    """
+
+    DEFAULT_MAX_SIZE_BYTES = 512 * 1024 * 1024
+
+    def __init__(self, directory: str, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # path -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for root, _, files in os.walk(directory):
+            for file in files:
+                if file.endswith(".json"):
+                    stat = os.stat(os.path.join(root, file))
+                    existing.append((stat.st_mtime, os.path.join(root, file), stat.st_size))
+        for _, path, size in sorted(existing):
+            self._entries[path] = size
+        self._size = sum(self._entries.values())
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Hash of the JSON serialization of the given parts (dictionaries are serialized with sorted keys)."""
+        serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Dict | None:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                value = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used, also for the next runs
+        os.utime(path)
+        if path in self._entries:
+            self._entries.move_to_end(path)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Dict):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(value, file, ensure_ascii=False)
+        os.replace(temporary_path, path)
+
+        self._size -= self._entries.pop(path, 0)
+        self._entries[path] = os.path.getsize(path)
+        self._size += self._entries[path]
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"ResponseCache(directory={self.directory}, entries={len(self)}, size={self._size} bytes)"
+
+
+import tempfile
+import unittest
+
+
+class TestResponseCache(unittest.TestCase):
+    VALUE = {"generated_response": "```json\n{\"eligible\": true}\n```", "generated_answer": {"eligible": True},
+             "number_tokens": 5}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_key_ignores_dictionary_order(self):
+        self.assertEqual(ResponseCache.key("ollama", {"temperature": 0, "seed": 1}),
+                         ResponseCache.key("ollama", {"seed": 1, "temperature": 0}))
+        self.assertNotEqual(ResponseCache.key("ollama", "prompt"), ResponseCache.key("openai", "prompt"))
+
+    def test_hits_and_misses(self):
+        cache = ResponseCache(self.directory.name)
+        self.assertIsNone(cache.get("a" * 64))
+        cache.put("a" * 64, self.VALUE)
+        self.assertEqual(cache.get("a" * 64), self.VALUE)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_eviction(self):
+        entry_size = len(json.dumps(self.VALUE, ensure_ascii=False).encode("utf-8"))
+        cache = ResponseCache(self.directory.name, max_size_bytes=2 * entry_size)
+        cache.put("a" * 64, self.VALUE)
+        cache.put("b" * 64, self.VALUE)
+        # Reading the first entry makes the second one the least recently used
+        cache.get("a" * 64)
+        cache.put("c" * 64, self.VALUE)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b" * 64))
+        self.assertIsNotNone(cache.get("a" * 64))
+
+    def test_entries_reloaded(self):
+        ResponseCache(self.directory.name).put("a" * 64, self.VALUE)
+        cache = ResponseCache(self.directory.name)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("a" * 64), self.VALUE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import random
+from typing import Dict
+
+
+class RetryPolicy:
+    """
+    Bounded retry policy of the LLM calls.
+
+    Transport errors (exceptions, timeouts, incomplete responses) and parse failures (answers without a JSON block)
+    have separate attempt budgets. Both are retried after an exponential backoff with jitter, counted per kind.
+    """
+
+    def __init__(self,
+                 max_transport_attempts: int = 5,
+                 max_parse_attempts: int = 3,
+                 base_delay: float = 1.0,
+                 max_delay: float = 30.0,
+                 jitter: float = 0.5):
+        """
+        :param max_transport_attempts: Maximum number of failed requests before giving up on a case.
+        :param max_parse_attempts: Maximum number of unparsable answers before giving up on a case.
+        :param base_delay: Delay in seconds before the first retry, doubled on every next one.
+        :param max_delay: Upper bound of the delay in seconds.
+        :param jitter: Fraction of the delay that is randomized (0 for no jitter, 1 for "full jitter").
+        """
+        self.max_transport_attempts = max_transport_attempts
+        self.max_parse_attempts = max_parse_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def backoff(self, failures: int) -> float:
+        """Delay in seconds before retrying after the given number of failures of the same kind."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    @staticmethod
+    def from_config(config: Dict = None):
+        """Builds the policy from the optional "retry" section of a model configuration file."""
+        return RetryPolicy(**(config or {}))
+
+    def __repr__(self):
+        return (f"RetryPolicy(max_transport_attempts={self.max_transport_attempts}, "
+                f"max_parse_attempts={self.max_parse_attempts}, base_delay={self.base_delay}, "
+                f"max_delay={self.max_delay}, jitter={self.jitter})")
+
+
+import unittest
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_exponential_backoff(self):
+        policy = RetryPolicy(base_delay=1.0, max_delay=5.0, jitter=0)
+        self.assertEqual([policy.backoff(failures) for failures in range(1, 6)], [1.0, 2.0, 4.0, 5.0, 5.0])
+
+    def test_jitter_bounds(self):
+        policy = RetryPolicy(base_delay=2.0, jitter=0.5)
+        delays = [policy.backoff(2) for _ in range(100)]
+        self.assertTrue(all(2.0 <= delay <= 4.0 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_from_config(self):
+        policy = RetryPolicy.from_config({"max_transport_attempts": 2, "jitter": 0})
+        self.assertEqual((policy.max_transport_attempts, policy.max_parse_attempts, policy.jitter), (2, 3, 0))
+        self.assertEqual(repr(RetryPolicy.from_config(None)), repr(RetryPolicy()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,8 @@
 import http.client
 import json
 import os
+import threading
+import time
 
 DEFAULT_PARAMETERS = {
     "decoding_method": "sample",
@@ -9,18 +11,95 @@ DEFAULT_PARAMETERS = {
     "temperature": 0.7
 }
 DEFAULT_URL = "https://us-south.ml.cloud.ibm.com"
+IAM_URL = "iam.cloud.ibm.com"
+# A token is refreshed when less than this many seconds (or 10% of its lifetime) are left before it expires
+DEFAULT_REFRESH_AHEAD = 300
 
 
-def get_token() -> str:
-    ibm_cloud__iam_url = "iam.cloud.ibm.com"
+class IAMTokenCache:
+    """
+    IBM Cloud IAM access token of an API key, fetched once and reused until shortly before it expires
+    (according to the `expires_in` of the IAM response). The token requests share one keep-alive HTTPS connection.
+    """
 
-    IBM_KEY = os.getenv("IBM_API_KEY")
+    def __init__(self, api_key: str = None, refresh_ahead: float = DEFAULT_REFRESH_AHEAD, iam_url: str = IAM_URL):
+        self.api_key = api_key
+        self.refresh_ahead = refresh_ahead
+        self.iam_url = iam_url
+        self.token = None
+        self.refresh_time = 0.0
+        self.expiration_time = 0.0
+        self._connection = None
+        self._lock = threading.Lock()
 
-    conn_ibm_cloud_iam = http.client.HTTPSConnection(ibm_cloud__iam_url)
-    payload = "grant_type=urn%3Aibm%3Aparams%3Aoauth%3Agrant-type%3Aapikey&apikey=" + IBM_KEY
-    headers = { 'Content-Type': "application/x-www-form-urlencoded" }
-    conn_ibm_cloud_iam.request("POST", "/identity/token", payload, headers)
-    res = conn_ibm_cloud_iam.getresponse()
-    data = res.read()
-    decoded_json = json.loads(data.decode("utf-8"))
-    return decoded_json["access_token"]
+    def _request_token(self) -> dict:
+        payload = "grant_type=urn%3Aibm%3Aparams%3Aoauth%3Agrant-type%3Aapikey&apikey=" + (self.api_key or os.getenv("IBM_API_KEY"))
+        headers = { 'Content-Type': "application/x-www-form-urlencoded" }
+        # A kept-alive connection may have been closed by the server since the last refresh, retry once on a new one
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = http.client.HTTPSConnection(self.iam_url)
+            try:
+                self._connection.request("POST", "/identity/token", payload, headers)
+                res = self._connection.getresponse()
+                data = res.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self._connection.close()
+                self._connection = None
+                if attempt:
+                    raise
+        decoded_json = json.loads(data.decode("utf-8"))
+        if "access_token" not in decoded_json:
+            raise Exception("IAM token request failed: " + str(decoded_json))
+        return decoded_json
+
+    def get(self) -> str:
+        with self._lock:
+            now = time.time()
+            if self.token is None or now >= self.refresh_time:
+                decoded_json = self._request_token()
+                expires_in = decoded_json.get("expires_in", 3600)
+                self.token = decoded_json["access_token"]
+                self.expiration_time = now + expires_in
+                self.refresh_time = self.expiration_time - max(self.refresh_ahead, expires_in / 10)
+            return self.token
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+_token_caches = {}
+
+
+def get_token(api_key: str = None) -> str:
+    """The IAM access token of the api key (default: the IBM_API_KEY environment variable), cached until close to its expiry."""
+    api_key = api_key or os.getenv("IBM_API_KEY")
+    if api_key not in _token_caches:
+        _token_caches[api_key] = IAMTokenCache(api_key)
+    return _token_caches[api_key].get()
+
+
+import unittest
+from unittest import mock
+
+
+class TestIAMTokenCache(unittest.TestCase):
+
+    def test_token_reused_until_refresh_ahead_of_expiry(self):
+        cache = IAMTokenCache("key", refresh_ahead=300)
+        responses = [{"access_token": "first", "expires_in": 3600}, {"access_token": "second", "expires_in": 3600}]
+        with mock.patch.object(cache, "_request_token", side_effect=responses) as request_token, \
+                mock.patch("time.time", return_value=1000.0) as now:
+            self.assertEqual(cache.get(), "first")
+            now.return_value = 1000.0 + 3600 - 361
+            self.assertEqual(cache.get(), "first")
+            now.return_value = 1000.0 + 3600 - 359
+            self.assertEqual(cache.get(), "second")
+        self.assertEqual(request_token.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 import sys
 import os
 import random
+import json
 from datetime import date, timedelta
 import pandas as pd
 from typing import List, Dict, Tuple
@@ -10,7 +11,8 @@ from insurance.insurance_compliance.insurance_policy import CarInsurancePolicy
 # Append the path to import the abstract class and compliance checker
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
-from common.generic_data_generator import DataGenerator
+from common.evaluation_context import EvaluationContext
+from common.generic_data_generator import DataGenerator, data_generator_parser, write_test_datasets
 from insurance.insurance_compliance.insurance_request import CarInsuranceRequest, Vehicle, Applicant, DrivingLicense
 
 class CarInsuranceDataGenerator(DataGenerator):
@@ -21,12 +23,19 @@ class CarInsuranceDataGenerator(DataGenerator):
         ]
 
     EVAL_COLUMN_NAMES = ["eligible", "premium_fee", "reason"]
+    NESTED_COLUMNS = ["applicants", "vehicle"]
 
-    def __init__(self):
-        super().__init__(CarInsurancePolicy())
+    def __init__(self, reference_date: date = None, date_ordinals: bool = False):
+        """
+        :param reference_date: The day the requests are generated for and labelled at, today if not given.
+        :param date_ordinals: Whether the dates are stored as date ordinals (pre-parsed) instead of ISO strings.
+        """
+        self.context = EvaluationContext(reference_date)
+        self.date_ordinals = date_ordinals
+        super().__init__(CarInsurancePolicy(self.context))
 
     def generate_eligible_case(self) -> Dict:
-        today = date.today()
+        today = self.context.reference_date
         num_applicants = random.randint(1, 3)
         applicants = []
 
@@ -74,16 +83,10 @@ class CarInsuranceDataGenerator(DataGenerator):
             state_min_liability=50000
         )
 
-        eligible, premium_fee, reason = self.determine_eligibility(case)
-        csv = case.to_dict()
-        csv["eligible"] = eligible
-        csv["premium_fee"] = premium_fee
-        csv["reason"] = reason
-
-        return csv
+        return self.labelled_case(case)
 
     def generate_non_eligible_case(self) -> Dict:
-        today = date.today()
+        today = self.context.reference_date
         reason_type = random.choice([
             "no_primary_applicant",
             "age_too_young",
@@ -201,24 +204,45 @@ class CarInsuranceDataGenerator(DataGenerator):
             state_min_liability=50000
         )
 
+        return self.labelled_case(case)
+
+    def labelled_case(self, case: CarInsuranceRequest) -> Dict:
+        """The dataset row of an insurance request, with the results of the policy."""
         eligible, premium_fee, reason = self.determine_eligibility(case)
 
         csv = case.to_dict()
+        if self.date_ordinals:
+            vehicle = case.vehicle.to_dict()
+            vehicle["registered_on"] = self.applicant_ordinals(vehicle["registered_on"])
+            vehicle["date_creation"] = self.ordinal(vehicle["date_creation"])
+            csv["applicants"] = json.dumps([self.applicant_ordinals(applicant.to_dict())
+                                            for applicant in case.applicants])
+            csv["vehicle"] = json.dumps(vehicle)
         csv["eligible"] = eligible
         csv["premium_fee"] = premium_fee
         csv["reason"] = reason
 
         return csv
 
+    def applicant_ordinals(self, applicant: Dict) -> Dict:
+        """An applicant dictionary (see Applicant.to_dict) with all its dates as date ordinals."""
+        driving_license = dict(applicant["driving_license"])
+        driving_license["issue_date"] = self.ordinal(driving_license["issue_date"])
+        driving_license["expiration_date"] = self.ordinal(driving_license["expiration_date"])
+        driving_license["status_history"] = [dict(record, date=self.ordinal(record.get("date")))
+                                             for record in driving_license["status_history"]]
+        return dict(applicant,
+                    birth_date=self.ordinal(applicant["birth_date"]),
+                    driving_license=driving_license,
+                    driving_history=[dict(violation, date=self.ordinal(violation.get("date")))
+                                     for violation in applicant["driving_history"]])
+
+    def ordinal(self, value):
+        """The date ordinal of an ISO date string, None if missing."""
+        return self.context.ordinal(value) if value else None
 
-from common.generic_data_generator import format_data_units
 
 # paste this in the end of {policy_name}_data_generator.py file
 if __name__ == "__main__":
-    sizes = [100, 1000]
-    generator = CarInsuranceDataGenerator()
-
-    for size in sizes:
-        df = generator.generate_test_dataset(size)
-        data_units = format_data_units(size)
-        df.to_csv(f'insurance_test_dataset_{data_units}.csv', index=False)
\ No newline at end of file
+    args = data_generator_parser(reference_date=True).parse_args()
+    write_test_datasets(CarInsuranceDataGenerator(args.reference_date, args.date_ordinals), 'insurance_test_dataset_{size}.{format}', args)
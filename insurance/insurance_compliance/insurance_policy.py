@@ -4,11 +4,15 @@ import unittest
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 from common.abstract_policy import Policy
+from common.evaluation_context import EvaluationContext
 
 from datetime import date, timedelta
-from typing import Tuple
+from typing import Dict, List, Tuple
+
+import numpy as np
+
 from insurance.insurance_compliance.insurance_request import CarInsuranceRequest, Vehicle, Applicant, \
-    DrivingLicense
+    DrivingLicense, CarInsuranceRequestBatch
 
 
 class CarInsurancePolicy(Policy):
@@ -18,6 +22,33 @@ class CarInsurancePolicy(Policy):
 
     MINIMUM_CREDIT_SCORE = 500
     CREDIT_SCORE_FEE_THRESHOLD = 650
+    MAJOR_VIOLATIONS = ["DUI", "reckless driving"]
+    DISQUALIFYING_LICENSE_STATUSES = ["suspended", "revoked"]
+
+    # Reasons of the rejections, in the order of the checks; their index is the reason code of evaluate_batch
+    REJECTION_REASONS = [
+        "No primary applicant found.",
+        "Primary policyholder must be at least 18 years old.",
+        "Applicants over 75 may require additional medical assessments.",
+        "All applicants must have a valid driver’s license.",
+        "All applicants must have an up-to-date driver’s license.",
+        "International drivers must provide additional documentation or proof of driving history.",
+        "The vehicle must be registered in the name of the applicant or an immediate family member.",
+        "The vehicle must be used primarily for personal use.",
+        "The vehicle must pass required safety inspections.",
+        "The vehicle older than 20 years cannot be covered",
+        "Major violations impact eligibility.",
+        "Too many minor violations in the last five years.",
+        "Recent license suspensions or revocations result in disqualification.",
+        "Lapses in prior insurance coverage may impact eligibility.",
+        "A history of insurance fraud may impact eligibility.",
+        "Frequent insurance claims may impact eligibility.",
+        "Policy cancellations due to non-payment may impact eligibility.",
+        "All applicants must reside in the country and state where the policy is issued.",
+        "Coverage must meet the state's minimum liability requirements.",
+        "Poor credit score impacts eligibility.",
+    ]
+    APPROVED = -1
 
     def check_address_validity(self, address: dict) -> bool:
         # OTHER checks
@@ -33,9 +64,10 @@ class CarInsurancePolicy(Policy):
         if not primary_applicant:
             return False, None, "No primary applicant found."
 
-        today_date = date.today()
+        context = self.evaluation_context()
+        today_date = context.reference_date
         # Check applicant age
-        age = (today_date - primary_applicant.birth_date).days // 365
+        age = context.age_in_years(primary_applicant.birth_date)
         if age < 18:
             return False, None, "Primary policyholder must be at least 18 years old."
         if age >= 75:
@@ -70,13 +102,13 @@ class CarInsurancePolicy(Policy):
         if not case.vehicle.passed_safety_inspections:
             return False, None, "The vehicle must pass required safety inspections."
 
-        # Check the vehicles age
-        if (today_date - case.vehicle.date_creation).days // 365 > 20:
+        # Check the vehicles age (older than 20 whole years, i.e. created at least 21 years ago)
+        if case.vehicle.date_creation.toordinal() <= context.years_ago(21):
             return False, None, "The vehicle older than 20 years cannot be covered"
 
         # Check driving record
         violation_threshold = 3
-        violation_timeframe = today_date - timedelta(days=5 * 365)
+        violation_timeframe = context.years_ago(5)
 
         overall_minor_violations = 0
 
@@ -85,7 +117,7 @@ class CarInsurancePolicy(Policy):
 
             for violation in applicant.driving_history:
                 violation_date = violation.get("date")
-                if violation_date and date.fromisoformat(violation_date) >= violation_timeframe:
+                if violation_date and context.ordinal(violation_date) >= violation_timeframe:
                     if violation.get("type") in ["DUI", "reckless driving"]:
                         return False, None, "Major violations impact eligibility."
                     else:
@@ -97,7 +129,7 @@ class CarInsurancePolicy(Policy):
             for status_record in applicant.driving_license.status_history:
                 if status_record.get("status") in ["suspended", "revoked"]:
                     status_date = status_record.get("date")
-                    if status_date and date.fromisoformat(status_date) >= violation_timeframe:
+                    if status_date and context.ordinal(status_date) >= violation_timeframe:
                         return (False, None,
                                 "Recent license suspensions or revocations result in disqualification.")
             overall_minor_violations += minor_violations
@@ -144,6 +176,150 @@ class CarInsurancePolicy(Policy):
 
         return True, round(premium_fee, 2), ""
 
+    def test_eligibility_batch(self, frame) -> List[Tuple]:
+        """
+        Columnar version of `test_eligibility`: the requests of the frame (or CarInsuranceRequestBatch) are exploded
+        into applicant, violation, status and coverage tables, evaluated at once by evaluate_batch, and each request
+        gets the reason of the first check it fails, or its premium.
+        """
+        batch = frame if isinstance(frame, CarInsuranceRequestBatch) else CarInsuranceRequestBatch.from_frame(frame)
+        reason_codes, premiums = self.evaluate_batch(batch, self.evaluation_context())
+
+        return [
+            (True, round(premium, 2), "") if code == self.APPROVED else (False, None, self.REJECTION_REASONS[code])
+            for code, premium in zip(reason_codes.tolist(), premiums.tolist())
+        ]
+
+    def evaluate_batch(self, batch: CarInsuranceRequestBatch,
+                       context: EvaluationContext = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Evaluates the checks of `test_eligibility` over the tables of a batch.
+
+        The rules over records are grouped aggregations per applicant (e.g. the minor violations of the last five
+        years, or the claims, of every applicant). As test_eligibility runs some groups of checks applicant by
+        applicant, such a group fails with the first failing check of the first failing applicant of the request.
+
+        :param batch: The exploded requests.
+        :param context: The reference date of the age and time window checks, evaluation_context() if not given.
+        :return: The reason code of every request, i.e. the index in REJECTION_REASONS of the first failed check
+                 (APPROVED if none), and the premium fee of every request, not rounded (only meaningful for the
+                 approved ones).
+        """
+        context = context or self.evaluation_context()
+        requests, applicants = batch.requests, batch.applicants
+        num_requests, num_applicants = len(batch), len(applicants["request"])
+        request_of = applicants["request"]
+        passed = len(self.REJECTION_REASONS)
+        code = self.REJECTION_REASONS.index
+
+        def any_per_request(mask: np.ndarray) -> np.ndarray:
+            return np.bincount(request_of[mask], minlength=num_requests) > 0
+
+        def per_applicant(table: Dict[str, np.ndarray], mask: np.ndarray) -> np.ndarray:
+            return np.bincount(table["applicant"][mask], minlength=num_applicants)
+
+        # Primary applicant: the first applicant of the request holding the policy
+        primary = np.full(num_requests, num_applicants)
+        holders = np.flatnonzero(applicants["is_primary_holder"])
+        np.minimum.at(primary, request_of[holders], holders)
+        has_primary = primary < num_applicants
+        birth_date = np.zeros(num_requests, dtype=np.int64)
+        birth_date[has_primary] = applicants["birth_date"][primary[has_primary]]
+        age = (context.reference_ordinal - birth_date) // 365
+
+        # Driving record: violations and license status records of the last five years
+        violation_timeframe = context.years_ago(5)
+        violations, status_records = batch.violations, batch.status_records
+        recent = violations["date"] >= violation_timeframe
+        major = recent & self._isin(violations["type"], self.MAJOR_VIOLATIONS)
+        minor_violations = per_applicant(violations, recent & ~major)
+        recent_disqualification = per_applicant(status_records, (status_records["date"] >= violation_timeframe) &
+                                                self._isin(status_records["status"],
+                                                           self.DISQUALIFYING_LICENSE_STATUSES)) > 0
+
+        coverages, credit_score = batch.coverages, applicants["credit_score"]
+
+        reasons = [
+            np.where(has_primary, passed, code("No primary applicant found.")),
+            np.where(has_primary & (age < 18), code("Primary policyholder must be at least 18 years old."), passed),
+            np.where(has_primary & (age >= 75),
+                     code("Applicants over 75 may require additional medical assessments."), passed),
+            self._first_failing_applicant(request_of, num_requests, [
+                applicants["license_status"] != "valid",
+                applicants["license_issue_date"] > context.reference_ordinal,
+                ~self._isin(applicants["license_issue_country"], self.LOCAL_COUNTRIES_ABBREVIATIONS)
+                & ~applicants["has_driving_history"],
+            ], code("All applicants must have a valid driver’s license.")),
+            np.where(requests["registered_to_applicant"], passed, code(
+                "The vehicle must be registered in the name of the applicant or an immediate family member.")),
+            np.where(requests["vehicle_use"] != "personal",
+                     code("The vehicle must be used primarily for personal use."), passed),
+            np.where(requests["passed_safety_inspections"], passed,
+                     code("The vehicle must pass required safety inspections.")),
+            np.where(requests["vehicle_date_creation"] <= context.years_ago(21),
+                     code("The vehicle older than 20 years cannot be covered"), passed),
+            self._first_failing_applicant(request_of, num_requests, [
+                per_applicant(violations, major) > 0,
+                minor_violations >= 3,
+                recent_disqualification,
+            ], code("Major violations impact eligibility.")),
+            self._first_failing_applicant(request_of, num_requests, [
+                per_applicant(coverages, coverages["lapse"]) > 0,
+                per_applicant(coverages, coverages["fraud"]) > 0,
+                per_applicant(coverages, coverages["claims"]) > 3,
+                per_applicant(coverages, coverages["non_payment"]) > 0,
+            ], code("Lapses in prior insurance coverage may impact eligibility.")),
+            np.where(any_per_request(~(applicants["has_address"]
+                                       & self._isin(applicants["country"], self.LOCAL_COUNTRIES_ABBREVIATIONS)
+                                       & self._isin(applicants["state"], self.STATES))),
+                     code("All applicants must reside in the country and state where the policy is issued."), passed),
+            np.where(requests["liability_coverage"] < requests["state_min_liability"],
+                     code("Coverage must meet the state's minimum liability requirements."), passed),
+            np.where(any_per_request(credit_score < self.MINIMUM_CREDIT_SCORE),
+                     code("Poor credit score impacts eligibility."), passed),
+        ]
+        # The checks are in the order of the reason codes: the first failed one has the lowest code
+        reason_codes = np.minimum.reduce(reasons)
+        reason_codes = np.where(reason_codes == passed, self.APPROVED, reason_codes)
+
+        # Premium, accumulated in the same order as test_eligibility for the same floating point results
+        overall_minor_violations = np.bincount(request_of, weights=minor_violations,
+                                               minlength=num_requests).astype(np.int64)
+        low_credit_scores = np.bincount(request_of[credit_score < self.CREDIT_SCORE_FEE_THRESHOLD],
+                                        minlength=num_requests)
+        premium_multiplier = 1.0 + np.where(age < 25, 0.2, 0.0)
+        premium_multiplier += np.where(overall_minor_violations >= 3, overall_minor_violations * 0.05, 0.0)
+        for count in range(low_credit_scores.max(initial=0)):
+            premium_multiplier = np.where(low_credit_scores > count, premium_multiplier + 0.1, premium_multiplier)
+
+        return reason_codes, 1000 * premium_multiplier
+
+    @staticmethod
+    def _isin(values: np.ndarray, options: List[str]) -> np.ndarray:
+        """Element-wise membership of object arrays, which may hold None."""
+        return np.logical_or.reduce([values == option for option in options] + [np.zeros(len(values), dtype=bool)])
+
+    @staticmethod
+    def _first_failing_applicant(request_of: np.ndarray, num_requests: int, checks: List[np.ndarray],
+                                 first_code: int) -> np.ndarray:
+        """
+        Reduces checks run applicant by applicant to one reason code per request: the code of the first check failed
+        by the first failing applicant of the request, len(REJECTION_REASONS) if none fails.
+
+        :param checks: The failures of every applicant, one mask per check, the checks having consecutive reason
+                       codes starting at first_code.
+        """
+        passed = len(CarInsurancePolicy.REJECTION_REASONS)
+        applicant_codes = np.full(len(request_of), passed)
+        for index, failed in reversed(list(enumerate(checks))):
+            applicant_codes = np.where(failed, first_code + index, applicant_codes)
+
+        failing = np.flatnonzero(applicant_codes < passed)
+        # Ordered by applicant row, i.e. by request then by position of the applicant in the request
+        first = np.full(num_requests, np.iinfo(np.int64).max)
+        np.minimum.at(first, request_of[failing], failing * (passed + 1) + applicant_codes[failing])
+        return np.where(first == np.iinfo(np.int64).max, passed, first % (passed + 1))
+
 
 class TestCarInsuranceCompliance(unittest.TestCase):
 
@@ -391,6 +567,74 @@ class TestCarInsuranceCompliance(unittest.TestCase):
         self.assertTrue(result)
         self.assertEqual(fee, 1150)
 
+    def test_fixed_evaluation_context(self):
+        window_start = self.today - timedelta(days=5 * 365)
+        history = [{"type": "DUI", "date": window_start.isoformat()}]
+        applicant = self.create_applicant(40, driving_history=history)
+        case = CarInsuranceRequest([applicant], self.create_vehicle(applicant, 20), 50000, 30000)
+
+        self.assertEqual(self.compliance.test_eligibility(case)[2], "Major violations impact eligibility.")
+        # A day later, the violation is out of the five years window
+        later = CarInsurancePolicy(EvaluationContext(self.today + timedelta(days=1)))
+        self.assertTrue(later.test_eligibility(case)[0])
+
+    def test_dates_as_ordinals(self):
+        applicant = self.create_applicant(40, driving_history=[
+            {"type": "Speeding", "date": (self.today - timedelta(days=180)).toordinal()} for _ in range(3)])
+        case = CarInsuranceRequest([applicant], self.create_vehicle(applicant, 5), 50000, 30000)
+        data = case.to_dict()
+        data["applicants"] = [dict(applicant.to_dict(), birth_date=applicant.birth_date.toordinal())
+                              for applicant in case.applicants]
+        self.assertEqual(self.compliance.test_eligibility(data)[2], "Too many minor violations in the last five years.")
+
+    def test_batch_first_failing_applicant(self):
+        # The first applicant fails a later check than the second one: its reason wins, as in test_eligibility
+        claims = [{"claims": 1} for _ in range(4)]
+        applicant1 = self.create_applicant(40, insurance_history=claims)
+        applicant2 = self.create_applicant(40, insurance_history=[{"lapse": True}], is_primary_holder=False)
+        requests = [CarInsuranceRequest([applicant1, applicant2], self.create_vehicle(applicant1, 5), 50000, 30000),
+                    CarInsuranceRequest([applicant2, applicant1], self.create_vehicle(applicant1, 5), 50000, 30000)]
+        results = self.compliance.test_eligibility_batch(CarInsuranceRequestBatch.from_requests(requests))
+        self.assertEqual([reason for _, _, reason in results],
+                         ["Frequent insurance claims may impact eligibility.",
+                          "Lapses in prior insurance coverage may impact eligibility."])
+        self.assertEqual(results, [self.compliance.test_eligibility(request) for request in requests])
+
+    def test_batch_matches_scalar(self):
+        import pandas as pd
+
+        applicant = self.create_applicant(22, credit_score=600, driving_history=[
+            {"type": "speeding", "date": (self.today - timedelta(days=100 * days)).isoformat()} for days in range(1, 5)])
+        other = self.create_applicant(40, is_primary_holder=False, driving_history=[
+            {"type": "speeding", "date": (self.today - timedelta(days=400)).isoformat()}])
+        requests = [
+            CarInsuranceRequest([applicant, other], self.create_vehicle(applicant, 5), 50000, 30000),
+            CarInsuranceRequest([other], self.create_vehicle(other, 5), 50000, 30000),
+            CarInsuranceRequest([self.create_applicant(17)], self.create_vehicle(other, 21, use="commercial"), 1, 2),
+            CarInsuranceRequest([self.create_applicant(30, issue_country="fr")], self.create_vehicle(other, 21), 1, 2),
+            CarInsuranceRequest([self.create_applicant(30, driving_history=[
+                {"type": "DUI", "date": (self.today - timedelta(days=10)).isoformat()}])], None, 50000, 30000),
+            # Two recent minor violations of the primary applicant and one of the other one: approved, with a fee
+            CarInsuranceRequest([self.create_applicant(22, credit_score=600, driving_history=[
+                {"type": "speeding", "date": (self.today - timedelta(days=100 * days)).isoformat()}
+                for days in range(1, 3)]), other], None, 50000, 30000),
+        ]
+        for request in requests[3:]:
+            request.vehicle = self.create_vehicle(request.applicants[0], 5)
+
+        expected = [self.compliance.test_eligibility(request) for request in requests]
+        frame = pd.DataFrame([request.to_dict() for request in requests])
+        self.assertEqual(expected, self.compliance.test_eligibility_batch(frame))
+        self.assertEqual(expected, self.compliance.test_eligibility_batch(CarInsuranceRequestBatch.from_requests(requests)))
+        self.assertEqual(expected[-1], (True, 1450, ""))
+
+    def test_batch_matches_scalar_on_reference_dataset(self):
+        import pandas as pd
+
+        frame = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "insurance_test_dataset_1K.csv"))
+        expected = [self.compliance.test_eligibility(row) for row in frame.to_dict(orient="records")]
+        self.assertEqual(expected, self.compliance.test_eligibility_batch(frame))
+
 
 if __name__ == "__main__":
     unittest.main()
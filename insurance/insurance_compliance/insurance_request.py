@@ -1,9 +1,18 @@
+import os
+import sys
 import json
 import unittest
 from datetime import date
-from typing import List, Dict
+from functools import lru_cache
+from typing import List, Dict, Iterable, Tuple
 import csv
 
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+from common.evaluation_context import as_date
+from common.json_columns import decode_json_cells
+
 
 class DrivingLicense:
     def __init__(self,
@@ -31,8 +40,8 @@ class DrivingLicense:
     def from_dict(data: dict):
         return DrivingLicense(
             status=data.get("status"),
-            issue_date=date.fromisoformat(data["issue_date"]) if data.get("issue_date") else None,
-            expiration_date=date.fromisoformat(data["expiration_date"]) if data.get("expiration_date") else None,
+            issue_date=as_date(data["issue_date"]) if data.get("issue_date") else None,
+            expiration_date=as_date(data["expiration_date"]) if data.get("expiration_date") else None,
             status_history=data.get("status_history", []),
             issue_country=data.get("issue_country", "us")
         )
@@ -109,7 +118,7 @@ class Applicant:
     @staticmethod
     def from_dict(data: dict):
         return Applicant(
-            birth_date=date.fromisoformat(data["birth_date"]) if data.get("birth_date") else None,
+            birth_date=as_date(data["birth_date"]) if data.get("birth_date") else None,
             driving_license=DrivingLicense.from_dict(data["driving_license"]) if data.get("driving_license") else None,
             family_members=data.get("family_members", []),
             driving_history=data.get("driving_history", []),
@@ -177,7 +186,7 @@ class Vehicle:
             registered_on=Applicant.from_dict(data["registered_on"]),
             vehicle_use=data.get("vehicle_use", "personal"),
             passed_safety_inspections=data.get("passed_safety_inspections", False),
-            date_creation=date.fromisoformat(data["date_creation"]) if data.get("date_creation") else None,
+            date_creation=as_date(data["date_creation"]) if data.get("date_creation") else None,
             vehicle_type=data.get("vehicle_type", "normal")
         )
 
@@ -228,8 +237,8 @@ class CarInsuranceRequest:
     @staticmethod
     def from_dict(data: dict):
         return CarInsuranceRequest(
-            applicants=[Applicant.from_dict(a) for a in json.loads(data["applicants"])],
-            vehicle=Vehicle.from_dict(json.loads(data["vehicle"])),
+            applicants=[Applicant.from_dict(a) for a in (json.loads(data["applicants"]) if isinstance(data["applicants"], str) else data["applicants"])],
+            vehicle=Vehicle.from_dict(json.loads(data["vehicle"]) if isinstance(data["vehicle"], str) else data["vehicle"]),
             liability_coverage=float(data["liability_coverage"]),
             state_min_liability=float(data["state_min_liability"])
         )
@@ -256,6 +265,167 @@ class CarInsuranceRequest:
         return json.dumps(self.to_dict(), indent=2)
 
 
+class CarInsuranceRequestBatch:
+    """
+    Car insurance requests exploded into flat tables of NumPy arrays, one row per request, per applicant, per
+    driving history violation, per license status record and per insurance coverage record. The rows of a child
+    table point to their applicant row ("applicant"), and the applicant rows to their request ("request"), in the
+    order of the requests and of their collections. Dates are stored as date ordinals (0 if missing), the countries
+    and states of the applicants in lower case; "registered_to_applicant" tells whether the vehicle is registered on
+    one of the applicants (or of their family members).
+    """
+    REQUEST_FIELDS = {
+        "liability_coverage": float,
+        "state_min_liability": float,
+        "vehicle_use": object,
+        "passed_safety_inspections": bool,
+        "vehicle_date_creation": np.int64,
+        "registered_to_applicant": bool,
+    }
+    APPLICANT_FIELDS = {
+        "request": np.int64,
+        "is_primary_holder": bool,
+        "birth_date": np.int64,
+        "credit_score": float,
+        "license_status": object,
+        "license_issue_date": np.int64,
+        "license_issue_country": object,
+        "has_driving_history": bool,
+        "has_address": bool,
+        "country": object,
+        "state": object,
+    }
+    VIOLATION_FIELDS = {"applicant": np.int64, "type": object, "date": np.int64}
+    STATUS_RECORD_FIELDS = {"applicant": np.int64, "status": object, "date": np.int64}
+    COVERAGE_FIELDS = {"applicant": np.int64, "lapse": bool, "fraud": bool, "claims": bool, "non_payment": bool}
+    # Rows of a frame decoded at once by from_frame
+    DECODE_CHUNK_SIZE = 1000
+
+    def __init__(self, requests: Dict[str, np.ndarray], applicants: Dict[str, np.ndarray],
+                 violations: Dict[str, np.ndarray], status_records: Dict[str, np.ndarray],
+                 coverages: Dict[str, np.ndarray]):
+        self.requests = requests
+        self.applicants = applicants
+        self.violations = violations
+        self.status_records = status_records
+        self.coverages = coverages
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _iso_ordinal(value: str) -> int:
+        return date.fromisoformat(value).toordinal()
+
+    @staticmethod
+    def _ordinal(value) -> int:
+        """The ordinal of a date, ISO string or (pre-parsed) ordinal, 0 if missing."""
+        if not value:
+            return 0
+        if isinstance(value, int):
+            return value
+        if isinstance(value, date):
+            return value.toordinal()
+        return CarInsuranceRequestBatch._iso_ordinal(value)
+
+    @staticmethod
+    def _append(columns: Dict[str, List], *values):
+        # Appends a row to lists per field: unlike row tuples, they do not add objects for the garbage collector to scan
+        for column, value in zip(columns.values(), values):
+            column.append(value)
+
+    @staticmethod
+    def _explode(requests: Iterable[Tuple[float, float, dict, List[dict], bool]]) -> "CarInsuranceRequestBatch":
+        """
+        Builds the tables from requests given as (liability coverage, state minimum liability, vehicle, applicants,
+        registered to applicant), the vehicle and the applicants as dictionaries (see to_dict).
+        """
+        ordinal, append = CarInsuranceRequestBatch._ordinal, CarInsuranceRequestBatch._append
+        table_fields = [CarInsuranceRequestBatch.REQUEST_FIELDS, CarInsuranceRequestBatch.APPLICANT_FIELDS,
+                        CarInsuranceRequestBatch.VIOLATION_FIELDS, CarInsuranceRequestBatch.STATUS_RECORD_FIELDS,
+                        CarInsuranceRequestBatch.COVERAGE_FIELDS]
+        tables = [{field: [] for field in fields} for fields in table_fields]
+        request_table, applicant_table, violation_table, status_table, coverage_table = tables
+
+        for request_index, (liability_coverage, state_min_liability, vehicle, applicants,
+                            registered_to_applicant) in enumerate(requests):
+            append(request_table, float(liability_coverage), float(state_min_liability),
+                   vehicle.get("vehicle_use", "personal"), bool(vehicle.get("passed_safety_inspections", False)),
+                   ordinal(vehicle.get("date_creation")), registered_to_applicant)
+
+            for applicant in applicants:
+                applicant_index = len(applicant_table["request"])
+                driving_license = applicant.get("driving_license") or {"status": "invalid"}
+                driving_history = applicant.get("driving_history") or []
+                address = applicant.get("address") or {}
+                credit_score = applicant.get("credit_score")
+                append(applicant_table, request_index, bool(applicant.get("is_primary_holder", False)),
+                       ordinal(applicant.get("birth_date")), np.nan if credit_score is None else credit_score,
+                       driving_license.get("status"), ordinal(driving_license.get("issue_date")),
+                       str(driving_license.get("issue_country", "us") or "").lower(), bool(driving_history),
+                       bool(address), str(address.get("country") or "").lower(),
+                       str(address.get("state") or "").lower())
+                for violation in driving_history:
+                    append(violation_table, applicant_index, violation.get("type"), ordinal(violation.get("date")))
+                for record in driving_license.get("status_history") or []:
+                    append(status_table, applicant_index, record.get("status"), ordinal(record.get("date")))
+                for record in applicant.get("history_insurance_coverage") or []:
+                    append(coverage_table, applicant_index, bool(record.get("lapse")), bool(record.get("fraud")),
+                           bool(record.get("claims")), record.get("cancellation_reason") == "non-payment")
+
+        return CarInsuranceRequestBatch(*[{field: np.array(table[field], dtype=dtype) for field, dtype in fields.items()}
+                                          for table, fields in zip(tables, table_fields)])
+
+    @staticmethod
+    def from_requests(requests: List[CarInsuranceRequest]) -> "CarInsuranceRequestBatch":
+        """Explodes CarInsuranceRequests into the tables of a batch."""
+        return CarInsuranceRequestBatch._explode(
+            (request.liability_coverage, request.state_min_liability,
+             {"vehicle_use": request.vehicle.vehicle_use,
+              "passed_safety_inspections": request.vehicle.passed_safety_inspections,
+              "date_creation": request.vehicle.date_creation},
+             [applicant.to_dict() for applicant in request.applicants],
+             # Compares whole applicants, as the policy does
+             any(request.vehicle.registered_on == applicant or request.vehicle.registered_on in applicant.family_members
+                 for applicant in request.applicants))
+            for request in requests)
+
+    @staticmethod
+    def _registered_to_applicant(registered_on: dict, applicants: List[dict]) -> bool:
+        """
+        Whether the vehicle owner of a decoded request is one of its applicants, compared as Applicants, i.e. as
+        the dictionaries when equal and as Applicant objects otherwise. The family members decoded from JSON are
+        never Applicants, so that they never match.
+        """
+        if any(registered_on == applicant for applicant in applicants):
+            return True
+        owner = Applicant.from_dict(registered_on)
+        return any(owner == Applicant.from_dict(applicant) for applicant in applicants)
+
+    @staticmethod
+    def _decoded_requests(frame, chunk_size: int):
+        registered_to_applicant = CarInsuranceRequestBatch._registered_to_applicant
+        for start in range(0, len(frame), chunk_size):
+            chunk = frame.iloc[start:start + chunk_size]
+            for liability_coverage, state_min_liability, vehicle, applicants in zip(
+                    chunk["liability_coverage"], chunk["state_min_liability"],
+                    decode_json_cells(chunk["vehicle"]), decode_json_cells(chunk["applicants"])):
+                yield (liability_coverage, state_min_liability, vehicle, applicants,
+                       registered_to_applicant(vehicle["registered_on"], applicants))
+
+    @staticmethod
+    def from_frame(frame, chunk_size: int = None) -> "CarInsuranceRequestBatch":
+        """
+        Explodes the requests of a dataset frame into the tables of a batch, without building any request object.
+        The applicants and vehicle columns (JSON text or decoded objects) are decoded chunk_size rows at once: the
+        decoded objects of a chunk are released once exploded, instead of all being kept alive (and scanned by the
+        garbage collector) until the end.
+        """
+        return CarInsuranceRequestBatch._explode(CarInsuranceRequestBatch._decoded_requests(
+            frame, chunk_size or CarInsuranceRequestBatch.DECODE_CHUNK_SIZE))
+
+    def __len__(self):
+        return len(self.requests["liability_coverage"])
+
+
 class TestCarInsuranceRequest(unittest.TestCase):
 
     def setUp(self):
@@ -312,6 +482,24 @@ class TestCarInsuranceRequest(unittest.TestCase):
         self.assertIn('"liability_coverage": 100000', repr_output)
         self.assertIn('"state_min_liability": 50000', repr_output)
 
+    def test_batch_tables(self):
+        """Test the explosion of requests into the tables of a batch."""
+        applicant = Applicant(birth_date=date(1990, 6, 15), driving_license=self.license, credit_score=600,
+                              driving_history=[{"type": "DUI", "date": "2021-03-04"}, {"type": "speeding"}],
+                              history_insurance_coverage=[{"claims": 2, "cancellation_reason": "non-payment"}],
+                              address={"country": "US", "state": "Ohio"})
+        batch = CarInsuranceRequestBatch.from_requests([self.car_insurance_request,
+                                                        CarInsuranceRequest([self.applicants[0], applicant],
+                                                                            self.vehicle, 100000, 50000)])
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.applicants["request"].tolist(), [0, 1, 1])
+        self.assertEqual(batch.requests["registered_to_applicant"].tolist(), [True, True])
+        self.assertEqual(batch.applicants["state"].tolist(), ["", "", "ohio"])
+        self.assertEqual(batch.violations["applicant"].tolist(), [2, 2])
+        self.assertEqual(batch.violations["date"].tolist(), [date(2021, 3, 4).toordinal(), 0])
+        self.assertEqual(batch.coverages["non_payment"].tolist(), [True])
+        self.assertEqual(len(batch.status_records["applicant"]), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,25 +6,33 @@ import json
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
-from common.generic_data_generator import DataGenerator, format_data_units
+from common.evaluation_context import EvaluationContext
+from common.generic_data_generator import DataGenerator, data_generator_parser, write_test_datasets
 from loan_policy import LoanApprovalPolicy
-from loan.loan_compliance.loan_request import LoanRequest, Applicant
+from loan.loan_compliance.loan_request import LoanRequest, Applicant, LoanRequestBatch
 
 
 class LoanDataGenerator(DataGenerator):
 
     COLUMN_NAMES = ["applicant", "co_signer", "loan_amount", "eligibility", "interest_rate", "reason"]
     EVAL_COLUMN_NAMES = ["eligibility", "interest_rate", "reason"]
+    NESTED_COLUMNS = ["applicant", "co_signer"]
 
-    def __init__(self):
-        super().__init__(LoanApprovalPolicy())
+    def __init__(self, reference_date: date = None, date_ordinals: bool = False):
+        """
+        :param reference_date: The day the requests are generated for and labelled at, today if not given.
+        :param date_ordinals: Whether the dates are stored as date ordinals (pre-parsed) instead of ISO strings.
+        """
+        self.context = EvaluationContext(reference_date)
+        self.date_ordinals = date_ordinals
+        super().__init__(LoanApprovalPolicy(self.context))
 
     def generate_applicant(self, is_co_signer=False, eligible=False) -> Applicant:
         """Generate an applicant or co-signer with randomized values."""
 
         random_employment_status=random.choice(["full-time", "part-time", "self-employed"])
         return Applicant(
-            birth_date=date.today() - timedelta(days=random.randint(18 if not eligible else 10, 40) * 365),
+            birth_date=self.context.reference_date - timedelta(days=random.randint(18 if not eligible else 10, 40) * 365),
             address={"country": random.choice(["US", "Canada", "UK", "India"]) if is_co_signer else "US"},
             credit_score=random.randint(600, 850),
             annual_income=random.randint(30000, 150000),
@@ -37,36 +45,64 @@ class LoanDataGenerator(DataGenerator):
 
     def generate_eligible_case(self) -> dict:
         """Generate a fully eligible loan request."""
-        applicant = self.generate_applicant(eligible=True)
-        age = (date.today() - applicant.birth_date).days // 365
-        if age < 18:
-            co_signer = self.generate_applicant()
-        else:
-            co_signer = self.generate_applicant() if random.choice([True, False]) else None
+        return self.labelled_case(self.generate_eligible_request())
 
-        if applicant.employment_status == "self-employed":
-            applicant.is_financial_record_present = True
-
-        loan_request = LoanRequest(applicant, co_signer, random.randint(5000, 50000))
+    def generate_non_eligible_case(self) -> dict:
+        """Generate a non-eligible loan request with a randomized reason."""
+        return self.labelled_case(self.generate_non_eligible_request())
+
+    def generate_request_batch(self, num_samples=100) -> LoanRequestBatch:
+        """
+        Generate loan requests straight into a LoanRequestBatch, half eligible and half not, without labelling them
+        (see LoanApprovalPolicy.test_eligibility_batch).
+        """
+        num_positive = num_samples // 2
+        return LoanRequestBatch.from_requests([self.generate_eligible_request() for _ in range(num_positive)]
+                                              + [self.generate_non_eligible_request()
+                                                 for _ in range(num_samples - num_positive)],
+                                              self.context.reference_date)
+
+    def labelled_case(self, loan_request: LoanRequest) -> dict:
+        """The dataset row of a loan request, with the results of the policy."""
         eligibility, interest_rate, reason = self.determine_eligibility(loan_request.to_dict())
 
         return {
-            "applicant": json.dumps(loan_request.applicant.to_dict()),
-            "co_signer": json.dumps(loan_request.co_signer.to_dict()) if loan_request.co_signer else None,
+            "applicant": self.applicant_json(loan_request.applicant),
+            "co_signer": self.applicant_json(loan_request.co_signer) if loan_request.co_signer else None,
             "loan_amount": loan_request.loan_amount,
             "eligibility": eligibility,
             "interest_rate": interest_rate,
             "reason": reason
         }
 
-    def generate_non_eligible_case(self) -> dict:
+    def applicant_json(self, applicant: Applicant) -> str:
+        """The JSON text of an applicant in the dataset, with the birth date as a date ordinal if date_ordinals."""
+        data = applicant.to_dict()
+        if self.date_ordinals and applicant.birth_date:
+            data["birth_date"] = applicant.birth_date.toordinal()
+        return json.dumps(data)
+
+    def generate_eligible_request(self) -> LoanRequest:
+        """Generate a fully eligible loan request."""
+        applicant = self.generate_applicant(eligible=True)
+        if applicant.birth_date.toordinal() > self.context.years_ago(18):
+            co_signer = self.generate_applicant()
+        else:
+            co_signer = self.generate_applicant() if random.choice([True, False]) else None
+
+        if applicant.employment_status == "self-employed":
+            applicant.is_financial_record_present = True
+
+        return LoanRequest(applicant, co_signer, random.randint(5000, 50000))
+
+    def generate_non_eligible_request(self) -> LoanRequest:
         """Generate a non-eligible loan request with a randomized reason."""
         applicant = self.generate_applicant()
         co_signer = self.generate_applicant() if random.choice([True, False]) else None
 
         # Introduce various reasons for ineligibility
         failure_cases = [
-            {"birth_date": date.today() - timedelta(days=random.randint(10, 17) * 365), "co_signer": None },  # Underage
+            {"birth_date": self.context.reference_date - timedelta(days=random.randint(10, 17) * 365), "co_signer": None },  # Underage
             {"address": {"country": random.choice(["Canada", "UK", "India"])}, "co_signer": co_signer},  # Non-US resident
             {"credit_score": random.randint(300, 550), "co_signer": co_signer},  # Low credit score
             {"annual_income": random.randint(5000, 25000), "co_signer": co_signer},  # Low income
@@ -81,30 +117,9 @@ class LoanDataGenerator(DataGenerator):
             setattr(applicant, key, value)
             co_signer = failure_case["co_signer"]
 
-        loan_request = LoanRequest(applicant, co_signer, random.randint(5000, 100000))
-        eligibility, interest_rate, reason = self.determine_eligibility(loan_request.to_dict())
-
-        # csv = loan_request.to_dict()
-        # csv["eligibility"] = eligibility
-        # csv["interest_rate"] = interest_rate
-        # csv["reason"] = reason
-
-        return {
-            "applicant": json.dumps(loan_request.applicant.to_dict()),
-            "co_signer": json.dumps(loan_request.co_signer.to_dict()) if loan_request.co_signer else None,
-            "loan_amount": loan_request.loan_amount,
-            "eligibility": eligibility,
-            "interest_rate": interest_rate,
-            "reason": reason
-        }
-        # return csv
+        return LoanRequest(applicant, co_signer, random.randint(5000, 100000))
 
 
 if __name__ == "__main__":
-    sizes = [100, 1000]
-    generator = LoanDataGenerator()
-
-    for size in sizes:
-        df = generator.generate_test_dataset(size)
-        data_units = format_data_units(size)
-        df.to_csv(f'loan_policy_test_dataset_{data_units}.csv', index=False, quoting=1, doublequote=True)
+    args = data_generator_parser(reference_date=True).parse_args()
+    write_test_datasets(LoanDataGenerator(args.reference_date, args.date_ordinals), 'loan_policy_test_dataset_{size}.{format}', args, quoting=1, doublequote=True)
@@ -1,13 +1,18 @@
 import sys
 import os
+import json
 from datetime import date, timedelta
-from typing import Tuple
+from typing import Dict, List, Tuple
 
-from loan.loan_compliance.loan_request import LoanRequest, Applicant
+import numpy as np
+
+from loan.loan_compliance.loan_request import LoanRequest, Applicant, FrozenLoanRequest, LoanRequestBatch
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
 from common.abstract_policy import Policy
+from common.evaluation_context import EvaluationContext
+from common.json_columns import PRESENT_FIELD
 
 
 class LoanApprovalPolicy(Policy):
@@ -16,24 +21,37 @@ class LoanApprovalPolicy(Policy):
     """
     LOCAL_COUNTRIES_ABBREVIATIONS = ["us", "usa", "united states", "united states of america"]
     ACCEPTED_INCOME_PROOFS = ["pay_stub", "tax_return", "bank_statement"]
+    # Reasons of the rejections, in the order of the checks; their index is the reason code of evaluate_columns
+    REJECTION_REASONS = [
+        "Applicant must be at least 18 years old or co-signer must be present.",
+        "Applicant must be at least 18 years old or co-signer must be at least 18 years old.",
+        "Applicant must be a resident or citizen of the United States.",
+        "Applicant must have a minimum credit score of 600.",
+        "Applicant must have an annual income of at least $30,000.",
+        "Applicant must have an income document proof of at least $30,000.",
+        "Unemployed applicant cannot get the loan.",
+        "Self-employed applicants must provide 2 years of financial records.",
+        "Applicant's debt-to-income ratio must not exceed 40%.",
+        "Loan amount must be between $5,000 and $50,000.",
+    ]
+    APPROVED = -1
 
     def test_eligibility(self, case) -> Tuple[bool, float, str]:
         """
         Tests the eligibility of a loan applicant based on predefined criteria.
         """
-        if not isinstance(case, LoanRequest):
+        if not isinstance(case, (LoanRequest, FrozenLoanRequest)):
             case = LoanRequest.from_dict(case)
 
         applicant = case.applicant
         co_signer = case.co_signer
 
         # Age Check
-        age = (date.today() - applicant.birth_date).days // 365
-        if age < 18:
+        adult_cutoff = self.evaluation_context().years_ago(18)
+        if applicant.birth_date.toordinal() > adult_cutoff:
             if not co_signer:
                 return False, 0.0, "Applicant must be at least 18 years old or co-signer must be present."
-            age_co_signer = (date.today() - co_signer.birth_date).days // 365
-            if age_co_signer < 18:
+            if co_signer.birth_date.toordinal() > adult_cutoff:
                 return False, 0.0, "Applicant must be at least 18 years old or co-signer must be at least 18 years old."
 
         # Residency Check
@@ -74,6 +92,142 @@ class LoanApprovalPolicy(Policy):
         # If all checks pass
         return True, interest_rate, f"Loan approved with {interest_rate:.2f}% APR."
 
+    def test_eligibility_batch(self, frame) -> List[Tuple[bool, float, str]]:
+        """
+        Columnar version of `test_eligibility`: the frame (or LoanRequestBatch) is decoded into arrays
+        (see columns_from_frame), evaluated at once by evaluate_columns, and each row gets the reason of the first
+        check it fails.
+        """
+        columns = self.columns_from_batch(frame) if isinstance(frame, LoanRequestBatch) else self.columns_from_frame(frame)
+        reason_codes, interest_rates = self.evaluate_columns(columns, self.evaluation_context())
+
+        return [
+            (True, rate, f"Loan approved with {rate:.2f}% APR.") if code == self.APPROVED
+            else (False, 0.0, self.REJECTION_REASONS[code])
+            for code, rate in zip(reason_codes.tolist(), interest_rates.tolist())
+        ]
+
+    def evaluate_columns(self, columns: Dict[str, np.ndarray],
+                         context: EvaluationContext = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Evaluates the checks of `test_eligibility` as ordered boolean masks over arrays of loan requests.
+
+        :param columns: One array per field, as built by columns_from_frame: "birth_date" and "co_signer_birth_date"
+                        (date ordinals, the latter only read where "has_co_signer"), "country" (lower case),
+                        "credit_score", "annual_income", "income_document", "employment_status",
+                        "is_financial_record_present", "dti" and "loan_amount".
+        :param context: The reference date the ages are checked at, evaluation_context() if not given.
+        :return: The reason code of every request, i.e. the index in REJECTION_REASONS of the first failed check
+                 (APPROVED if none), and the APR of every request (only meaningful for the approved ones).
+        """
+        adult_cutoff = (context or self.evaluation_context()).years_ago(18)
+        has_co_signer = columns["has_co_signer"]
+        employment_status = columns["employment_status"]
+        loan_amount = columns["loan_amount"]
+
+        underage = columns["birth_date"] > adult_cutoff
+        failed = np.stack([
+            underage & ~has_co_signer,
+            underage & has_co_signer & (columns["co_signer_birth_date"] > adult_cutoff),
+            ~np.isin(columns["country"], self.LOCAL_COUNTRIES_ABBREVIATIONS),
+            columns["credit_score"] < 600,
+            columns["annual_income"] < 30000,
+            ~np.isin(columns["income_document"], self.ACCEPTED_INCOME_PROOFS),
+            employment_status == "unemployed",
+            (employment_status == "self-employed") & ~columns["is_financial_record_present"],
+            # round(dti, 2) > 0.40 holds exactly for the ratios that are >= 0.405
+            columns["dti"] >= 0.405,
+            (loan_amount < 5000) | (loan_amount > 50000),
+        ])
+
+        reason_codes = np.where(failed.any(axis=0), failed.argmax(axis=0), self.APPROVED)
+        interest_rates = np.clip(15 - ((columns["credit_score"] - 600) / 100) * 2, 5, 15)
+        return reason_codes, interest_rates
+
+    @staticmethod
+    def columns_from_batch(batch: LoanRequestBatch) -> Dict[str, np.ndarray]:
+        """The arrays of evaluate_columns, taken from a LoanRequestBatch without building any object."""
+        arrays = batch.arrays
+        return {
+            "birth_date": arrays["birth_date"],
+            "has_co_signer": arrays["has_co_signer"],
+            "co_signer_birth_date": arrays["co_signer_birth_date"],
+            "country": np.char.lower(arrays["country"].astype(str)).astype(object),
+            "credit_score": arrays["credit_score"],
+            "annual_income": arrays["annual_income"],
+            "income_document": arrays["income_document"],
+            "employment_status": arrays["employment_status"],
+            "is_financial_record_present": arrays["is_financial_record_present"],
+            "dti": batch.dti(),
+            "loan_amount": arrays["loan_amount"],
+        }
+
+    @staticmethod
+    def columns_from_decoded(frame) -> Dict[str, np.ndarray]:
+        """
+        The arrays of evaluate_columns, taken from the typed columns added by JsonColumnParser(APPLICANT_SCHEMA)
+        parse functions of the applicant and co_signer columns ("applicant.credit_score"...).
+        """
+        debt = np.nan_to_num(frame["applicant.monthly_debt_amount"].to_numpy(dtype=float))
+        gross = np.nan_to_num(frame["applicant.monthly_gross_income"].to_numpy(dtype=float))
+
+        return {
+            "birth_date": frame["applicant.birth_date"].to_numpy(),
+            "has_co_signer": frame[f"co_signer.{PRESENT_FIELD}"].to_numpy(dtype=bool),
+            "co_signer_birth_date": frame["co_signer.birth_date"].to_numpy(),
+            "country": frame["applicant.address.country"].astype(str).str.lower().to_numpy(dtype=object),
+            "credit_score": frame["applicant.credit_score"].to_numpy(dtype=float),
+            "annual_income": frame["applicant.annual_income"].to_numpy(dtype=float),
+            "income_document": frame["applicant.income_document"].to_numpy(dtype=object),
+            "employment_status": frame["applicant.employment_status"].to_numpy(dtype=object),
+            "is_financial_record_present": frame["applicant.is_financial_record_present"].to_numpy(dtype=bool),
+            "dti": np.divide(debt, gross, out=np.zeros(len(frame)), where=(debt != 0) & (gross != 0)),
+            "loan_amount": frame["loan_amount"].to_numpy(dtype=float),
+        }
+
+    def columns_from_frame(self, frame) -> Dict[str, np.ndarray]:
+        """Decodes the applicant and co-signer cells (JSON text, dictionaries or Applicants) of a frame into the
+        arrays of evaluate_columns, or takes them from the typed columns of columns_from_decoded if present."""
+        if "applicant.birth_date" in frame.columns and f"co_signer.{PRESENT_FIELD}" in frame.columns:
+            return self.columns_from_decoded(frame)
+
+        applicants = [self._as_dict(value) for value in frame["applicant"]]
+        co_signers = [self._as_dict(value) for value in frame["co_signer"]]
+
+        debt = np.nan_to_num(self._numeric_field(applicants, "monthly_debt_amount"))
+        gross = np.nan_to_num(self._numeric_field(applicants, "monthly_gross_income"))
+        # Parses every distinct ISO date once, and takes pre-parsed date ordinals as they are
+        ordinal = self.evaluation_context().ordinal
+
+        return {
+            "birth_date": np.array([ordinal(a["birth_date"]) for a in applicants], dtype=np.int64),
+            "has_co_signer": np.array([bool(c) for c in co_signers], dtype=bool),
+            "co_signer_birth_date": np.array([ordinal(c["birth_date"]) if c else 0 for c in co_signers],
+                                             dtype=np.int64),
+            "country": np.array([str((a.get("address") or {}).get("country", "")).lower() for a in applicants],
+                                dtype=object),
+            "credit_score": self._numeric_field(applicants, "credit_score"),
+            "annual_income": self._numeric_field(applicants, "annual_income"),
+            "income_document": np.array([a.get("income_document") or "" for a in applicants], dtype=object),
+            "employment_status": np.array([a.get("employment_status", "unemployed") for a in applicants], dtype=object),
+            "is_financial_record_present": np.array([bool(a.get("is_financial_record_present", False))
+                                                     for a in applicants], dtype=bool),
+            "dti": np.divide(debt, gross, out=np.zeros(len(applicants)), where=(debt != 0) & (gross != 0)),
+            "loan_amount": frame["loan_amount"].to_numpy(dtype=float),
+        }
+
+    @staticmethod
+    def _as_dict(value) -> dict:
+        if isinstance(value, Applicant):
+            return value.to_dict()
+        if isinstance(value, str):
+            return json.loads(value) if value else {}
+        return value or {}
+
+    @staticmethod
+    def _numeric_field(applicants, field) -> np.ndarray:
+        return np.array([a.get(field) for a in applicants], dtype=float)
+
 
 import unittest
 
@@ -176,6 +330,90 @@ class TestLoanApprovalPolicy(unittest.TestCase):
         result = self.policy.test_eligibility(loan_request)
         self.assertEqual(13, result[1])
 
+    def test_batch_matches_scalar(self):
+        import pandas as pd
+
+        underage = Applicant.from_dict(self.valid_applicant.to_dict())
+        underage.birth_date = date.today() - timedelta(days=17 * 365)
+        self_employed = Applicant.from_dict(self.valid_applicant.to_dict())
+        self_employed.employment_status = "self-employed"
+        self_employed.is_financial_record_present = False
+        requests = [
+            LoanRequest(self.valid_applicant, loan_amount=20000),
+            LoanRequest(self.valid_applicant, loan_amount=60000),
+            LoanRequest(underage, loan_amount=20000),
+            LoanRequest(underage, co_signer=self.valid_applicant, loan_amount=20000),
+            LoanRequest(self_employed, loan_amount=20000),
+        ]
+        frame = pd.DataFrame([{
+            "applicant": json.dumps(request.applicant.to_dict()),
+            "co_signer": json.dumps(request.co_signer.to_dict()) if request.co_signer else "",
+            "loan_amount": request.loan_amount
+        } for request in requests])
+
+        expected = [self.policy.test_eligibility(request) for request in requests]
+        self.assertEqual(expected, self.policy.test_eligibility_batch(frame))
+
+    def test_batch_matches_scalar_on_reference_dataset(self):
+        import pandas as pd
+
+        frame = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "loan_policy_test_dataset_1K.csv"),
+                            na_filter=True).fillna("")
+        expected = [self.policy.test_eligibility(row) for _, row in frame.iterrows()]
+        self.assertEqual(expected, self.policy.test_eligibility_batch(frame))
+
+    def test_decoded_columns_match_scalar(self):
+        import pandas as pd
+        from common.json_columns import JsonColumnParser
+        from loan.loan_compliance.loan_request import APPLICANT_SCHEMA
+
+        frame = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "loan_policy_test_dataset_1K.csv"),
+                            na_filter=True).fillna("")
+        expected = [self.policy.test_eligibility(row) for _, row in frame.iterrows()]
+        for column in ("applicant", "co_signer"):
+            decoded = JsonColumnParser(APPLICANT_SCHEMA)(frame[column])
+            frame = frame.join(decoded)
+        self.assertEqual(expected, self.policy.test_eligibility_batch(frame))
+
+    def test_reason_codes(self):
+        import pandas as pd
+
+        requests = [LoanRequest(self.valid_applicant, loan_amount=amount) for amount in (20000, 60000)]
+        frame = pd.DataFrame([{"applicant": request.applicant.to_dict(), "co_signer": None,
+                               "loan_amount": request.loan_amount} for request in requests])
+        reason_codes, interest_rates = self.policy.evaluate_columns(self.policy.columns_from_frame(frame))
+        self.assertEqual(reason_codes.tolist(), [LoanApprovalPolicy.APPROVED,
+                                                 LoanApprovalPolicy.REJECTION_REASONS.index(
+                                                     "Loan amount must be between $5,000 and $50,000.")])
+        self.assertEqual(interest_rates.tolist(), [13, 13])
+
+    def test_request_batch(self):
+        underage = Applicant.from_dict(self.valid_applicant.to_dict())
+        underage.birth_date = date.today() - timedelta(days=17 * 365)
+        requests = [
+            LoanRequest(self.valid_applicant, loan_amount=20000),
+            LoanRequest(underage, co_signer=self.valid_applicant, loan_amount=20000),
+            LoanRequest(underage, loan_amount=20000),
+        ]
+        batch = LoanRequestBatch.from_requests(requests)
+        expected = [self.policy.test_eligibility(request) for request in requests]
+        self.assertEqual(expected, self.policy.test_eligibility_batch(batch))
+        self.assertEqual(expected, [self.policy.test_eligibility(batch[index]) for index in range(len(batch))])
+
+    def test_fixed_evaluation_context(self):
+        import pandas as pd
+
+        # 18 years (of 365 days) old on the reference date, 17 the day before
+        context = EvaluationContext(self.valid_applicant.birth_date + timedelta(days=18 * 365))
+        requests = [LoanRequest(self.valid_applicant, loan_amount=20000)]
+        frame = pd.DataFrame([{"applicant": self.valid_applicant.to_dict(), "co_signer": None, "loan_amount": 20000}])
+        for reference_date, approved in ((context.reference_date, True),
+                                         (context.reference_date - timedelta(days=1), False)):
+            policy = LoanApprovalPolicy(EvaluationContext(reference_date))
+            self.assertEqual(policy.test_eligibility(requests[0])[0], approved)
+            self.assertEqual(policy.test_eligibility_batch(frame)[0][0], approved)
+            self.assertEqual(policy.test_eligibility_batch(LoanRequestBatch.from_requests(requests))[0][0], approved)
+
 
 if __name__ == "__main__":
     unittest.main()
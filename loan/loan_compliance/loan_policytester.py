@@ -6,11 +6,18 @@ from loan_policy import LoanApprovalPolicy
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
 from common.generic_tester import PolicyTester
+from common.json_columns import JsonColumnParser
+from loan.loan_compliance.loan_request import APPLICANT_SCHEMA
 
 if __name__ == "__main__":
     config = {
         'policy_class': LoanApprovalPolicy,
         'csv_file': 'loan_policy_test_dataset_100.csv',
+        # Decodes the applicant columns at once into typed columns, read by LoanApprovalPolicy.test_eligibility_batch
+        'parse_functions': {
+            'applicant': JsonColumnParser(APPLICANT_SCHEMA),
+            'co_signer': JsonColumnParser(APPLICANT_SCHEMA)
+        },
         'eval_columns': ["eligibility", "interest_rate", "reason"],
         'save_in_csv': False
     }
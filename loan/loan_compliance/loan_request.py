@@ -1,6 +1,36 @@
+import os
+import sys
 import json
 from datetime import date
-from typing import Dict
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+from common.evaluation_context import as_date
+
+
+def _hashable(value):
+    """A hashable equivalent of a JSON-like value, equal values (e.g. 2 and 2.0) having equal hashes."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+# Types of the Applicant fields read by the policies, for the columnar decoding of the datasets (see json_columns.py)
+APPLICANT_SCHEMA = {
+    "birth_date": "date",
+    "address.country": "str",
+    "credit_score": "float",
+    "annual_income": "float",
+    "income_document": "str",
+    "employment_status": ("str", "unemployed"),
+    "is_financial_record_present": "bool",
+    "monthly_debt_amount": "float",
+    "monthly_gross_income": "float",
+}
 
 
 class Applicant:
@@ -46,7 +76,7 @@ class Applicant:
         if not data:
             return None
         return Applicant(
-            birth_date=date.fromisoformat(data["birth_date"]) if data.get("birth_date") else None,
+            birth_date=as_date(data["birth_date"]) if data.get("birth_date") else None,
             address=data.get("address", {}),
             credit_score=data.get("credit_score", None),
             annual_income=data.get("annual_income", None),
@@ -63,7 +93,7 @@ class Applicant:
         return self.to_dict() == other.to_dict()
 
     def __hash__(self):
-        return hash(self.to_dict())
+        return hash(_hashable(self.to_dict()))
 
     def __repr__(self):
         return json.dumps(self.to_dict(), indent=2)
@@ -99,7 +129,294 @@ class LoanRequest:
         return self.to_dict() == other.to_dict()
 
     def __hash__(self):
-        return hash(self.to_dict())
+        return hash(_hashable(self.to_dict()))
 
     def __repr__(self):
         return json.dumps(self.to_dict(), indent=2)
+
+
+class FrozenApplicant:
+    """
+    Compact, immutable and hashable Applicant: slotted attributes, the address kept as a _hashable tuple of (key, value) pairs,
+    and the debt-to-income ratio and age in days computed once, at construction.
+    Policies read it like an Applicant.
+    """
+    __slots__ = ("birth_date", "_address", "credit_score", "annual_income", "income_document", "employment_status",
+                 "is_financial_record_present", "monthly_debt_amount", "monthly_gross_income", "dti", "age_in_days",
+                 "_hash")
+    # The fields an applicant is compared and hashed on: the derived dti and age in days are left out, so that the
+    # same applicant is equal to itself whatever the reference date
+    _IDENTITY = __slots__[:9]
+
+    def __init__(self,
+                 birth_date: date = None,
+                 address: Dict = None,
+                 credit_score: float = None,
+                 annual_income: float = None,
+                 income_document: str = None,
+                 employment_status: str = None,
+                 is_financial_record_present: bool = False,
+                 monthly_debt_amount: float = None,
+                 monthly_gross_income: float = None,
+                 reference_date: date = None):
+        """
+        See Applicant for the fields.
+
+        :param reference_date: The date the age in days is computed at; the age in days is None without it.
+        """
+        values = {
+            "birth_date": birth_date,
+            "_address": _hashable(address or {}),
+            "credit_score": credit_score,
+            "annual_income": annual_income,
+            "income_document": income_document,
+            "employment_status": employment_status,
+            "is_financial_record_present": is_financial_record_present,
+            "monthly_debt_amount": monthly_debt_amount,
+            "monthly_gross_income": monthly_gross_income,
+            "dti": round(monthly_debt_amount / monthly_gross_income
+                         if monthly_debt_amount and monthly_gross_income else 0.0, 2),
+            "age_in_days": (reference_date - birth_date).days if birth_date and reference_date else None,
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_hash", hash(tuple(values[name] for name in self._IDENTITY)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"FrozenApplicant is immutable, cannot set '{name}'")
+
+    @property
+    def address(self) -> Dict:
+        """The address fields; nested values, if any, keep their hashable (tuple) form."""
+        return dict(self._address)
+
+    def calculate_dti(self):
+        return self.dti
+
+    def to_dict(self) -> dict:
+        return {
+            "birth_date": self.birth_date.isoformat() if self.birth_date else None,
+            "address": self.address,
+            "credit_score": self.credit_score,
+            "annual_income": self.annual_income,
+            "income_document": self.income_document,
+            "employment_status": self.employment_status,
+            "is_financial_record_present": self.is_financial_record_present,
+            "monthly_debt_amount": self.monthly_debt_amount,
+            "monthly_gross_income": self.monthly_gross_income
+        }
+
+    @staticmethod
+    def from_applicant(applicant: Applicant, reference_date: date = None):
+        if applicant is None:
+            return None
+        return FrozenApplicant(applicant.birth_date, applicant.address, applicant.credit_score,
+                               applicant.annual_income, applicant.income_document, applicant.employment_status,
+                               applicant.is_financial_record_present, applicant.monthly_debt_amount,
+                               applicant.monthly_gross_income, reference_date)
+
+    @staticmethod
+    def from_dict(data: dict, reference_date: date = None):
+        return FrozenApplicant.from_applicant(Applicant.from_dict(data), reference_date)
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenApplicant):
+            return False
+        return all(getattr(self, name) == getattr(other, name) for name in self._IDENTITY)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"FrozenApplicant({self.to_dict()})"
+
+
+class FrozenLoanRequest:
+    """Compact, immutable and hashable LoanRequest of FrozenApplicants."""
+    __slots__ = ("applicant", "co_signer", "loan_amount", "_hash")
+
+    def __init__(self, applicant: FrozenApplicant, co_signer: FrozenApplicant = None, loan_amount: float = None):
+        object.__setattr__(self, "applicant", applicant)
+        object.__setattr__(self, "co_signer", co_signer)
+        object.__setattr__(self, "loan_amount", loan_amount)
+        object.__setattr__(self, "_hash", hash((applicant, co_signer, loan_amount)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"FrozenLoanRequest is immutable, cannot set '{name}'")
+
+    def to_dict(self) -> dict:
+        return {
+            "applicant": self.applicant.to_dict(),
+            "co_signer": self.co_signer.to_dict() if self.co_signer else None,
+            "loan_amount": self.loan_amount
+        }
+
+    @staticmethod
+    def from_request(request: LoanRequest, reference_date: date = None):
+        return FrozenLoanRequest(FrozenApplicant.from_applicant(request.applicant, reference_date),
+                                 FrozenApplicant.from_applicant(request.co_signer, reference_date),
+                                 request.loan_amount)
+
+    @staticmethod
+    def from_dict(data: dict, reference_date: date = None):
+        return FrozenLoanRequest.from_request(LoanRequest.from_dict(data), reference_date)
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenLoanRequest):
+            return False
+        return (self.applicant, self.co_signer, self.loan_amount) == (other.applicant, other.co_signer, other.loan_amount)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"FrozenLoanRequest({self.to_dict()})"
+
+
+class LoanRequestBatch:
+    """
+    Struct-of-arrays container of loan requests: one NumPy array per field of the applicants, of the co-signers
+    ("co_signer_" prefixed) and of the requests, instead of one object (or dictionary) per request.
+    The birth dates are stored as date ordinals (0 without co-signer); the addresses are reduced to their country.
+    The ages in days of the requests are computed at the reference date of the batch.
+    """
+    APPLICANT_FIELDS = {
+        "birth_date": np.int64,
+        "country": object,
+        "credit_score": float,
+        "annual_income": float,
+        "income_document": object,
+        "employment_status": object,
+        "is_financial_record_present": bool,
+        "monthly_debt_amount": float,
+        "monthly_gross_income": float,
+    }
+
+    def __init__(self, arrays: Dict[str, np.ndarray], reference_date: date = None):
+        """
+        :param arrays: The APPLICANT_FIELDS arrays, the same prefixed with "co_signer_", "has_co_signer" and
+                       "loan_amount", all of the same length.
+        :param reference_date: The date the ages in days are computed at (default: today, taken once).
+        """
+        self.arrays = arrays
+        self.reference_date = reference_date or date.today()
+
+    @staticmethod
+    def _applicant_values(applicant) -> List:
+        if applicant is None:
+            return [0, "", np.nan, np.nan, "", "", False, np.nan, np.nan]
+        return [applicant.birth_date.toordinal() if applicant.birth_date else 0,
+                (applicant.address or {}).get("country", ""),
+                applicant.credit_score, applicant.annual_income, applicant.income_document or "",
+                applicant.employment_status, bool(applicant.is_financial_record_present),
+                applicant.monthly_debt_amount, applicant.monthly_gross_income]
+
+    @staticmethod
+    def from_requests(requests, reference_date: date = None) -> "LoanRequestBatch":
+        """Builds a batch from LoanRequests or FrozenLoanRequests (see __init__ for the reference date)."""
+        applicants = [LoanRequestBatch._applicant_values(request.applicant) for request in requests]
+        co_signers = [LoanRequestBatch._applicant_values(request.co_signer) for request in requests]
+        arrays = {}
+        for index, (field, dtype) in enumerate(LoanRequestBatch.APPLICANT_FIELDS.items()):
+            arrays[field] = np.array([values[index] for values in applicants], dtype=dtype)
+            arrays[f"co_signer_{field}"] = np.array([values[index] for values in co_signers], dtype=dtype)
+        arrays["has_co_signer"] = np.array([request.co_signer is not None for request in requests], dtype=bool)
+        arrays["loan_amount"] = np.array([request.loan_amount for request in requests], dtype=float)
+        return LoanRequestBatch(arrays, reference_date)
+
+    @staticmethod
+    def from_frame(frame, reference_date: date = None) -> "LoanRequestBatch":
+        """Builds a batch from a dataset frame (applicant and co_signer as JSON text or dictionaries)."""
+        return LoanRequestBatch.from_requests([LoanRequest.from_dict(row) for row in frame.to_dict(orient="records")],
+                                              reference_date)
+
+    def dti(self) -> np.ndarray:
+        """The debt-to-income ratios of the applicants, not rounded (0 without debt or income)."""
+        debt = np.nan_to_num(self.arrays["monthly_debt_amount"])
+        gross = np.nan_to_num(self.arrays["monthly_gross_income"])
+        return np.divide(debt, gross, out=np.zeros(len(self)), where=(debt != 0) & (gross != 0))
+
+    def age_in_days(self, reference_date: date = None) -> np.ndarray:
+        """The ages in days of the applicants at the given date, the reference date of the batch if not given."""
+        return (reference_date or self.reference_date).toordinal() - self.arrays["birth_date"]
+
+    def __len__(self):
+        return len(self.arrays["loan_amount"])
+
+    def __getitem__(self, index) -> FrozenLoanRequest:
+        def applicant(prefix):
+            values = {field: self.arrays[f"{prefix}{field}"][index] for field in self.APPLICANT_FIELDS}
+            return FrozenApplicant(
+                birth_date=date.fromordinal(int(values["birth_date"])) if values["birth_date"] else None,
+                address={"country": values["country"]},
+                credit_score=values["credit_score"].item(),
+                annual_income=values["annual_income"].item(),
+                income_document=values["income_document"] or None,
+                employment_status=values["employment_status"],
+                is_financial_record_present=bool(values["is_financial_record_present"]),
+                monthly_debt_amount=values["monthly_debt_amount"].item(),
+                monthly_gross_income=values["monthly_gross_income"].item(),
+                reference_date=self.reference_date,
+            )
+
+        co_signer = applicant("co_signer_") if self.arrays["has_co_signer"][index] else None
+        return FrozenLoanRequest(applicant(""), co_signer, self.arrays["loan_amount"][index].item())
+
+    def __repr__(self):
+        return f"LoanRequestBatch({len(self)} requests)"
+
+
+import unittest
+
+
+class TestLoanRequest(unittest.TestCase):
+    def setUp(self):
+        self.applicant = Applicant(date(1990, 5, 17), {"country": "US"}, 700, 50000, "pay_stub", "full-time",
+                                   True, 1000, 5000)
+        self.co_signer = Applicant(date(1970, 1, 2), {"country": "UK"}, 650, 40000, None, "self-employed",
+                                   False, 500, 3000)
+
+    def test_hash(self):
+        request = LoanRequest(self.applicant, self.co_signer, 20000)
+        self.assertEqual(hash(request), hash(LoanRequest.from_dict(request.to_dict())))
+
+    def test_frozen_applicant(self):
+        frozen = FrozenApplicant.from_applicant(self.applicant, reference_date=date(2000, 5, 17))
+        self.assertEqual(frozen.calculate_dti(), self.applicant.calculate_dti())
+        self.assertEqual(frozen.age_in_days, 3653)
+        self.assertEqual(frozen.to_dict(), self.applicant.to_dict())
+        self.assertEqual(len({frozen, FrozenApplicant.from_dict(self.applicant.to_dict(), date(2000, 5, 17))}), 1)
+        with self.assertRaises(AttributeError):
+            frozen.credit_score = 800
+        self.assertFalse(hasattr(frozen, "__dict__"))
+
+    def test_frozen_identity_ignores_reference_date(self):
+        frozen = FrozenApplicant.from_applicant(self.applicant, reference_date=date(2000, 5, 17))
+        later = FrozenApplicant.from_applicant(self.applicant, reference_date=date(2024, 1, 1))
+        self.assertEqual(frozen, later)
+        self.assertEqual(hash(frozen), hash(later))
+        self.assertNotEqual(frozen, FrozenApplicant.from_applicant(self.co_signer, reference_date=date(2000, 5, 17)))
+
+    def test_frozen_nested_address(self):
+        address = {"country": "US", "lines": ["1 Main St", "Apt 2"], "geo": {"lat": 40.7, "lon": -74.0}}
+        frozen = FrozenApplicant(date(1990, 5, 17), address)
+        self.assertEqual(hash(frozen), hash(FrozenApplicant(date(1990, 5, 17), dict(reversed(address.items())))))
+        self.assertEqual(frozen.address["country"], "US")
+
+    def test_batch_round_trip(self):
+        requests = [LoanRequest(self.applicant, self.co_signer, 20000), LoanRequest(self.applicant, None, 7000)]
+        batch = LoanRequestBatch.from_requests(requests, date(2000, 5, 17))
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.arrays["credit_score"].tolist(), [700, 700])
+        self.assertEqual(batch.arrays["has_co_signer"].tolist(), [True, False])
+        self.assertEqual(batch.dti().tolist(), [0.2, 0.2])
+        self.assertEqual(batch.age_in_days().tolist(), [3653, 3653])
+        self.assertEqual([batch[index] for index in range(2)],
+                         [FrozenLoanRequest.from_request(request, date(2000, 5, 17)) for request in requests])
+        self.assertEqual([batch[index].applicant.age_in_days for index in range(2)], [3653, 3653])
+        self.assertEqual(batch[0].co_signer.age_in_days, 11093)
+        self.assertIsNone(FrozenApplicant(date(1990, 5, 17)).age_in_days)
+
+
+if __name__ == "__main__":
+    unittest.main()
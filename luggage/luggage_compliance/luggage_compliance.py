@@ -10,6 +10,10 @@ import unittest
 
 
 class LuggageCompliance(Policy):
+
+    # test_eligibility reads the request fields as attributes
+    BATCH_ROW_FORMAT = "tuple"
+
     def __init__(self):
         self.classes = {
             "Economy": {
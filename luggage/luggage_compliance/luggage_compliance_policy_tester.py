@@ -38,16 +38,22 @@ def parse_carry_on_items(item_str):
     return parsed_items
 
 
+def parse_luggages(value):
+    """The luggages of a cell: JSON text in csv datasets, a list of dictionaries in Parquet datasets."""
+    if isinstance(value, str):
+        return [Luggage.from_dict(item) for item in json.loads(value)] if len(value) > 0 else []
+    return [Luggage.from_dict(item) for item in value] if value is not None else []
+
+
 if __name__ == "__main__":
     # Define the configuration for the PolicyTester
     config = {
         'policy_class': LuggageCompliance,
         'csv_file': 'luggage_policy_test_dataset_100.csv',
         'parse_functions': {
-            'luggages': lambda x: [Luggage.from_dict(item) for item in json.loads(x)],
-            'moved_to_checked': lambda x: [Luggage.from_dict(item) for item in json.loads(x)] if pd.notnull(x) and len(
-                x) > 0 else [],
-            'cargo_items': lambda x: [Luggage.from_dict(item) for item in json.loads(x)] if pd.notnull(x) and len(x) > 0 else []
+            'luggages': parse_luggages,
+            'moved_to_checked': parse_luggages,
+            'cargo_items': parse_luggages
         },
         'eval_columns': ["compliance_result", "compliance_message", "moved_to_checked", "cargo_items", "fees"],
         'evaluators': [cargo_items_evaluator]
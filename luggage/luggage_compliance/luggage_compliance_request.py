@@ -39,7 +39,7 @@ class LuggageComplianceRequest:
         return LuggageComplianceRequest(
             travel_class=data["travel_class"],
             age_category=data["age_category"],
-            luggages=[Luggage.from_dict(l) for l in json.loads(data["luggages"])]
+            luggages=[Luggage.from_dict(l) for l in (json.loads(data["luggages"]) if isinstance(data["luggages"], str) else data["luggages"])]
         )
 
     @staticmethod
@@ -6,7 +6,7 @@ from typing import List, Dict
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
-from common.generic_data_generator import DataGenerator, format_data_units
+from common.generic_data_generator import DataGenerator, data_generator_parser, write_test_datasets
 from luggage_compliance import LuggageCompliance
 from luggage import Luggage
 from luggage_compliance_request import LuggageComplianceRequest
@@ -19,6 +19,7 @@ class LuggageDataGenerator(DataGenerator):
     ]
 
     EVAL_COLUMN_NAMES = ["eligibility", "compliance_result", "fees", "compliance_message", "cargo_items"]
+    NESTED_COLUMNS = ["luggages", "moved_to_checked", "cargo_items"]
 
     TRAVEL_CLASSES = ["Economy", "Business", "First"]
     AGE_CATEGORIES = ["adult", "child", "infant"]
@@ -124,10 +125,5 @@ class LuggageDataGenerator(DataGenerator):
 
 
 if __name__ == "__main__":
-    sizes = [100, 1000]
-    generator = LuggageDataGenerator()
-
-    for size in sizes:
-        df = generator.generate_test_dataset(size)
-        data_units = format_data_units(size)
-        df.to_csv(f'luggage_policy_test_dataset_{data_units}.csv', index=False)
+    args = data_generator_parser().parse_args()
+    write_test_datasets(LuggageDataGenerator(), 'luggage_policy_test_dataset_{size}.{format}', args)